@@ -1 +1,3 @@
-from . import gcdb, gcana, gcsim, gcplot
\ No newline at end of file
+__version__ = '0.1.2'
+
+from . import gcdb, gcana, gcsim, gcplot, gccache, gcbatch
@@ -20,29 +20,24 @@ import os
 import pandas as pd
 
 # needed for curve smoothing
-from scipy import signal
+from scipy import signal, fft
 
 # numerical operations
 import numpy as np
 from numba import jit
 
-from . import utils
-from scipy.optimize import curve_fit
-import uncertainties as unc
-from uncertainties import unumpy as unp
-
-import multiprocessing
+from . import utils, gcdb, gccache, gcbatch
+from scipy.optimize import curve_fit, least_squares, nnls
 
 import gc
 
+# output selection of the analysis pipeline
+import fnmatch
 
-def worker(doc, func):
-    func(doc)
-    return doc
 
-def update(data, func, njobs=-1):
+def update(data, func, njobs=-1, engine=None, arrays=None):
     """
-    Use a function to update given data using one or more threads 
+    Use a function to update given data using one or more processes
     
     Parameters
     ---------
@@ -53,33 +48,23 @@ def update(data, func, njobs=-1):
         function to be applied
 
     njobs
-        integer (default=-1). If -1, all available processors are used, otherwise the specified number of workers is launched
+        integer (default=-1). If -1, all available processors but one are used, otherwise the specified number of workers is launched
+
+    engine
+        None (default) or gcbatch.BatchEngine. If passed, its persistent workers are used, otherwise a temporary engine with njobs workers is started and closed again
+
+    arrays
+        list of field names or None (default). If given, only these array fields are sent to the workers
     
     Returns
     ----------
-    The function updates the data and does not return data
+    The function updates data bases in place and does not return data, updated documents are returned for documents and lists of documents
 
     """ 
-    pool = multiprocessing.Pool(processes=njobs if njobs != -1 else multiprocessing.cpu_count()-1)
-
-    if isinstance(data, dict):
-        docs = [data]
-    elif isinstance(data, list):
-        docs = data
-    else:
-        docs = data.all()
-
-    results = [pool.apply_async(worker, args=(doc, func)) for doc in docs]
-    docs = None
-
-    results = [result.get() for result in results]
-    if isinstance(data, dict):
-        return results[0]
-    elif isinstance(data, list):
-        return results
-    else:
-        data.write_back(results)
-        return
+    if engine is None:
+        with gcbatch.BatchEngine(njobs) as engine:
+            return engine.update(data, func, arrays)
+    return engine.update(data, func, arrays)
 
 def stripArrays(data, exclude=[]):
     """
@@ -126,14 +111,16 @@ def stripArrays(data, exclude=[]):
         return docs
 
 
-def getTable(db, asDataFrame=True):
+def getTable(db, asDataFrame=True, arrays=True):
     """
     Returns a table of data from the data base. 
     
     Parameters
     ---------
     db
-        data base or list of documents to get the parameters from
+        data base, list of documents or path of a stored data base to get the parameters from
+    arrays
+        Boolean (default: True). If False, array entries are left out and only the scalar parameters are tabulated
     
     Returns
     ---------
@@ -143,11 +130,17 @@ def getTable(db, asDataFrame=True):
 
     """ 
 
+    if isinstance(db, str):
+        db = gcdb.load(db)
+
     if asDataFrame:
         # if it is a list, some form of querying has happend, else get all documents
         if not isinstance(db, list):
             db = db.all()
 
+        if not arrays:
+            db = [{key: doc[key] for key in doc if not isinstance(doc[key], (np.ndarray, list))} for doc in db]
+
         results = pd.DataFrame(db)
 
     else: 
@@ -276,7 +269,7 @@ def getTimestamps(data, database, calc_fadingTimes=False):
     
     return data
 
-def calcGCparams(x, y):
+def calcGCparams(x, y, roi = None):
     """
     Compute standard parameters directly from the glow curve
     
@@ -288,6 +281,9 @@ def calcGCparams(x, y):
     y
         string or list or array. y-axis for the data, generally the photon counts for glow curve analysis. If a string is passed, a callable is returned
 
+    roi
+        None (default) or dict. Result of calcRoI for the curve, computed if not passed
+
     Returns
     ---------
     dict
@@ -314,7 +310,8 @@ def calcGCparams(x, y):
 
     #### RoI #######
     # calculate TU ROI
-    roi = calcRoI(x, y)
+    if roi is None:
+        roi = calcRoI(x, y)
     RoI_low_TU = x[roi['RoI_low']]
     RoI_up_TU = x[roi['RoI_high']]
 
@@ -364,6 +361,104 @@ class calcGCparamsWrapper(object):
         return data.update(calcGCparams(data[self.x], data[self.y]))
 
 
+def calcGCparamsBatch(x, y):
+    """
+    Compute the standard glow curve parameters of calcGCparams for many glow curves of equal length in one vectorised pass.
+    The time axis has to be increasing.
+
+    Example
+    ---------
+    Parameters of all curves of a data base table
+        >>> table = gcana.getTable(db)
+        >>> params = gcana.calcGCparamsBatch(table['time_sec'].iloc[0], np.stack(table['PhCount']))
+
+    Parameters
+    ---------
+    x
+        1D or 2D array-like or string. x-axis for the data, either shared by all curves or one row per curve. If a string is passed, a callable is returned to be applied on a DataFrame
+
+    y
+        2D array-like or string. y-axis for the data, one curve per row
+
+    Returns
+    ---------
+    DataFrame
+        one row per curve with the gc_* columns of calcGCparams. The RoI based columns are NaN for curves without a valid RoI
+
+    """
+
+    # special case: only column names are passed. In that case, a new callable is returned adding the columns to a data frame
+    if isinstance(x, str):
+        return lambda data: data.assign(**calcGCparamsBatch(np.stack(data[x].values), np.stack(data[y].values)).set_index(data.index))
+
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    x = np.broadcast_to(np.asarray(x, dtype=float), y.shape)
+    nCurves, length = y.shape
+    rows = np.arange(nCurves)
+
+    #### Curve data #####
+    # cumulated sums with leading zero: cumSum[:, k] is the sum of the first k entries
+    cumSum = np.zeros((nCurves, length+1))
+    np.cumsum(y, axis=1, out=cumSum[:, 1:])
+    results = {}
+    results['gc_Ntot'] = cumSum[:, -1]
+    results['gc_Nmean'] = cumSum[:, -1] / length
+    results['gc_Nmax'] = y.max(axis=1)
+    results['gc_tmax'] = x[rows, y.argmax(axis=1)]
+
+    #### RoI #######
+    roi = calcRoIBatch(x, y)
+    low = roi['RoI_low']
+    high = roi['RoI_high']
+    RoI_low_TU = x[rows, low]
+    RoI_up_TU = x[rows, high]
+    valid = RoI_low_TU < RoI_up_TU
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        results['gc_timeRoI_low'] = RoI_low_TU
+        results['gc_timeRoI_high'] = RoI_up_TU
+        results['gc_timeRoI_length'] = RoI_up_TU-RoI_low_TU
+
+        #### calc sig and bg counts #####
+        results['gc_tBinSize'] = x[:, 1] - x[:, 0]
+        sumLeft = cumSum[rows, low]
+        sumRight = cumSum[:, -1] - cumSum[rows, high+1]
+        meanLeft = sumLeft / low
+        meanRight = sumRight / (length-1-high)
+        results['gc_NtRoI'] = cumSum[rows, high] - sumLeft
+        results['gc_Nbg_m'] = (meanRight-meanLeft) / (RoI_up_TU-RoI_low_TU)
+        results['gc_Nbg_b'] = meanLeft-results['gc_Nbg_m']*RoI_low_TU
+        results['gc_Nbg'] = sumLeft + sumRight + (RoI_up_TU-RoI_low_TU)*0.5*1/results['gc_tBinSize']*(meanRight+meanLeft)
+        results['gc_Nsig'] = results['gc_Ntot'] - results['gc_Nbg']
+
+        #### quartiles from the cumulated sums ######
+        # the photons within the RoI are the entries low+1 to high-1. For non-negative counts the cumulated sums increase,
+        # so they are searched in the flattened cumulated sums with row offsets. Curves with negative counts (e.g. after
+        # a background subtraction) are searched for the last entry below the quartile as in calcGCparams
+        start = np.minimum(low+1, length)
+        RoI_start = cumSum[rows, start]
+        RoI_total = cumSum[rows, np.maximum(high, start)] - RoI_start
+        increasing = not np.any(y < 0)
+        if increasing:
+            offsets = np.concatenate([[0], np.cumsum(cumSum[:-1, -1] + 1)])
+            flatCumSum = (cumSum + offsets[:, np.newaxis]).ravel()
+        else:
+            entries = np.arange(length+1)
+            inRoI = (entries >= start[:, np.newaxis]+1) & (entries <= high[:, np.newaxis])
+        for key, quarter in zip(['gc_t_nphotonFirstQuarter', 'gc_t_nphotonSecondQuarter', 'gc_t_nphotonThirdQuarter'], [0.25, 0.50, 0.75]):
+            if increasing:
+                index = np.searchsorted(flatCumSum, RoI_start + quarter*RoI_total + offsets, 'right') - rows*(length+1) - 1
+            else:
+                below = inRoI & (cumSum <= (RoI_start + quarter*RoI_total)[:, np.newaxis])
+                index = np.where(below.any(axis=1), length - np.argmax(below[:, ::-1], axis=1), -1)
+            index = np.minimum(index, high)
+            results[key] = np.where(index >= low+2, x[rows, np.clip(index-1, 0, length-1)], np.nan)
+
+    results = pd.DataFrame(results)
+    roiColumns = [column for column in results.columns if column not in ['gc_Ntot', 'gc_Nmean', 'gc_Nmax', 'gc_tmax']]
+    results.loc[~valid, roiColumns] = np.nan
+    return results
+
 def calcRoI(x, y, iterations = 2):
     """
     Compute the RoI for given x and y
@@ -390,51 +485,231 @@ def calcRoI(x, y, iterations = 2):
     if isinstance(x, str):
         return lambda data: calcRoI(data[x], data[y]) if isinstance(data, pd.DataFrame)  else data.update(calcRoI(data[x], data[y]))
 
-    x = np.array(x)
-    y = np.array(y)
-        
-    # window size for the curve finder and correction for even numbers (can't be handled)
-    window = int(len(x)/3)
-    if np.mod(window,2)==0:
-        window += 1
+    roi = calcRoIBatch(x, np.asarray(y)[np.newaxis, :], iterations=iterations)
+    result = {
+            "RoI_low": int(roi["RoI_low"][0]),
+            "RoI_high": int(roi["RoI_high"][0]),
+            }
+    return result
 
-    # using a Savitzky-Golay filter to strongly smoothe the curve and find the peak area
-    smoothed = signal.savgol_filter(y, window , 4, deriv = 0)
-    startPoint = smoothed[x > 1].max()
+def _savgolSmooth(y, window, polyorder):
+    """
+    Internal helper computing signal.savgol_filter(y, window, polyorder, axis=1) (mode 'interp') of many rows at once.
+    The convolution is done in the frequency domain and the polynomial edge fits as matrix products, the results agree
+    with savgol_filter up to floating point rounding.
+    """
+    half = window//2
+    length = y.shape[1]
+    size = fft.next_fast_len(length + window - 1, real=True)
+    coeffs = signal.savgol_coeffs(window, polyorder)
+    smoothed = fft.irfft(fft.rfft(y, size, axis=1) * fft.rfft(coeffs, size), size, axis=1)[:, half:half+length]
+
+    # the edges are given by polynomials fitted to the first and last window
+    design = np.vander(np.arange(window, dtype=float), polyorder+1)
+    fit = np.linalg.pinv(design).T
+    smoothed[:, :half] = (y[:, :window] @ fit) @ design[:half].T
+    smoothed[:, length-half:] = (y[:, -window:] @ fit) @ design[window-half:].T
+    return smoothed
+
+def _walkRight(smoothed, start, threshold):
+    """
+    Internal helper returning for each row the first index right of start (included) which is not above the threshold, the last index if there is none
+    """
+    rows = np.arange(smoothed.shape[0])
+    stop = ~(smoothed > threshold[:, np.newaxis])
+    stop &= np.arange(smoothed.shape[1]) >= start[:, np.newaxis]
+    first = stop.argmax(axis=1)
+    return np.where(stop[rows, first], first, smoothed.shape[1]-1)
 
-    # get index of start value, first [0] gives array of index, second [0] returns int value, otherwise it would be overwritten as arrays are not copied
-    startIndex = np.where(smoothed == startPoint)[0][0]
+def _sideMeans(x, smoothed, cumSmoothed, leftSide, rightSide):
+    """
+    Internal helper computing the row wise means of the smoothed curves left of leftSide and right of rightSide, nan for empty sides
+    """
+    rows = np.arange(smoothed.shape[0])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if cumSmoothed is not None:
+            # increasing x: the sides are the leading and trailing entries
+            left = cumSmoothed[rows, leftSide] / leftSide
+            right = (cumSmoothed[:, -1] - cumSmoothed[rows, rightSide+1]) / (smoothed.shape[1]-1-rightSide)
+            return left, right
+        maskLeft = x < x[rows, leftSide][:, np.newaxis]
+        maskRight = x > x[rows, rightSide][:, np.newaxis]
+        left = np.where(maskLeft, smoothed, 0).sum(axis=1) / maskLeft.sum(axis=1)
+        right = np.where(maskRight, smoothed, 0).sum(axis=1) / maskRight.sum(axis=1)
+        return left, right
+
+def calcRoIBatch(x, y, iterations = 2):
+    """
+    Compute the RoI for many glow curves of equal length at once. The results match calcRoI for every single curve.
 
-    # search for ROI
-    leftSide = startIndex
-    meanVal = smoothed.mean()
-    while (smoothed[leftSide] > meanVal and leftSide > 0):
-        leftSide -= 1
+    Example
+    ---------
+    RoI of all curves of a data base table
+        >>> table = gcana.getTable(db)
+        >>> roi = gcana.calcRoIBatch(table['time_sec'].iloc[0], np.stack(table['PhCount']))
 
-    rightSide = startIndex
-    while (smoothed[rightSide] > meanVal and rightSide < (len(x)-1)):
-        rightSide += 1
+    Parameters
+    ---------
+    x
+        1D or 2D array-like. x-axis for the data, either shared by all curves or one row per curve. If a string is passed, a callable is returned to be applied on a DataFrame
 
+    y
+        2D array-like or string. y-axis for the data, one curve per row
 
-    for i in range(iterations):
-        # refine ROI 
-        meanValLeft = smoothed[x < x[leftSide]].mean()
-        while (smoothed[leftSide] > meanValLeft and leftSide > 0):
-            leftSide -= 1
+    iterations
+        The RoI is determined iteratively. Good results have been found with 2 iterations (default)
 
-        meanValRight = smoothed[x > x[rightSide]].mean()    
-        while (smoothed[rightSide] > meanValRight and rightSide < (len(x)-1)):
-            rightSide += 1
+    Returns
+    ---------
+    dict
+        dictionary containing the arrays of RoI indices of all curves
+
+    """
 
+    # special case: only column names are passed. In that case, a new callable is returned adding the RoI columns to a data frame
+    if isinstance(x, str):
+        return lambda data: data.assign(**calcRoIBatch(np.stack(data[x].values), np.stack(data[y].values), iterations=iterations))
+
+    roi = _roiIterations(x, y, iterations)[-1]
     result = {
-            "RoI_low": leftSide,
-            "RoI_high": rightSide,
+            "RoI_low": roi[0],
+            "RoI_high": roi[1],
             }
     return result
 
+def _roiIterations(x, y, iterations):
+    """
+    Internal helper for calcRoIBatch returning the RoI indices (low, high) after the initial search and after each
+    refinement, so stages using different numbers of iterations can share one computation
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    x = np.broadcast_to(np.asarray(x), y.shape)
+
+    # window size for the curve finder and correction for even numbers (can't be handled)
+    window = int(y.shape[1]/3)
+    if np.mod(window,2)==0:
+        window += 1
+
+    # using a Savitzky-Golay filter to strongly smoothe the curves and find the peak areas
+    smoothed = _savgolSmooth(y, window , 4)
+    startPoint = np.where(x > 1, smoothed, -np.inf).max(axis=1)
+    startIndex = np.argmax(smoothed == startPoint[:, np.newaxis], axis=1)
+
+    # search for ROI, the walks to the left are done as walks to the right on the reversed curves
+    length = y.shape[1]
+    reversedSmoothed = smoothed[:, ::-1].copy()
+    meanVal = smoothed.mean(axis=1)
+    leftSide = length-1 - _walkRight(reversedSmoothed, length-1 - startIndex, meanVal)
+    rightSide = _walkRight(smoothed, startIndex, meanVal)
+
+    cumSmoothed = None
+    if np.all(x[:, 1:] > x[:, :-1]):
+        cumSmoothed = np.zeros((y.shape[0], length+1))
+        np.cumsum(smoothed, axis=1, out=cumSmoothed[:, 1:])
+
+    rois = [(leftSide, rightSide)]
+    for i in range(iterations):
+        # refine ROI 
+        meanValLeft, meanValRight = _sideMeans(x, smoothed, cumSmoothed, leftSide, rightSide)
+        leftSide = length-1 - _walkRight(reversedSmoothed, length-1 - leftSide, meanValLeft)
+        rightSide = _walkRight(smoothed, rightSide, meanValRight)
+        rois.append((leftSide, rightSide))
+    return rois
+
+
+def _trecoStartValues(RoI_low, RoI_high, maxCounts, tailMean, fourPeaks):
+    """
+    Internal helper returning the start values and limits of the gaussian fit of calcTreco. The inputs may be arrays
+    of many curves, the parameters are then stacked along the last axis.
+    """
+    RoI_len = RoI_high - RoI_low
+    zero = np.zeros_like(RoI_len)
+    if not fourPeaks:
+        # start values and limits for the three peak gaussian fit
+        p0 = [RoI_len/3, RoI_len/3, RoI_high,
+                RoI_len/6, zero, zero,
+                maxCounts, maxCounts, maxCounts,
+                tailMean]
+        limitsLow = [RoI_len/8, RoI_len/8, RoI_high-RoI_len/3,
+                0.1+zero, zero, zero,
+                zero, maxCounts/2, maxCounts/3,
+                zero]
+        limitsHigh = [RoI_len/2, RoI_len/3, RoI_high,
+                RoI_len/4, 0.2+zero, 0.2+zero,
+                np.inf+zero, np.inf+zero, np.inf+zero,
+                np.inf+zero]
+    else:
+        p0 = [RoI_len/3, RoI_len/4, RoI_len/4, RoI_high,
+                RoI_len/8, zero, zero, zero,
+                zero, maxCounts, maxCounts, maxCounts,
+                tailMean]
+        limitsLow = [RoI_len/8, RoI_len/8, RoI_len/8, RoI_high-RoI_len/4,
+                0.1+zero, zero, zero, zero,
+                zero, maxCounts/4, maxCounts/3, maxCounts/3,
+                zero]
+        limitsHigh = [RoI_len/3, RoI_len/3, RoI_len/3, RoI_high,
+                RoI_len/6, 0.2+zero, 0.2+zero, 0.2+zero,
+                np.inf+zero, np.inf+zero, np.inf+zero, np.inf+zero,
+                np.inf+zero]
+    return np.stack(p0, axis=-1).astype(float), np.stack(limitsLow, axis=-1).astype(float), np.stack(limitsHigh, axis=-1).astype(float)
+
+def _trecoPeakResults(results, params, cov, fourPeaks):
+    """
+    Internal helper writing the peak positions, widths, heights and the background of the gaussian fit of calcTreco to
+    results. params and cov may hold many curves along the leading axis.
+    """
+    cov = np.diagonal(cov, axis1=-2, axis2=-1)
+    param_offset = 1 if fourPeaks else 0
+
+    # write peak positions
+    results['Treco_t5'] = params[..., 2 + param_offset]
+    results['Treco_t5_std_dev'] = np.sqrt(cov[..., 2 + param_offset])
+    results['Treco_t4'] = results['Treco_t5']-params[..., 1 + param_offset]
+    results['Treco_t4_std_dev'] = np.sqrt(results['Treco_t5_std_dev']**2 + np.sqrt(cov[..., 1 + param_offset])**2)
+    results['Treco_t3'] = results['Treco_t4']-params[..., param_offset]
+    results['Treco_t3_std_dev'] = np.sqrt(results['Treco_t4_std_dev']**2 + np.sqrt(cov[..., param_offset])**2)
 
+    # write sigmas
+    results['Treco_sigma3'] = params[..., 3 + 2*param_offset]
+    
+    results['Treco_sigma3_std_dev'] = np.sqrt(cov[..., 3 + 2*param_offset])
+    results['Treco_sigma4'] = results['Treco_sigma3'] + params[..., 1 + 3 + 2*param_offset]
+    results['Treco_sigma4_std_dev'] = np.sqrt(results['Treco_sigma3_std_dev']**2 + np.sqrt(cov[..., 1 + 3 + 2*param_offset])**2)
+    results['Treco_sigma5'] = results['Treco_sigma4'] + params[..., 2 + 3 + 2*param_offset]
+    results['Treco_sigma5_std_dev'] = np.sqrt(results['Treco_sigma4_std_dev']**2 + np.sqrt(cov[..., 2 + 3 + 2*param_offset])**2)
+    
+    # write heights
+    results['Treco_I5'] = params[..., 2 + 6 + 3*param_offset]
+    results['Treco_I5_std_dev'] = np.sqrt(cov[..., 2 + 6 + 3*param_offset])
+    results['Treco_I4'] = params[..., 1 + 6 + 3*param_offset]
+    results['Treco_I4_std_dev'] = np.sqrt(cov[..., 1 + 6 + 3*param_offset])
+    results['Treco_I3'] = params[..., 6 + 3*param_offset]
+    results['Treco_I3_std_dev'] = np.sqrt(cov[..., 6 + 3*param_offset])
+
+    # write background
+    results['Treco_bg'] = params[..., 9 + 3*param_offset]
+    results['Treco_bg_std_dev'] = np.sqrt(cov[..., 9 + 3*param_offset])
+
+    # additional entries for 4 peaks
+    if fourPeaks:
+        results['Treco_t2'] = results['Treco_t3'] - params[..., 0]
+        results['Treco_t2_std_dev'] = np.sqrt(results['Treco_t3_std_dev']**2 + np.sqrt(cov[..., 0])**2)
+
+        results['Treco_sigma2'] = params[..., 4]
+        results['Treco_sigma2_std_dev'] = np.sqrt(cov[..., 4])
+
+        results['Treco_sigma3'] =  results['Treco_sigma3'] + params[..., 4]
+        results['Treco_sigma3_std_dev'] = np.sqrt(results['Treco_sigma3_std_dev']**2 + np.sqrt(cov[..., 4])**2)
+        results['Treco_sigma4'] =  results['Treco_sigma4'] + params[..., 4]
+        results['Treco_sigma4_std_dev'] = np.sqrt(results['Treco_sigma4_std_dev']**2 + np.sqrt(cov[..., 4])**2)
+        results['Treco_sigma5'] =  results['Treco_sigma5'] + params[..., 4]
+        results['Treco_sigma5_std_dev'] = np.sqrt(results['Treco_sigma5_std_dev']**2 + np.sqrt(cov[..., 4])**2)
+
+        results['Treco_I2'] = params[..., 8]
+        results['Treco_I2_std_dev'] = np.sqrt(cov[..., 8])
+    return results
 
-def calcTreco(x, y, peaks = 3):
+def calcTreco(x, y, peaks = 3, cache = None, cacheKey = None, roi = None):
     """
     Perform the temperature reconstruction on an input data set either using a fixed or dynamic number of peaks.
 
@@ -447,6 +722,12 @@ def calcTreco(x, y, peaks = 3):
         array-like or string. If array-like, used as y-axis of analysis, typically photon counts of measurement. If string, the call will return a callable to be applied to a data set containing that y column
     peaks
         None or integer (default=3). If passed, used as fixed number of peaks so be searched. Auto uses an experimental automatic peak detection algorithm.
+    cache
+        None (default) or gccache.FitCache. If passed, the fit starts from the last converged parameters of the same detector and readout configuration and stores its result. The result is not stored if the fit runs in worker processes, see gccache.FitCache
+    cacheKey
+        None (default) or key of the curve in the cache, see gccache.fitKey. Determined from the data set if a callable is returned
+    roi
+        None (default) or dict. Result of calcRoI with iterations=0 for the curve, computed if not passed
 
     Returns
     -------
@@ -455,7 +736,7 @@ def calcTreco(x, y, peaks = 3):
         dictionary containing the results of the Treco calculation
     """
     if isinstance(x, str):
-        return calcTrecoWrapper(x, y, peaks)
+        return calcTrecoWrapper(x, y, peaks, cache)
         # return lambda data: calcTreco(data[x], data[y], peaks) if isinstance(data, pd.DataFrame)  else data.update(calcTreco(data[x], data[y], peaks))
 
     results = {}
@@ -463,7 +744,8 @@ def calcTreco(x, y, peaks = 3):
     tPhotons = np.array(y)
 
     try:
-        roi = calcRoI(t, tPhotons, iterations=0)
+        if roi is None:
+            roi = calcRoI(t, tPhotons, iterations=0)
         if (roi['RoI_low'] == 0 or roi['RoI_high'] == len(t)):
             Warning('RoI limit set to maximum or minimum value! Indicator for corrupted glow curve at {}'.format(gc_id))
         RoI_low = t[roi['RoI_low']]
@@ -509,42 +791,16 @@ def calcTreco(x, y, peaks = 3):
     else:
         peakIndices = np.zeros(peaks)
 
-    if len(peakIndices) <= 3:
-        # start values and limits for the three peak gaussian fit
-        p0 = np.array([(RoI_high-RoI_low)/3, (RoI_high-RoI_low)/3, RoI_high,
-                            RoI_len/6,0,0,
-                            tPhotons.max(),tPhotons.max(),tPhotons.max(),
-                            tPhotons[np.where(t>RoI_high)[0]].mean()
-                            ])
-        limitsLow=np.array([(RoI_high-RoI_low)/8,(RoI_high-RoI_low)/8,RoI_high-(RoI_high-RoI_low)/3,
-                            0.1, 0, 0,
-                            0, tPhotons.max()/2, tPhotons.max()/3,
-                            0
-                            ])
-        limitsHigh=np.array([(RoI_high-RoI_low)/2,(RoI_high-RoI_low)/3,RoI_high,
-                            RoI_len/4, 0.2, 0.2,
-                            np.inf, np.inf, np.inf,
-                                np.inf
-                            ])
-
-        fitFunction = utils.gaussianMultiPeak3
-    else:
-        p0 = np.array([(RoI_high-RoI_low)/3, (RoI_high-RoI_low)/4, (RoI_high-RoI_low)/4, RoI_high,
-                        RoI_len/8, 0, 0, 0,
-                        0,tPhotons.max(),tPhotons.max(),tPhotons.max(),
-                        tPhotons[np.where(t>RoI_high)[0]].mean()
-                        ])
-        limitsLow=np.array([(RoI_high-RoI_low)/8, (RoI_high-RoI_low)/8,(RoI_high-RoI_low)/8,RoI_high-(RoI_high-RoI_low)/4,
-                            0.1, 0, 0, 0,
-                            0,tPhotons.max()/4 ,tPhotons.max()/3, tPhotons.max()/3,
-                            0
-                            ])
-        limitsHigh=np.array([(RoI_high-RoI_low)/3, (RoI_high-RoI_low)/3,(RoI_high-RoI_low)/3,RoI_high,
-                            RoI_len/6, 0.2, 0.2, 0.2,
-                            np.inf, np.inf, np.inf, np.inf,
-                            np.inf
-                            ])
-        fitFunction = utils.gaussianMultiPeak4
+    fitFunction = utils.gaussianMultiPeak3 if len(peakIndices) <= 3 else utils.gaussianMultiPeak4
+    fitJacobian = utils.gaussianMultiPeak3Jacobian if len(peakIndices) <= 3 else utils.gaussianMultiPeak4Jacobian
+    p0, limitsLow, limitsHigh = _trecoStartValues(RoI_low, RoI_high, tPhotons.max(), tPhotons[np.where(t>RoI_high)[0]].mean(), len(peakIndices) > 3)
+
+    # warm start from the last converged fit, the heights and the background scale with the curve
+    cacheStage = "calcTreco_%s"%len(p0)
+    amplitudes = [6, 7, 8, 9] if fitFunction is utils.gaussianMultiPeak3 else [8, 9, 10, 11, 12]
+    warmStart = gccache.warmStart(cache, cacheKey, cacheStage, p0, [limitsLow, limitsHigh], tPhotons.max(), amplitudes=amplitudes)
+    if warmStart is not None:
+        p0 = warmStart
 
 
     try:
@@ -552,70 +808,23 @@ def calcTreco(x, y, peaks = 3):
         params, cov = curve_fit(
                 fitFunction, 
                 t, tPhotons, 
-                p0 = p0, bounds=[limitsLow, limitsHigh],
+                p0 = p0, bounds=[limitsLow, limitsHigh], jac = fitJacobian,
             )
+        # curve_fit raises if the fit did not converge
+        converged = True
         chi = utils.calcRedChisq(tPhotons, fitFunction(t,*params), np.sqrt(tPhotons), len(tPhotons)-len(params))
         results["Treco_performed"] = True
-    except Exception as e:
+        if cache is not None and converged:
+            cache.put(cacheKey, cacheStage, params, tPhotons.max())
+    except Exception:
         Warning('Error in temperature reconstruction!')
         results["Treco_error"] = True
         return results
     
     # write the params and errors to the curve
     results['Treco_redChi2'] = chi
-    if len(peakIndices) > 3:
-        param_offset = 1
-    else:
-        param_offset = 0
-
-    # write peak positions
-    results['Treco_t5'] = params[2 + param_offset]
-    results['Treco_t5_std_dev'] = np.sqrt(cov[2 + param_offset, 2 + param_offset])
-    results['Treco_t4'] = results['Treco_t5']-params[1 + param_offset]
-    results['Treco_t4_std_dev'] = np.sqrt(results['Treco_t5_std_dev']**2 + np.sqrt(cov[1 + param_offset , 1 + param_offset])**2)
-    results['Treco_t3'] = results['Treco_t4']-params[param_offset]
-    results['Treco_t3_std_dev'] = np.sqrt(results['Treco_t4_std_dev']**2 + np.sqrt(cov[param_offset, param_offset])**2)
-
-    # write sigmas
-    results['Treco_sigma3'] = params[3 + 2*param_offset]
-    
-    results['Treco_sigma3_std_dev'] = np.sqrt(cov[3 + 2*param_offset, 3 + 2*param_offset])
-    results['Treco_sigma4'] = results['Treco_sigma3'] + params[1 + 3 + 2*param_offset]
-    results['Treco_sigma4_std_dev'] = np.sqrt(results['Treco_sigma3_std_dev']**2 + np.sqrt(cov[1 + 3 + 2*param_offset , 1 + 3 + 2*param_offset])**2)
-    results['Treco_sigma5'] = results['Treco_sigma4'] + params[2 + 3 + 2*param_offset]
-    results['Treco_sigma5_std_dev'] = np.sqrt(results['Treco_sigma4_std_dev']**2 + np.sqrt(cov[2 + 3 + 2*param_offset, 2 + 3 + 2*param_offset])**2)
-    
-    # write heights
-    results['Treco_I5'] = params[2 + 6 + 3*param_offset]
-    results['Treco_I5_std_dev'] = np.sqrt(cov[2 + 6 + 3*param_offset, 2 + 6 + 3*param_offset])
-    results['Treco_I4'] = params[1 + 6 + 3*param_offset]
-    results['Treco_I4_std_dev'] = np.sqrt(cov[1 + 6 + 3*param_offset , 1 + 6 + 3*param_offset])
-    results['Treco_I3'] = params[6 + 3*param_offset]
-    results['Treco_I3_std_dev'] = np.sqrt(cov[6 + 3*param_offset, 6 + 3*param_offset])
+    _trecoPeakResults(results, params, cov, len(peakIndices) > 3)
 
-    # write background
-    results['Treco_bg'] = params[9 + 3*param_offset]
-    results['Treco_bg_std_dev'] = np.sqrt(cov[9 + 3*param_offset, 9 + 3*param_offset])
-
-    # additional entries for 4 peaks
-    if len(peakIndices) > 3:
-        results['Treco_t2'] = results['Treco_t3'] - params[0]
-        results['Treco_t2_std_dev'] = np.sqrt(results['Treco_t3_std_dev']**2 + np.sqrt(cov[0, 0])**2)
-
-        results['Treco_sigma2'] = params[4]
-        results['Treco_sigma2_std_dev'] = np.sqrt(cov[4, 4])
-
-        results['Treco_sigma3'] =  results['Treco_sigma3'] + params[4]
-        results['Treco_sigma3_std_dev'] = np.sqrt(results['Treco_sigma3_std_dev']**2 + np.sqrt(cov[4, 4])**2)
-        results['Treco_sigma4'] =  results['Treco_sigma4'] + params[4]
-        results['Treco_sigma4_std_dev'] = np.sqrt(results['Treco_sigma4_std_dev']**2 + np.sqrt(cov[4, 4])**2)
-        results['Treco_sigma5'] =  results['Treco_sigma5'] + params[4]
-        results['Treco_sigma5_std_dev'] = np.sqrt(results['Treco_sigma5_std_dev']**2 + np.sqrt(cov[4, 4])**2)
-
-        results['Treco_I2'] = params[8]
-        results['Treco_I2_std_dev'] = np.sqrt(cov[8,8])
-    
-    
     # define known peak temperatures
     peakTemperatures = utils.peakTemps
     peakTimes = np.array([results['Treco_t3'], results['Treco_t4'], results['Treco_t5']])
@@ -625,10 +834,9 @@ def calcTreco(x, y, peaks = 3):
         peakTimes = np.insert(peakTimes, 0, results['Treco_t2'])
 
 
-    # fit with given data'preheat_performed' in TrecoInfo.columns and results['preheat_performed'] == 1:
-    try:
-        TfitParams, TfitCov = curve_fit(exponentialHeatingWrapper(), peakTimes, peakTemperatures)
-    except (ValueError, RuntimeError):
+    # closed form fit of the exponential heating to the known peak temperatures
+    TfitParams, TfitCov = utils.fitExponentialHeating(peakTimes, peakTemperatures)
+    if not np.all(np.isfinite(TfitParams)):
         Warning("Error during temperature reconstruction: temperature array creation")
         results["Treco_error"] = True
         return results
@@ -639,32 +847,212 @@ def calcTreco(x, y, peaks = 3):
     results['Treco_alpha'] = TfitParams[1]
     results['Treco_alpha_std_dev'] = np.sqrt(TfitCov[1, 1])
 
-    T = utils.exponentialHeating(t, TfitParams[0], TfitParams[1])
-    results["Treco_T(t)"] = T
     binWidth = 2.5
-    results['Treco_binWidth'] = 2.5
-        
-    gcTemp = np.linspace(T.min(), T.max(), int((T.max()- T.min())/binWidth))
-    results["Treco_T"] = gcTemp
-    gcPhotons = utils.rebinHistRescale(T , tPhotons, gcTemp)
-    results['Treco_PhCount'] = gcPhotons
+    results['Treco_binWidth'] = binWidth
+    results["Treco_T(t)"], results["Treco_T"], results['Treco_PhCount'] = utils.exponentialHeatingGrid(t, tPhotons, TfitParams[0], TfitParams[1], binWidth)
 
     return results
 
-class exponentialHeatingWrapper(object):
-    def __init__(self):
-        self.fitFunc = utils.exponentialHeating
-    def __call__(self, x, y, z):
-        return  self.fitFunc(x, y, z)
-
-
 class calcTrecoWrapper(object):
-    def __init__(self, x, y, peaks):
+    def __init__(self, x, y, peaks, cache=None):
         self.x = x
         self.y = y
         self.peaks = peaks
+        self.cache = cache
     def __call__(self, data):
-        return data.update(calcTreco(data[self.x], data[self.y], self.peaks))
+        return data.update(calcTreco(data[self.x], data[self.y], self.peaks, cache=self.cache, cacheKey=gccache.fitKey(data) if self.cache is not None else None))
+
+def _batchLeastSquares(model, x, y, p0, low, high, maxIter = 200, gtol = 1e-8):
+    """
+    Internal bounded Levenberg-Marquardt solver advancing the least squares problems of many curves in lockstep.
+    model(x, params) returns the model values (n, len) and the Jacobian (n, m, len) for the parameters (n, m) of n
+    curves, x is shared or has one row per curve. The parameters at a bound with the gradient pointing outwards are
+    kept fixed during a step, they are released as soon as the gradient points back inside. The other steps are
+    projected onto the bounds. A curve has converged once the cosine between its residuals and every Jacobian column of
+    the free parameters is below gtol, i.e. the projected gradient vanishes, and leaves the iteration. Curves whose
+    steps keep failing leave it unconverged.
+    Returns the parameters, their covariance as computed by curve_fit and the convergence mask.
+    """
+    x = np.asarray(x, dtype=float)
+    params = np.clip(np.array(p0, dtype=float), low, high)
+    n, m = params.shape
+    rows = (lambda index: x[index]) if x.ndim > 1 else (lambda index: x)
+
+    values, jacobian = model(x, params)
+    residuals = y - values
+    cost = np.sum(residuals**2, axis=1)
+    damping = np.full(n, 1e-3)
+    converged = np.zeros(n, dtype=bool)
+    active = np.isfinite(cost)
+
+    for iteration in range(maxIter+1):
+        index = np.flatnonzero(active)
+        if len(index) == 0:
+            break
+        J = jacobian[index] if len(index) < n else jacobian
+        hessian = np.matmul(J, J.transpose(0, 2, 1))
+        gradient = np.matmul(J, residuals[index, :, np.newaxis])[:, :, 0]
+
+        # parameters at a bound which the step would leave are fixed
+        current = params[index]
+        fixed = ((current <= low[index]) & (gradient < 0)) | ((current >= high[index]) & (gradient > 0))
+        gradient[fixed] = 0
+        diagonal = np.diagonal(hessian, axis1=1, axis2=2)
+
+        # convergence test on the projected gradient, scaled by the norms of the residuals and the Jacobian columns
+        with np.errstate(all='ignore'):
+            cosine = np.nan_to_num(np.abs(gradient)/np.sqrt(diagonal*cost[index, np.newaxis]))
+        done = cosine.max(axis=1) <= gtol
+        converged[index[done]] = True
+        active[index[done]] = False
+        if iteration == maxIter or np.all(done):
+            break
+        index, hessian, gradient, current, fixed, diagonal = index[~done], hessian[~done], gradient[~done], current[~done], fixed[~done], diagonal[~done]
+
+        scaling = np.maximum(diagonal, 1e-12*diagonal.max(axis=1, keepdims=True) + np.finfo(float).tiny)
+        system = hessian + (damping[index, np.newaxis]*scaling)[:, :, np.newaxis]*np.eye(m)
+        system[np.repeat(fixed[:, :, np.newaxis], m, axis=2) | np.repeat(fixed[:, np.newaxis, :], m, axis=1)] = 0
+        system[:, np.arange(m), np.arange(m)] += fixed
+        try:
+            step = np.linalg.solve(system, gradient[:, :, np.newaxis])[:, :, 0]
+        except np.linalg.LinAlgError:
+            step = np.einsum('nmk,nk->nm', np.linalg.pinv(system), gradient)
+
+        trial = np.clip(current + step, low[index], high[index])
+        trialValues, trialJacobian = model(rows(index), trial)
+        trialResiduals = y[index] - trialValues
+        trialCost = np.sum(trialResiduals**2, axis=1)
+
+        # accepted steps lower the damping, rejected steps raise it
+        better = trialCost < cost[index]
+        accepted = index[better]
+        params[accepted] = trial[better]
+        values[accepted], jacobian[accepted], residuals[accepted], cost[accepted] = trialValues[better], trialJacobian[better], trialResiduals[better], trialCost[better]
+        damping[accepted] = np.maximum(damping[accepted]/10, 1e-12)
+        damping[index[~better]] *= 10
+        active[index[~better][damping[index[~better]] > 1e10]] = False
+
+    # covariance as computed by curve_fit
+    cov = np.linalg.pinv(np.matmul(jacobian, jacobian.transpose(0, 2, 1)))
+    dof = y.shape[1] - m
+    cov = cov*(cost/dof)[:, np.newaxis, np.newaxis] if dof > 0 else np.full_like(cov, np.inf)
+    return params, cov, converged
+
+def calcTrecoBatch(x, y, peaks = 3, chunkSize = 128, maxIter = 200):
+    """
+    Perform the temperature reconstruction for many glow curves of equal length at once. The gaussian fits of all curves
+    of a chunk are advanced in lockstep by a bounded Levenberg-Marquardt solver, so the residuals, Jacobians and linear
+    solves of the curves are computed in single vectorised steps. Curves whose batched fit did not converge or ended with
+    a vanished peak (height 0, its position is then undetermined) are refit one by one as in calcTreco. Results with a
+    non-physical heating (T0 not between 0 K and the plate temperature or alpha <= 0) are marked with 'Treco_error'.
+
+    Example
+    ---------
+    Temperature reconstruction of all curves of a data base table
+        >>> table = gcana.getTable(db)
+        >>> treco = gcana.calcTrecoBatch(table['time_sec'].iloc[0], np.stack(table['PhCount']))
+        >>> table = table.assign(**pd.DataFrame(treco, index=table.index))
+
+    Parameters
+    ---------
+    x
+        1D or 2D array-like or string. Time axis of the curves, either shared by all curves or one row per curve. If a string is passed, a callable is returned to be applied on a DataFrame
+    y
+        2D array-like or string. Photon counts, one curve per row
+    peaks
+        integer (default=3). Number of peaks, 3 or 4. The automatic peak detection of calcTreco is not supported
+    chunkSize
+        integer (default=128). Number of curves solved together, limits the memory of the Jacobians
+    maxIter
+        integer (default=200). Maximum number of iterations per curve, curves which did not converge are refit as in calcTreco
+
+    Returns
+    ---------
+    list
+        list of dictionaries with the results of calcTreco, one per curve
+    """
+
+    # special case: only column names are passed. In that case, a new callable is returned adding the Treco columns to a data frame
+    if isinstance(x, str):
+        return lambda data: data.assign(**pd.DataFrame(calcTrecoBatch(np.stack(data[x].values), np.stack(data[y].values), peaks, chunkSize, maxIter), index=data.index))
+
+    if peaks not in [3, 4]:
+        raise AttributeError("Invalid number of peaks for calcTrecoBatch: ", peaks)
+
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    x = np.array(np.broadcast_to(np.asarray(x, dtype=float), y.shape))
+    length = y.shape[1]
+    results = [{} for curve in y]
+
+    # RoI of all curves, curves with the RoI at the limits are not reconstructed as in calcTreco
+    low, high = _roiIterations(x, y, 0)[0]
+    rows = np.arange(len(y))
+    valid = (low != 0) & (high != length)
+    RoI_low = x[rows, low]
+    RoI_high = x[rows, np.minimum(high, length-2)]
+    tail = x > RoI_high[:, np.newaxis]
+    with np.errstate(all='ignore'):
+        tailMean = np.where(tail, y, 0).sum(axis=1)/tail.sum(axis=1)
+    for pos in np.flatnonzero(valid):
+        results[pos].update({'Treco_param_RoI_low': RoI_low[pos], 'Treco_param_RoI_high': RoI_high[pos]})
+
+    p0, limitsLow, limitsHigh = _trecoStartValues(RoI_low, RoI_high, y.max(axis=1), tailMean, peaks == 4)
+    valid &= np.all(np.isfinite(p0), axis=1) & np.all((p0 >= limitsLow) & (p0 <= limitsHigh), axis=1)
+
+    fitFunction = utils.gaussianMultiPeak3 if peaks == 3 else utils.gaussianMultiPeak4
+    fitJacobian = utils.gaussianMultiPeak3Jacobian if peaks == 3 else utils.gaussianMultiPeak4Jacobian
+    params = np.full(p0.shape, np.nan)
+    cov = np.full(p0.shape + p0.shape[-1:], np.nan)
+    for start in range(0, len(y), chunkSize):
+        chunk = np.flatnonzero(valid[start:start+chunkSize]) + start
+        if len(chunk) == 0:
+            continue
+        params[chunk], cov[chunk], converged = _batchLeastSquares(utils.gaussianMultiPeakBatch, x[chunk], y[chunk], p0[chunk], limitsLow[chunk], limitsHigh[chunk], maxIter)
+
+        # refit of the curves stuck at a vanished peak or without convergence, as in calcTreco
+        vanished = np.any(params[chunk, 2*peaks:3*peaks] <= 0, axis=1)
+        for pos in chunk[~converged | vanished]:
+            try:
+                params[pos], cov[pos] = curve_fit(fitFunction, x[pos], y[pos], p0=p0[pos], bounds=[limitsLow[pos], limitsHigh[pos]], jac=fitJacobian)
+            except Exception:
+                valid[pos] = False
+
+    fitted = {}
+    _trecoPeakResults(fitted, params, cov, peaks == 4)
+    with np.errstate(all='ignore'):
+        prediction = utils.gaussianMultiPeakBatch(x, np.nan_to_num(params))[0]
+        chi = np.sum((y - prediction)**2/np.where(y == 0, prediction, y), axis=1)/(length - p0.shape[1])
+
+    # exponential heating from the peak positions to the known peak temperatures
+    peakTemperatures = utils.peakTemps if peaks == 4 else utils.peakTemps[1:]
+    peakTimes = np.stack([fitted['Treco_t%s'%peak] for peak in range(6-peaks, 6)], axis=1)
+    heating, heatingCov = utils.fitExponentialHeating(peakTimes, peakTemperatures)
+    with np.errstate(invalid='ignore'):
+        # the detector starts between 0 K and the temperature of the heater plate (573.15 K) and heats up
+        physical = (heating[:, 0] > 0) & (heating[:, 0] < 573.15) & (heating[:, 1] > 0)
+
+    binWidth = 2.5
+    for pos, result in enumerate(results):
+        if not valid[pos]:
+            result["Treco_error"] = True
+            continue
+        result["Treco_performed"] = True
+        result['Treco_redChi2'] = chi[pos]
+        result.update({key: value[pos] for key, value in fitted.items()})
+        if not physical[pos]:
+            Warning("Non-physical heating in the temperature reconstruction")
+            result["Treco_error"] = True
+            continue
+
+        result['Treco_T0'] = heating[pos, 0]
+        result['Treco_T0_std_dev'] = np.sqrt(heatingCov[pos, 0, 0])
+        result['Treco_alpha'] = heating[pos, 1]
+        result['Treco_alpha_std_dev'] = np.sqrt(heatingCov[pos, 1, 1])
+
+        result['Treco_binWidth'] = binWidth
+        result["Treco_T(t)"], result["Treco_T"], result['Treco_PhCount'] = utils.exponentialHeatingGrid(x[pos], y[pos], heating[pos, 0], heating[pos, 1], binWidth)
+
+    return results
 
 @jit(nopython=False)
 def fitmethod_kitis98(x, T1, T2, T3, T4, I1, I2, I3, I4, E1, E2, E3, E4 , A, B, C, D):
@@ -680,18 +1068,68 @@ def fitmethod_kitis98(x, T1, T2, T3, T4, I1, I2, I3, I4, E1, E2, E3, E4 , A, B,
 
 @jit(nopython=False)
 def fitmethod_kitis06(x, T1, T2, T3, T4, I1, I2, I3, I4, E1, E2, E3, E4 , A, B, C, D):
-    I = 0
-    I += utils.ckitis2006(x, T1, I1, E1)
-    I += utils.ckitis2006(x, T2, I2, E2)
-    I += utils.ckitis2006(x, T3, I3, E3)
-    I += utils.ckitis2006(x, T4, I4, E4)
+    I = utils.ckitis2006(x, [T1, T2, T3, T4], [I1, I2, I3, I4], [E1, E2, E3, E4]).sum(axis=0)
     bg = utils.backgroundFunction(x, A, B, C, D)
     bg = np.where(bg<0,0,bg)
     
     return I+bg
 
+def jacobian_kitis98(x, T1, T2, T3, T4, I1, I2, I3, I4, E1, E2, E3, E4 , A, B, C, D):
+    dTm, dIm, dE = utils.kitis1998Jacobian(x, np.array([T1, T2, T3, T4]), np.array([I1, I2, I3, I4]), np.array([E1, E2, E3, E4]))
+    return np.hstack([dTm.T, dIm.T, dE.T, utils.backgroundJacobian(x, A, B, C, D)])
+
+def jacobian_kitis06(x, T1, T2, T3, T4, I1, I2, I3, I4, E1, E2, E3, E4 , A, B, C, D):
+    dTm, dIm, dE = utils.kitis2006Jacobian(x, np.array([T1, T2, T3, T4]), np.array([I1, I2, I3, I4]), np.array([E1, E2, E3, E4]), function=utils.ckitis2006)
+    return np.hstack([dTm.T, dIm.T, dE.T, utils.backgroundJacobian(x, A, B, C, D)])
+
+# fit models of the gcFit stages: model function and Jacobian
+gcFitModels = {
+    'kitis98': (fitmethod_kitis98, jacobian_kitis98),
+    'kitis06': (fitmethod_kitis06, jacobian_kitis06),
+}
+
+# stages of gcFit, run in order. A stage is skipped if the reduced chi2 of the start values is below 'skip' and limited
+# to 'shortNfev' function evaluations if it is below 'shorten' (not applied to the last stage). 'maxNfev' limits the
+# evaluations of a stage, None runs it until convergence, 'warmNfev' replaces the limit for warm started fits. A limit
+# trades accuracy for speed, stages stopped by it are reported in 'gcfit_converged_<stage>' and, for the last stage, in
+# 'gcfit_converged'. The last stage has to be kitis06.
+gcFitStages = [
+    {'name': 'kitis98', 'skip': 2., 'shorten': 5., 'shortNfev': 20, 'maxNfev': None},
+    {'name': 'kitis06', 'maxNfev': 100, 'warmNfev': 50},
+]
+
+def _checkFitStages(stages):
+    """
+    Internal helper raising an AttributeError for fit stages gcFit can not run
+    """
+    if stages is None:
+        return
+    if len(stages) == 0 or stages[-1].get('name') != 'kitis06' or any(stage.get('name') not in gcFitModels for stage in stages):
+        raise AttributeError("Invalid gcFit stages, the last stage has to be kitis06: ", stages)
+
+def _boundedFit(function, jacobian, x, y, p0, bounds, maxNfev=None):
+    """
+    Internal helper for a bounded least squares fit like curve_fit, which also returns results if maxNfev is reached.
+    Returns the parameters, their covariance, the number of function evaluations and whether the fit converged.
+    """
+    fit = least_squares(lambda p: function(x, *p) - y, p0, jac=lambda p: jacobian(x, *p), bounds=bounds, method='trf', max_nfev=maxNfev)
+    if fit.status < 0:
+        raise RuntimeError("Optimal parameters not found: " + fit.message)
+
+    # covariance as computed by curve_fit
+    _, s, VT = np.linalg.svd(fit.jac, full_matrices=False)
+    threshold = np.finfo(float).eps * max(fit.jac.shape) * s[0]
+    s = s[s > threshold]
+    VT = VT[:s.size]
+    cov = np.dot(VT.T / s**2, VT)
+    if len(y) > len(p0):
+        cov = cov * 2*fit.cost / (len(y) - len(p0))
+    else:
+        cov.fill(np.inf)
+    return fit.x, cov, fit.nfev, fit.status > 0
+
 ## Glow curve fit
-def gcFit(x, y):
+def gcFit(x, y, cache = None, cacheKey = None, stages = None, mode = 'full', reference = None, templates = None):
     """
     Perform the glow curve deconvolution for a given glow curve.
 
@@ -702,15 +1140,36 @@ def gcFit(x, y):
         array-like or string. If array-like, used as x-axis of analysis, should be temperature array from Treco. If string, the call will return a callable to be applied to a data set containing that x column
     y
         array-like or string. If array-like, used as y-axis of analysis, typically photon counts of measurement. If string, the call will return a callable to be applied to a data set containing that y column
+    cache
+        None (default) or gccache.FitCache. If passed, the fit starts from the last converged parameters of the same detector and readout configuration and stores its result. The result is not stored if the fit runs in worker processes, see gccache.FitCache
+    cacheKey
+        None (default) or key of the curve in the cache, see gccache.fitKey. Determined from the data set if a callable is returned
+    stages
+        None (default) or list of fit stages, see gcFitStages. The last stage has to be kitis06
+    mode
+        'full' (default) or 'fast'. The fast mode keeps Tm, E and the background shape of a reference fit and only
+        solves for the peak intensities and background amplitudes by non-negative linear least squares. Without
+        reference parameters the full fit is performed
+    reference
+        None (default) or array of the 16 fit parameters used by the fast mode. Taken from the cache entry of the curve if not passed
+    templates
+        None (default) or utils.TemplateBank. If passed, the fast mode interpolates the peak shapes from the bank
     
     Returns
     -------
 
-    GCio object containing the fitted data.
+    GCio object containing the fitted data. The mode which produced the results is given in 'gcfit_mode', the stages
+    of a full fit are listed in 'gcfit_stages' and the function evaluations of each stage in 'gcfit_nfev_<stage>'.
+    'gcfit_converged' is False if the final fit stopped at its 'maxNfev' limit or failed, the flags of the single stages
+    are given in 'gcfit_converged_<stage>'
     """
 
+    if mode not in gcFitModes:
+        raise AttributeError("Invalid gcFit mode: ", mode)
+    _checkFitStages(stages)
+
     if isinstance(x, str):
-        return gcFitWrapper(x, y) #if isinstance(data, pd.DataFrame)  else data.update(gcFitWrapper(data[x], data[y]))
+        return gcFitWrapper(x, y, cache, stages, mode, reference, templates) #if isinstance(data, pd.DataFrame)  else data.update(gcFitWrapper(data[x], data[y]))
         # return lambda data: gcFit(data[x], data[y]) if isinstance(data, pd.DataFrame)  else data.update(gcFit(data[x], data[y]))
 
     results = {}
@@ -751,41 +1210,134 @@ def gcFit(x, y):
             np.inf,np.inf,np.inf,np.inf,2.3,3.5,3.4,4.5,np.inf,580,10,.1] #maxima
             )
 
-    # fit marker
-    error = False
-    prefitVals = None
-
-    # actual fit
+    # fast mode: linear fit of the amplitudes with the shapes of the reference fit
+    if mode == 'fast':
+        if reference is None and cache is not None and cache.get(cacheKey, "gcFit") is not None:
+            reference = cache.get(cacheKey, "gcFit")[0]
+        if reference is not None:
+            t0 = time.time()
+            params, cov = _fastFit(gcTemp, gcPhotons, reference, templates)
+            results["gcfit_mode"] = "fast"
+            results["gcfit_converged"] = True
+            return _gcFitResults(results, gcTemp, gcPhotons, params, cov, t0)
+    results["gcfit_mode"] = "full"
+
+    # warm start from the last converged fit, the intensities and the background amplitudes scale with the curve
+    warmStart = gccache.warmStart(cache, cacheKey, "gcFit", p0, bounds, gcPhotons.max(), amplitudes=[4, 5, 6, 7, 12, 14])
+
+    if warmStart is not None:
+        p0 = warmStart
+        results["gcfit_warmStart"] = True
+
+    # actual fit, staged as configured in gcFitStages
     t0 = time.time()
-    
-    try:
-        params, cov = curve_fit(fitmethod_kitis98, gcTemp, gcPhotons, p0 = p0, 
-                                bounds = bounds,
-                                )
-        prefitVals = params
-    except Exception as e:
-        results["gcfit_prefit_error"] = True
-
-        Warning('Fit error kitis 98')
-    
-    if isinstance(prefitVals, np.ndarray):
-        p0 = prefitVals
-
-    try:
-        params, cov = curve_fit(fitmethod_kitis06, gcTemp, gcPhotons, p0 = p0, 
-                                bounds = bounds,
-                                )
-    except Exception as e:
-        Warning('Fit error kitis 06')
-        results["gcfit_error"] = True
-        return results
-    
+    stages = gcFitStages if stages is None else stages
+    dof = len(gcPhotons)-len(p0)
+    startChi2 = utils.calcRedChisq(gcPhotons, fitmethod_kitis06(gcTemp, *p0), np.sqrt(gcPhotons), dof)
+    results["gcfit_startRedChi2"] = startChi2
+    ranStages = []
+
+    for i, stage in enumerate(stages):
+        last = i == len(stages)-1
+        maxNfev = stage.get('maxNfev')
+        if warmStart is not None and stage.get('warmNfev') is not None:
+            maxNfev = stage['warmNfev']
+        if not last and stage.get('skip') is not None and startChi2 < stage['skip']:
+            results["gcfit_nfev_%s"%stage['name']] = 0
+            continue
+        if not last and stage.get('shorten') is not None and startChi2 < stage['shorten']:
+            maxNfev = stage['shortNfev']
+
+        function, jacobian = gcFitModels[stage['name']]
+        try:
+            params, cov, nfev, converged = _boundedFit(function, jacobian, gcTemp, gcPhotons, p0, bounds, maxNfev)
+        except Exception:
+            if last:
+                Warning('Fit error %s'%stage['name'])
+                results["gcfit_error"] = True
+                results["gcfit_converged"] = False
+                return results
+            results["gcfit_prefit_error"] = True
+            Warning('Fit error %s'%stage['name'])
+            continue
+        results["gcfit_nfev_%s"%stage['name']] = nfev
+        results["gcfit_converged_%s"%stage['name']] = converged
+        ranStages.append(stage['name'])
+        p0 = params
+
+    results["gcfit_stages"] = ",".join(ranStages)
+    results["gcfit_converged"] = converged
+
+    # only converged fits are used as warm starts
+    if cache is not None and converged:
+        cache.put(cacheKey, "gcFit", params, gcPhotons.max())
+
+    return _gcFitResults(results, gcTemp, gcPhotons, params, cov, t0)
+
+# modes of gcFit
+gcFitModes = ['full', 'fast']
+
+def _fastFit(gcTemp, gcPhotons, reference, templates=None):
+    """
+    Internal helper for the fast mode of gcFit. Tm, E and the background shape parameters b and d are kept from the
+    reference, the peak intensities and the background amplitudes a and c are non-negative linear coefficients of the
+    peak shapes and background terms. Returns the 16 parameters and their covariance, fixed parameters have zero variance.
+    """
+    params = np.array(reference, dtype=float)
+    Tm, E = params[0:4], params[8:12]
+    peakShapes = templates.shape(Tm, E, gcTemp) if templates is not None else utils.ckitis2006(gcTemp, Tm, np.ones(4), E)
+    with np.errstate(all='ignore'):
+        background = np.array([1/(params[13]-gcTemp), np.exp((gcTemp-300)*params[15])])
+    basis = np.nan_to_num(np.vstack([peakShapes, background]).T)
+
+    coefficients, _ = nnls(basis, gcPhotons)
+    params[4:8] = coefficients[:4]
+    params[[12, 14]] = coefficients[4:]
+
+    # covariance of the free coefficients, coefficients at the bound 0 are treated as fixed
+    free = np.flatnonzero(coefficients > 0)
+    indices = np.array([4, 5, 6, 7, 12, 14])[free]
+    cov = np.zeros((len(params), len(params)))
+    dof = len(gcPhotons) - len(free)
+    if len(free) and dof > 0:
+        residuals = gcPhotons - basis @ coefficients
+        cov[np.ix_(indices, indices)] = np.linalg.pinv(basis[:, free].T @ basis[:, free]) * np.sum(residuals**2)/dof
+    return params, cov
+
+def _backgroundCounts(gcTemp, values, errors):
+    """
+    Internal helper returning the background counts of gcFit and their uncertainty, propagated linearly from the
+    uncorrelated uncertainties of the background parameters a, b, c and d. The background is clipped at 0.
+    """
+    a, b, c, d = values
+    exponential = np.exp((gcTemp-300)*d)
+    background = a/(b-gcTemp) + c*exponential
+    widths = np.append([0], np.diff(gcTemp))
+    counted = background >= 0
+    if not counted[1:].any():
+        return np.where(background < 0, 0, background), None, None
+
+    weights = widths*counted
+    derivatives = np.array([
+        np.sum(weights/(b-gcTemp)),
+        np.sum(-weights*a/(b-gcTemp)**2),
+        np.sum(weights*exponential),
+        np.sum(weights*c*(gcTemp-300)*exponential),
+    ])
+    return np.where(background < 0, 0, background), np.sum(weights*background), np.sqrt(np.sum((derivatives*errors)**2))
+
+def _gcFitResults(results, gcTemp, gcPhotons, params, cov, t0):
+    """
+    Internal helper writing the fitted parameters, peak and background curves and photon counts of gcFit to results
+    """
     tcpu = round(1000*(time.time()-t0), 3)
 
     fitValues = params
     fitErrors = np.sqrt(np.diag(cov))
 
-    I_pred = fitmethod_kitis06(gcTemp, *params)
+    peakCurves = utils.ckitis2006(gcTemp, fitValues[0:4], fitValues[4:8], fitValues[8:12])
+    bg = utils.backgroundFunction(gcTemp, *fitValues[-4:])
+    I_pred = peakCurves.sum(axis=0) + np.where(bg<0,0,bg)
     results["gcfit_gcd"] = I_pred
     chiSquare = utils.calcRedChisq(gcPhotons,I_pred,np.sqrt(gcPhotons),len(gcPhotons)-len(params))
 
@@ -793,7 +1345,7 @@ def gcFit(x, y):
     #########################################################
     results["gcfit_cpuTime"] = tcpu
     results["gcfit_redChi2"] = chiSquare
-    Nsig =  0#unc.ufloat(0,0)
+    Nsig =  0
     
     for peak in range(4):
         results["gcfit_Tm%s"%(peak+2)] = fitValues[peak]
@@ -803,59 +1355,197 @@ def gcFit(x, y):
         results["gcfit_Im%s_std_dev"%(peak+2)] = fitErrors[peak+4]
 
         results["gcfit_E%s"%(peak+2)] = fitValues[peak+8]
-        results["gcfit_E%s_std_dev"%(peak+2)] = fitErrors[peak]+8
+        results["gcfit_E%s_std_dev"%(peak+2)] = fitErrors[peak+8]
         
-        peakI = utils.ckitis2006(gcTemp, fitValues[peak], fitValues[peak+4], fitValues[peak+8])
+        peakI = peakCurves[peak]
         results["gcfit_gcd_peak%s"%(peak+2)] = peakI
 
         N_peakI = peakI[1:]*np.diff(gcTemp)
         results["gcfit_N%s"%(peak+2)] = np.sum(N_peakI)
         Nsig += np.sum(N_peakI)
         
-        results["gcfit_Nsig"] = Nsig
-
-        uA = unc.ufloat(fitValues[-4], fitErrors[-4])
-        uB = unc.ufloat(fitValues[-3], fitErrors[-3])
-        uC = unc.ufloat(fitValues[-2], fitErrors[-2])
-        uD = unc.ufloat(fitValues[-1], fitErrors[-1])
-        uIbg = (uA/(uB-gcTemp)+uC * unp.exp((gcTemp-300)*uD))
-        uIbg = np.where(unp.nominal_values(uIbg) < 0,0,uIbg) 
-
-        # uNbg = (uA/(uB-gcTemp[1:])+uC * unp.exp((gcTemp[1:]-300)*uD))*np.diff(gcTemp)
-        # uNbg = np.where(unp.nominal_values(uNbg) < 0,0,uNbg) 
-        results["gcfit_gcd_bg"] = unp.nominal_values(uIbg)
-        uNbg = uIbg[1:]*np.diff(gcTemp)
-
-        results["gcfit_a"] = fitValues[-4]
-        results["gcfit_a_std_dev"] = fitErrors[-4]
-        results["gcfit_b"] = fitValues[-3]
-        results["gcfit_b_std_dev"] = fitErrors[-3]
-        results["gcfit_c"] = fitValues[-2]
-        results["gcfit_c_std_dev"] = fitErrors[-2]
-        results["gcfit_d"] = fitValues[-1]
-        results["gcfit_d_std_dev"] = fitErrors[-1]
-        
-        try:
-            results["gcfit_Nbg"] = np.sum(uNbg).nominal_value
-            results["gcfit_Nbg_std_dev"] = np.sum(uNbg).std_dev
-        
-            results["gcfit_Ntot"] = (Nsig+np.sum(uNbg)).nominal_value
-            results["gcfit_Ntot_std_dev"] = (Nsig+np.sum(uNbg)).std_dev
-
-        except AttributeError:
-            results["gcfit_Nbg"] = -1
-            results["gcfit_Nbg_std_dev"] = -1
-            results["gcfit_Ntot"] = -1
-            results["gcfit_Ntot_std_dev"] = -1
+    results["gcfit_Nsig"] = Nsig
+
+    Ibg, Nbg, Nbg_std_dev = _backgroundCounts(gcTemp, fitValues[-4:], fitErrors[-4:])
+    results["gcfit_gcd_bg"] = Ibg
+
+    results["gcfit_a"] = fitValues[-4]
+    results["gcfit_a_std_dev"] = fitErrors[-4]
+    results["gcfit_b"] = fitValues[-3]
+    results["gcfit_b_std_dev"] = fitErrors[-3]
+    results["gcfit_c"] = fitValues[-2]
+    results["gcfit_c_std_dev"] = fitErrors[-2]
+    results["gcfit_d"] = fitValues[-1]
+    results["gcfit_d_std_dev"] = fitErrors[-1]
+    
+    if Nbg is not None:
+        results["gcfit_Nbg"] = Nbg
+        results["gcfit_Nbg_std_dev"] = Nbg_std_dev
+        results["gcfit_Ntot"] = Nsig+Nbg
+        results["gcfit_Ntot_std_dev"] = Nbg_std_dev
+    else:
+        results["gcfit_Nbg"] = -1
+        results["gcfit_Nbg_std_dev"] = -1
+        results["gcfit_Ntot"] = -1
+        results["gcfit_Ntot_std_dev"] = -1
 
     return results
 
 class gcFitWrapper(object):
-    def __init__(self, x, y):
+    def __init__(self, x, y, cache=None, stages=None, mode='full', reference=None, templates=None):
+        self.x = x
+        self.y = y
+        self.cache = cache
+        self.stages = stages
+        self.mode = mode
+        self.reference = reference
+        self.templates = templates
+    def __call__(self, data):
+        return data.update(gcFit(data[self.x], data[self.y], cache=self.cache, cacheKey=gccache.fitKey(data) if self.cache is not None else None, stages=self.stages, mode=self.mode, reference=self.reference, templates=self.templates))
+
+
+# stages of the analysis pipeline in the order they are run
+pipelineStages = ['calcGCparams', 'calcTreco', 'gcFit']
+
+# versions of the pipeline stages, increased when a change alters the results so the result cache is not reused
+pipelineStageVersions = {'calcGCparams': 1, 'calcTreco': 1, 'gcFit': 2}
+
+class Pipeline(object):
+    """
+    Analysis pipeline running calcGCparams, calcTreco and gcFit for each glow curve in a single pass. The RoI search is
+    shared by calcGCparams and calcTreco and gcFit is run on the reconstructed temperature grid in memory, only the
+    requested outputs are written back.
+
+    Example
+    ---------
+    Full reconstruction of a data base keeping only the fitted photon counts
+        >>> pipeline = gcana.Pipeline(peaks=3, outputs=['gc_*', 'Treco_T0', 'gcfit_N*'])
+        >>> pipeline.apply(db)
+    Full reconstruction of a DataFrame, a new DataFrame with the result columns is returned
+        >>> df = pipeline.apply(pd.DataFrame(db.all()))
+
+    Parameters
+    ---------
+    stages
+        list of strings (default=pipelineStages). Stages to be run, out of 'calcGCparams', 'calcTreco' and 'gcFit'. If gcFit is run without calcTreco, the stored 'Treco_T' and 'Treco_PhCount' are used
+    x
+        string (default='time_sec'). Time axis of the glow curves
+    y
+        string (default='PhCount'). Photon counts of the glow curves
+    peaks
+        integer (default=3). Number of peaks of the temperature reconstruction, see calcTreco
+    outputs
+        None (default) or list of strings. Result keys written back, shell-style wildcards like 'gcfit_*' are supported. All results are written back if None
+    cache
+        None (default) or gccache.FitCache. Used to warm start calcTreco and gcFit, it is not updated if the pipeline runs in worker processes
+    fitStages
+        None (default) or list of fit stages of gcFit, see gcFitStages
+    resultCache
+        None (default) or gccache.ResultCache. If passed, stages whose input arrays and settings did not change are not computed again
+    """
+
+    def __init__(self, stages=pipelineStages, x='time_sec', y='PhCount', peaks=3, outputs=None, cache=None, fitStages=None, resultCache=None):
+        for stage in stages:
+            if stage not in pipelineStages:
+                raise AttributeError("Invalid pipeline stage: ", stage)
+        _checkFitStages(fitStages)
+        self.stages = [stage for stage in pipelineStages if stage in stages]
         self.x = x
         self.y = y
+        self.peaks = peaks
+        self.outputs = outputs
+        self.cache = cache
+        self.fitStages = fitStages
+        self.resultCache = resultCache
+
     def __call__(self, data):
-        return data.update(gcFit(data[self.x], data[self.y]))
+        return data.update(self.run(data))
+
+    def arrays(self):
+        """
+        Returns the array fields read by the pipeline, e.g. to be passed to gcbatch.BatchEngine.update
+        """
+        if 'calcTreco' not in self.stages and 'gcFit' in self.stages:
+            return [self.x, self.y, 'Treco_T', 'Treco_PhCount']
+        return [self.x, self.y]
+
+    def run(self, doc):
+        """
+        Runs the stages on a single document and returns the requested results as dict
+        """
+        results = {}
+        cacheKey = gccache.fitKey(doc) if self.cache is not None else None
+
+        if 'calcGCparams' in self.stages or 'calcTreco' in self.stages:
+            x = np.array(doc[self.x])
+            y = np.array(doc[self.y])
+            rois = []
+            def roi(iteration):
+                # calcTreco uses the initial RoI, calcGCparams the RoI after two refinements, both share one search
+                if not rois:
+                    rois.extend({"RoI_low": int(low[0]), "RoI_high": int(high[0])} for low, high in _roiIterations(x, y[np.newaxis, :], 2))
+                return rois[iteration]
+            if 'calcGCparams' in self.stages:
+                results.update(self._cached('calcGCparams', [x, y], {}, lambda: calcGCparams(x, y, roi=roi(2))))
+            if 'calcTreco' in self.stages:
+                results.update(self._cached('calcTreco', [x, y], {'peaks': self.peaks, 'warmStart': self.cache is not None}, lambda: calcTreco(x, y, self.peaks, cache=self.cache, cacheKey=cacheKey, roi=roi(0))))
+
+        if 'gcFit' in self.stages:
+            treco = results if 'calcTreco' in self.stages else doc
+            if treco.get('Treco_T') is not None and treco.get('Treco_PhCount') is not None:
+                fitStages = gcFitStages if self.fitStages is None else self.fitStages
+                results.update(self._cached('gcFit', [treco['Treco_T'], treco['Treco_PhCount']], {'stages': fitStages, 'warmStart': self.cache is not None}, lambda: gcFit(treco['Treco_T'], treco['Treco_PhCount'], cache=self.cache, cacheKey=cacheKey, stages=self.fitStages)))
+            else:
+                results["gcfit_error"] = True
+
+        if self.outputs is None:
+            return results
+        return {key: value for key, value in results.items() if any(fnmatch.fnmatchcase(key, output) for output in self.outputs)}
+
+    def _cached(self, stage, arrays, params, compute):
+        """
+        Internal helper returning the results of a stage from the result cache, computing and storing them if missing
+        """
+        if self.resultCache is None:
+            return compute()
+        # the settings include whether the fits are warm started from a fit cache, which changes their results
+        key = gccache.resultKey(stage, arrays, params, pipelineStageVersions[stage])
+        results = self.resultCache.get(key)
+        if results is None:
+            results = compute()
+            self.resultCache.put(key, results)
+        return results
+
+    def apply(self, data, engine=None):
+        """
+        Runs the pipeline on all glow curves of data.
+
+        Parameters
+        ---------
+        data
+            data base, list of documents, single document or DataFrame
+        engine
+            None (default) or gcbatch.BatchEngine. If passed, the glow curves of a data base or list are processed by its workers
+
+        Returns
+        ---------
+        A new DataFrame with the result columns for DataFrames, the updated documents for documents and lists of documents. Data bases are updated in place and None is returned
+        """
+        if isinstance(data, pd.DataFrame):
+            results = pd.DataFrame([self.run(row) for row in data.to_dict('records')], index=data.index)
+            return data.assign(**results)
+        if engine is not None:
+            return engine.update(data, self, arrays=self.arrays())
+        if isinstance(data, dict):
+            data.update(self.run(data))
+            return data
+        if isinstance(data, list):
+            for doc in data:
+                doc.update(self.run(doc))
+            return data
+
+        changes = {doc.doc_id: self.run(doc) for doc in data.all()}
+        data.process_elements(lambda stored, doc_id: stored[doc_id].update(changes[doc_id]), doc_ids=list(changes))
 
 
 if __name__ == "__main__":
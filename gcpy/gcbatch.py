@@ -0,0 +1,317 @@
+"""
+    GCpy module for the parallel batch analysis of glow curve data bases.
+    Author: Florian Mentzel (florian.mentzel@tu-dortmund.de)
+    Creation: 2026/10/18
+"""
+
+# parallel processing with a persistent pool of workers
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+
+# serialisation of the document metadata
+import pickle
+import functools
+
+import numpy as np
+
+# alignment of the arrays in the shared buffer in bytes
+sharedAlignment = 64
+
+# shared memory of the job currently attached by a worker process
+_workerJob = {'name': None, 'blocks': [], 'meta': None, 'buffer': None}
+
+# barrier of the worker processes of a pool, see _releaseWorker
+_workerBarrier = None
+
+
+def _numericArray(value):
+    """
+    Internal helper returning value as 1D numerical array or None if it cannot be shared
+    """
+    if not isinstance(value, (list, np.ndarray)):
+        return None
+    array = np.asarray(value)
+    if array.ndim != 1 or array.dtype.kind not in 'biuf':
+        return None
+    return array
+
+
+def _packDocuments(docs, arrays=None):
+    """
+    Internal helper splitting documents into numerical 1D arrays, which are packed into one shared buffer, and the
+    remaining fields. Returns the arrays per field, their layout in the buffer, the buffer size and the remaining
+    fields of each document.
+    """
+    candidates = {}
+    rejected = set()
+    for pos, doc in enumerate(docs):
+        for key, value in doc.items():
+            if arrays is not None and key not in arrays:
+                continue
+            if key in rejected:
+                continue
+            array = _numericArray(value)
+            if array is None:
+                if isinstance(value, (list, np.ndarray)):
+                    rejected.add(key)
+                continue
+            candidates.setdefault(key, {})[pos] = array
+    for key in rejected:
+        candidates.pop(key, None)
+    # fields which are arrays in some and scalars in other documents stay with the metadata
+    for key in list(candidates):
+        if any(key in doc and pos not in candidates[key] for pos, doc in enumerate(docs)):
+            del candidates[key]
+
+    layout = {}
+    size = 0
+    for key, values in candidates.items():
+        dtype = functools.reduce(np.promote_types, set(array.dtype for array in values.values()))
+        # offsets of the documents in the field, -1 marks documents without the field
+        lengths = np.full(len(docs), -1, dtype=np.int64)
+        for pos, array in values.items():
+            lengths[pos] = len(array)
+        offsets = np.concatenate(([0], np.cumsum(np.maximum(lengths, 0))))
+        layout[key] = {'start': size, 'dtype': dtype.str, 'offsets': offsets, 'present': lengths >= 0}
+        size += -(-int(offsets[-1])*dtype.itemsize // sharedAlignment)*sharedAlignment
+
+    others = [{key: value for key, value in doc.items() if key not in candidates and (arrays is None or key in arrays or not isinstance(value, (list, np.ndarray)))} for doc in docs]
+    return candidates, layout, size, others
+
+
+def _attachBlock(name):
+    """
+    Internal helper attaching a worker process to a shared memory block. The block is owned and unlinked by the
+    engine, so it is not registered with the resource tracker. A tracker of the worker would report it as leaked,
+    unregistering it from a tracker shared with the engine would drop the registration of the engine.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    # Python < 3.13 registers attached blocks as well, the workers attach blocks one at a time
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def _attachJob(name):
+    """
+    Internal helper attaching a worker process to the shared memory of a job, the previous job is released
+    """
+    if _workerJob['name'] == name:
+        return _workerJob
+    _releaseJob()
+    metaBlock = _attachBlock(name)
+    meta = pickle.loads(metaBlock.buf)
+    dataBlock = _attachBlock(meta['data'])
+    _workerJob.update({'name': name, 'blocks': [metaBlock, dataBlock], 'meta': meta, 'buffer': dataBlock.buf})
+    return _workerJob
+
+
+def _releaseJob():
+    """
+    Internal helper closing the shared memory attached by a worker process
+    """
+    _workerJob['buffer'] = None
+    _workerJob['meta'] = None
+    for block in _workerJob['blocks']:
+        try:
+            block.close()
+        except BufferError:
+            pass
+    _workerJob.update({'name': None, 'blocks': []})
+
+
+def _initWorker(barrier):
+    """
+    Internal helper initialising a worker process with the barrier shared by the workers of the pool
+    """
+    global _workerBarrier
+    _workerBarrier = barrier
+
+
+def _releaseWorker(_):
+    """
+    Internal task releasing the shared memory of the last job. The workers wait for each other at the barrier, so each
+    worker of the pool runs exactly one of njobs release tasks.
+    """
+    _releaseJob()
+    _workerBarrier.wait()
+
+
+def _buildDocument(job, pos):
+    """
+    Internal helper assembling a document from its metadata and read-only views of the shared arrays
+    """
+    meta = job['meta']
+    doc = dict(meta['others'][pos])
+    for key, field in meta['layout'].items():
+        if not field['present'][pos]:
+            continue
+        dtype = np.dtype(field['dtype'])
+        start, end = field['offsets'][pos], field['offsets'][pos+1]
+        array = np.frombuffer(job['buffer'], dtype=dtype, count=end-start, offset=field['start']+start*dtype.itemsize)
+        # in-place changes would go to the shared memory and not be sent back
+        array.flags.writeable = False
+        doc[key] = array
+    return doc
+
+
+def _runChunk(task):
+    """
+    Internal worker function applying the job function to a chunk of documents. Only the fields added or replaced
+    by the function are sent back.
+    """
+    name, positions = task
+    job = _attachJob(name)
+    func = job['meta']['func']
+    results = []
+    for pos in positions:
+        doc = _buildDocument(job, pos)
+        before = dict(doc)
+        func(doc)
+        results.append((pos, {key: value for key, value in doc.items() if key not in before or value is not before[key]}))
+        doc = before = None
+    return results
+
+
+class BatchEngine(object):
+    """
+    Persistent pool of worker processes applying analysis functions to many glow curves. The numerical arrays of the
+    documents are placed in shared memory once per job, the workers receive chunks of document positions and return
+    only the fields added by the function, which are written back to the data base in one go.
+
+    Example
+    ---------
+    Fitting all glow curves of a data base
+        >>> with gcbatch.BatchEngine(njobs=8) as engine:
+        >>>     engine.update(db, gcana.calcTreco('time_sec', 'PhCount'), arrays=['time_sec', 'PhCount'])
+        >>>     engine.update(db, gcana.gcFit('Treco_T', 'Treco_PhCount'), arrays=['Treco_T', 'Treco_PhCount'])
+
+    Parameters
+    ---------
+    njobs
+        integer (default=-1). If -1, all available processors but one are used, otherwise the specified number of workers is launched
+    chunkSize
+        integer or None (default). Number of documents per task, by default the documents are split into four tasks per worker
+    """
+
+    def __init__(self, njobs=-1, chunkSize=None):
+        self.njobs = njobs if njobs != -1 else max(1, multiprocessing.cpu_count()-1)
+        if self.njobs < 1:
+            raise AttributeError("Invalid number of workers: ", njobs)
+        self.chunkSize = chunkSize
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _getPool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(processes=self.njobs, initializer=_initWorker, initargs=(multiprocessing.Barrier(self.njobs),))
+        return self._pool
+
+    def close(self):
+        """
+        Stops the worker processes, the engine starts new ones if it is used again
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def map(self, docs, func, arrays=None):
+        """
+        Applies func to copies of the documents in the worker processes.
+
+        Parameters
+        ---------
+        docs
+            list of documents
+        func
+            picklable function updating a document in place, e.g. the callables returned by the gcana functions. The
+            numerical arrays are passed as read-only numpy arrays. A gccache.FitCache held by func is copied to the
+            workers and not updated, see gccache.FitCache
+        arrays
+            list of field names or None (default). If given, only these array fields are sent to the workers, the
+            scalar fields are always sent
+
+        Returns
+        ---------
+        list of dictionaries with the fields added or replaced by func, in the order of docs
+        """
+        results = [None]*len(docs)
+        if len(docs) == 0:
+            return results
+
+        # the workers are started first, forked workers would inherit the mapping of the shared memory
+        pool = self._getPool()
+        candidates, layout, size, others = _packDocuments(docs, arrays)
+        dataBlock = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        metaBlock = None
+        try:
+            for key, values in candidates.items():
+                field = layout[key]
+                dtype = np.dtype(field['dtype'])
+                shared = np.ndarray(int(field['offsets'][-1]), dtype=dtype, buffer=dataBlock.buf, offset=field['start'])
+                for pos, array in values.items():
+                    shared[field['offsets'][pos]:field['offsets'][pos+1]] = array
+                shared = None
+            candidates = None
+
+            meta = pickle.dumps({'data': dataBlock.name, 'layout': layout, 'others': others, 'func': func}, protocol=pickle.HIGHEST_PROTOCOL)
+            metaBlock = shared_memory.SharedMemory(create=True, size=len(meta))
+            metaBlock.buf[:len(meta)] = meta
+            meta = None
+
+            chunkSize = self.chunkSize if self.chunkSize is not None else max(1, -(-len(docs) // (4*self.njobs)))
+            tasks = [(metaBlock.name, range(start, min(start+chunkSize, len(docs)))) for start in range(0, len(docs), chunkSize)]
+            for chunk in pool.imap_unordered(_runChunk, tasks):
+                for pos, changes in chunk:
+                    results[pos] = changes
+        finally:
+            # the workers close their mappings, otherwise the unlinked memory of the last job stays allocated
+            if metaBlock is not None:
+                pool.map(_releaseWorker, range(self.njobs), chunksize=1)
+            for block in (dataBlock, metaBlock):
+                if block is not None:
+                    block.close()
+                    block.unlink()
+        return results
+
+    def update(self, data, func, arrays=None):
+        """
+        Use a function to update given data in the worker processes
+
+        Parameters
+        ---------
+        data
+            data base, table, list of documents or single document
+        func
+            function to be applied, see map
+        arrays
+            list of field names or None (default). If given, only these array fields are sent to the workers
+
+        Returns
+        ---------
+        The updated document or list of documents, data bases are updated in place and None is returned
+        """
+        if isinstance(data, dict):
+            data.update(self.map([data], func, arrays)[0])
+            return data
+        if isinstance(data, list):
+            for doc, changes in zip(data, self.map(data, func, arrays)):
+                doc.update(changes)
+            return data
+
+        docs = data.all()
+        changes = {doc.doc_id: result for doc, result in zip(docs, self.map(docs, func, arrays))}
+        docs = None
+        data.process_elements(lambda stored, doc_id: stored[doc_id].update(changes[doc_id]), doc_ids=list(changes))
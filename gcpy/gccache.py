@@ -0,0 +1,306 @@
+"""
+    GCpy module for caching analysis results.
+    Author: Florian Mentzel (florian.mentzel@tu-dortmund.de)
+    Creation: 2026/10/18
+"""
+
+import os
+import json
+from collections import OrderedDict
+
+# content hashes and storage of the analysis results
+import hashlib
+import pickle
+
+import numpy as np
+
+from . import __version__
+
+# suffix of the fit cache file stored beside a data base
+fitCacheSuffix = ".fitcache.json"
+
+# suffix of the result cache directory stored beside a data base and extension of its entries
+resultCacheSuffix = ".results"
+resultExtension = ".pkl"
+
+def fitCachePath(store):
+    """
+    Returns the path of the fit cache belonging to a data base file or directory
+    """
+    return store.rstrip(os.sep) + fitCacheSuffix
+
+def resultCachePath(store):
+    """
+    Returns the path of the result cache directory belonging to a data base file or directory
+    """
+    return store.rstrip(os.sep) + resultCacheSuffix
+
+def resultKey(stage, arrays, params={}, version=None):
+    """
+    Returns the result cache key of an analysis stage: the stage name and a hash of the input arrays, the stage
+    parameters and the versions of gcpy and the stage, so results of older code are not reused
+
+    Parameters
+    ---------
+    stage
+        string. Name of the analysis stage
+    arrays
+        list of array-like. Inputs of the stage, their values, data types and shapes enter the hash
+    params
+        dict (default={}). Settings of the stage, have to be JSON serialisable (other values are converted to strings)
+    version
+        None (default) or integer. Version of the stage, see gcana.pipelineStageVersions
+    """
+    digest = hashlib.sha1(("%s %s %s"%(stage, __version__, version)).encode())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(("%s%s"%(array.dtype.str, array.shape)).encode())
+        digest.update(array.data)
+    return stage + "_" + digest.hexdigest()
+
+def fitKey(doc):
+    """
+    Returns the fit cache key of a document: the detector name and all readoutConfig_* settings.
+    None is returned for documents without detector name.
+    """
+    if 'det_name' not in doc or doc['det_name'] is None:
+        return None
+    config = sorted((key, str(doc[key])) for key in doc.keys() if str(key).startswith('readoutConfig_'))
+    return json.dumps([str(doc['det_name']), config])
+
+
+class FitCache(object):
+    """
+    Cache of the last converged fit parameters per detector and readout configuration, used to seed the start values
+    of calcTreco and gcFit. The least recently used entries are evicted beyond maxsize entries.
+    The cache is only updated by fits run in the calling process, e.g. by db.update. Functions sent to worker processes
+    by gcana.update or gcbatch.BatchEngine receive a copy: they are warm started from the entries present when the job
+    starts, but their converged parameters are not written back.
+
+    Example
+    ---------
+    Warm started fits with the cache stored beside the data base
+        >>> with gccache.FitCache(gccache.fitCachePath("glowcurves.gcdb")) as cache:
+        >>>     db.update(gcana.calcTreco('time_sec', 'PhCount', cache=cache))
+        >>>     db.update(gcana.gcFit('Treco_T', 'Treco_PhCount', cache=cache))
+
+    Parameters
+    ---------
+    path
+        string or None (default). JSON file the cache is loaded from and saved to
+    maxsize
+        integer (default=1000). Maximum number of cached detector configurations
+    """
+
+    def __init__(self, path=None, maxsize=1000):
+        self.path = path
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.save()
+
+    def get(self, key, stage):
+        """
+        Returns the cached parameters and the curve scale of a stage as tuple or None
+        """
+        if key is None or key not in self._entries or stage not in self._entries[key]:
+            return None
+        self._entries.move_to_end(key)
+        entry = self._entries[key][stage]
+        return np.array(entry['params']), entry['scale']
+
+    def put(self, key, stage, params, scale=1.):
+        """
+        Stores the converged parameters of a stage together with the scale of the fitted curve
+        """
+        if key is None:
+            return
+        self._entries.setdefault(key, {})[stage] = {'params': [float(value) for value in params], 'scale': float(scale)}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def load(self, path=None):
+        path = self.path if path is None else path
+        with open(path, 'r') as cacheFile:
+            self._entries = OrderedDict(json.load(cacheFile))
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def save(self, path=None):
+        path = self.path if path is None else path
+        if path is None:
+            return
+        with open(path + ".tmp", 'w') as cacheFile:
+            json.dump(list(self._entries.items()), cacheFile)
+        os.replace(path + ".tmp", path)
+
+
+def warmStart(cache, key, stage, p0, bounds, scale, amplitudes=None):
+    """
+    Returns the start values of a fit seeded from the cache, the amplitude parameters are rescaled to the curve scale
+    and the values are clipped to the bounds. Parameters which converged to a bound carry no information and
+    slow down the trust region steps, they start from p0 instead. None is returned if there is no entry matching p0.
+    """
+    cached = cache.get(key, stage) if cache is not None else None
+    if cached is None or len(cached[0]) != len(p0):
+        return None
+    params, cachedScale = cached
+    lower, upper = np.asarray(bounds[0], dtype=float), np.asarray(bounds[1], dtype=float)
+    atBound = np.isclose(params, lower, rtol=1e-6, atol=1e-12) | np.isclose(params, upper, rtol=1e-6, atol=1e-12)
+    if amplitudes is not None and cachedScale > 0 and scale > 0:
+        params[amplitudes] *= scale/cachedScale
+    params = np.where(atBound, p0, params)
+    return np.clip(params, lower, upper)
+
+
+class ResultCache(object):
+    """
+    Content-addressed cache of the result dicts of the analysis stages, see resultKey. The entries are stored as files
+    in a directory or, without path, in memory. The least recently used entries are evicted beyond maxBytes.
+
+    Example
+    ---------
+    Rerunning an analysis only computes the stages whose inputs or settings changed
+        >>> cache = gccache.ResultCache(gccache.resultCachePath("glowcurves.gcdb"))
+        >>> gcana.Pipeline(peaks=3, resultCache=cache).apply(db)
+
+    Parameters
+    ---------
+    path
+        string or None (default). Directory of the cache entries, created if needed
+    maxBytes
+        integer (default=2**30). Maximum size of all entries in bytes
+    """
+
+    def __init__(self, path=None, maxBytes=2**30):
+        self.path = path
+        self.maxBytes = maxBytes
+        self._entries = OrderedDict()
+        self._size = 0
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            self._size = sum(size for _, size, _ in self._scan())
+
+    def __len__(self):
+        if self.path is None:
+            return len(self._entries)
+        return len(self._scan())
+
+    def __contains__(self, key):
+        if self.path is None:
+            return key in self._entries
+        return os.path.exists(self._file(key))
+
+    def _file(self, key):
+        return os.path.join(self.path, key + resultExtension)
+
+    def _scan(self):
+        """
+        Returns name, size and modification time of all entries on disk
+        """
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(resultExtension):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((entry.name, stat.st_size, stat.st_mtime))
+        return entries
+
+    def get(self, key):
+        """
+        Returns the cached results or None
+        """
+        if self.path is None:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return pickle.loads(self._entries[key])
+        try:
+            with open(self._file(key), 'rb') as entryFile:
+                results = pickle.load(entryFile)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        # the modification time marks the last use for the eviction
+        try:
+            os.utime(self._file(key))
+        except FileNotFoundError:
+            pass
+        return results
+
+    def put(self, key, results):
+        """
+        Stores the results of a stage
+        """
+        data = pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL)
+        if self.path is None:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = data
+            self._size += len(data)
+            while self._size > self.maxBytes and self._entries:
+                self._size -= len(self._entries.popitem(last=False)[1])
+            return
+
+        tmpFile = self._file(key) + ".%s.tmp"%os.getpid()
+        with open(tmpFile, 'wb') as entryFile:
+            entryFile.write(data)
+        try:
+            self._size -= os.stat(self._file(key)).st_size
+        except FileNotFoundError:
+            pass
+        os.replace(tmpFile, self._file(key))
+        self._size += len(data)
+        if self._size > self.maxBytes:
+            self._evict()
+
+    def _evict(self):
+        """
+        Removes the least recently used entries on disk until the cache is filled to 90%, the directory is scanned as
+        other processes may share it
+        """
+        entries = sorted(self._scan(), key=lambda entry: entry[2])
+        self._size = sum(size for _, size, _ in entries)
+        for name, size, _ in entries:
+            if self._size <= 0.9*self.maxBytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+    def clear(self, stage=None):
+        """
+        Removes all entries or only those of a stage, e.g. after the code of the stage changed
+        """
+        prefix = "" if stage is None else stage + "_"
+        if self.path is None:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                self._size -= len(self._entries.pop(key))
+            return
+        for name, _, _ in self._scan():
+            if name.startswith(prefix):
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    pass
+        self._size = sum(size for _, size, _ in self._scan())
@@ -14,16 +14,414 @@ import ujson as json
 # os operations like file lists
 import os
 
+# parallel file import
+import multiprocessing
+
+# content hashes for the incremental import
+import hashlib
+
 # tiny db content for data storage
 from tinydb import TinyDB
+from tinydb.database import Table, Document
 from tinydb.storages import MemoryStorage
 
 # compression tools for saving disk space
-import pickle, gzip, bz2
+import pickle, gzip, bz2, lzma, zlib, struct, shutil
+
+# typed array buffers for the columnar storage
+import numpy as np
 
 # import for prototypeII support
 import pandas as pd
-import io
+import io, functools, warnings
+
+# file extension, file names and version of the columnar storage layout
+columnarExtension = ".gcdb"
+columnarMeta = "meta.json"
+columnarFormat = "gcpy-columnar"
+columnarVersion = 2
+
+# magic bytes and version of the chunked stream format of compressed data bases
+streamMagic = b"GCPYDB"
+streamVersion = 1
+
+# table of the data base keeping track of the imported files
+manifestTable = "_manifest"
+
+# indexed document fields, the first available date field is indexed
+indexFields = ['det_name', 'meas_tag']
+indexDateFields = ['meas_dateTime', 'meas_date']
+# table of the data base keeping the stored indexes
+indexTable = "_index"
+
+
+class ColumnarStorage(MemoryStorage):
+    """
+    TinyDB storage for large glow curve data bases. The documents are handled in memory like in the MemoryStorage,
+    on disk the data is kept in a columnar layout: the scalar entries of all documents are stored in one table while
+    the array entries (e.g. 'PhCount', 'time_sec') are stored as contiguous typed numpy buffers, one per column and
+    data type. The arrays are loaded as numpy arrays of their original data type.
+
+    The data is written to disk when the data base is closed or passed to store(), readFiles and readDir write it
+    at the end of the import.
+
+    Parameters
+    ---------
+    path
+        Directory of the columnar data base. If it exists, its content is loaded.
+    mmap
+        Boolean (default: False). If True, the array buffers are memory-mapped instead of read. The arrays of the documents are
+        then lazy views which are only read from disk when they are accessed (copy-on-write, changes are not written to the buffer files).
+    """
+
+    def __init__(self, path, mmap=False):
+        super(ColumnarStorage, self).__init__()
+        self.path = path
+        self.changed = False
+        if os.path.isdir(path):
+            self.memory = _readColumnar(path, mmap)
+
+    def write(self, data):
+        self.memory = data
+        self.changed = True
+
+    def close(self):
+        if self.changed and self.memory is not None:
+            _writeColumnar(self.memory, self.path)
+            self.changed = False
+
+
+def _toNanoseconds(dates):
+    """
+    Internal helper converting a list of date strings to integer nanoseconds, invalid dates are NaT
+    """
+    try:
+        return np.array(dates, dtype='datetime64[ns]').astype(np.int64)
+    except (ValueError, TypeError):
+        return pd.to_datetime(pd.Series(dates), errors='coerce').values.astype('datetime64[ns]').astype(np.int64)
+
+class DocumentIndex(object):
+    """
+    Secondary indexes of a table: a mapping from value to document ids for the indexFields and the sorted
+    measurement dates (first available of indexDateFields) for range queries.
+    """
+
+    def __init__(self):
+        self.values = {field: {} for field in indexFields}
+        self.dates = {}
+        self._sorted = None
+
+    def add(self, docIds, docs):
+        dates = []
+        dateIds = []
+        for docId, doc in zip(docIds, docs):
+            for field in indexFields:
+                value = doc.get(field)
+                if isinstance(value, (str, int, float)):
+                    self.values[field].setdefault(value, set()).add(docId)
+            for field in indexDateFields:
+                if doc.get(field) is not None:
+                    dates.append(doc[field])
+                    dateIds.append(docId)
+                    break
+        if dates:
+            for docId, date in zip(dateIds, _toNanoseconds(dates).tolist()):
+                if date != np.iinfo(np.int64).min:
+                    self.dates[docId] = date
+            self._sorted = None
+
+    def lookup(self, det_name=None, meas_tag=None, start=None, end=None):
+        """
+        Returns the sorted document ids matching all passed conditions, the date range is [start, end)
+        """
+        candidates = None
+        for field, values in zip(indexFields, [det_name, meas_tag]):
+            if values is None:
+                continue
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            ids = set()
+            for value in values:
+                ids |= self.values[field].get(value, set())
+            candidates = ids if candidates is None else candidates & ids
+
+        if start is None and end is None:
+            return sorted(candidates) if candidates is not None else None
+
+        start = np.iinfo(np.int64).min if start is None else pd.Timestamp(start).value
+        end = np.iinfo(np.int64).max if end is None else pd.Timestamp(end).value
+        if candidates is not None:
+            return sorted(docId for docId in candidates if docId in self.dates and start <= self.dates[docId] < end)
+
+        if self._sorted is None:
+            ids = np.fromiter(self.dates.keys(), dtype=np.int64, count=len(self.dates))
+            dates = np.fromiter(self.dates.values(), dtype=np.int64, count=len(self.dates))
+            order = np.argsort(dates, kind='stable')
+            self._sorted = (dates[order], ids[order])
+        dates, ids = self._sorted
+        return sorted(ids[np.searchsorted(dates, start, 'left'):np.searchsorted(dates, end, 'left')].tolist())
+
+    def toRecord(self):
+        return {
+            'values': {field: [[value, sorted(ids)] for value, ids in values.items()] for field, values in self.values.items()},
+            'dates': [[docId, date] for docId, date in self.dates.items()],
+        }
+
+    @classmethod
+    def fromRecord(cls, record):
+        index = cls()
+        for field in indexFields:
+            index.values[field] = {value: set(ids) for value, ids in record['values'].get(field, [])}
+        index.dates = {docId: date for docId, date in record['dates']}
+        return index
+
+
+class IndexedTable(Table):
+    """
+    TinyDB table keeping secondary indexes on the detector name, the measurement tag and the measurement date
+    of its documents (see DocumentIndex). The indexes are updated on insert, rebuilt after other changes when they
+    are needed and saved by store(). Use lookup() for indexed queries.
+    """
+
+    def __init__(self, storage, name, **kwargs):
+        self._index = None
+        self._indexing = False
+        self._docs = None
+        self._record = None
+        super(IndexedTable, self).__init__(storage, name, **kwargs)
+
+    def _rawDocs(self):
+        # the documents are read once and kept until the table is written
+        if self._docs is None:
+            raw = self._storage._storage.read() or {}
+            self._docs = raw.get(self.name, {})
+            records = [record for record in (raw.get(indexTable) or {}).values() if record.get('table') == self.name]
+            self._record = records[0] if records else None
+        return self._docs
+
+    def _write(self, values):
+        super(IndexedTable, self)._write(values)
+        self._docs = dict(values)
+        if not self._indexing:
+            self._index = None
+        self._dropStoredIndex()
+
+    def _dropStoredIndex(self):
+        # a stored index is outdated after the documents changed
+        if self._record is None:
+            return
+        self._record = None
+        raw = self._storage._storage.read() or {}
+        records = raw.get(indexTable) or {}
+        for key in [key for key, record in records.items() if record.get('table') == self.name]:
+            del records[key]
+        self._storage._storage.write(raw)
+
+    def _getIndex(self):
+        if self._index is None:
+            docs = self._rawDocs()
+            lastId = max([int(docId) for docId in docs]) if docs else 0
+            record = self._record
+            if record is not None and record.get('count') == len(docs) and record.get('last_id') == lastId:
+                self._index = DocumentIndex.fromRecord(record)
+                return self._index
+            self._index = DocumentIndex()
+            self._index.add([int(docId) for docId in docs], docs.values())
+        return self._index
+
+    def insert(self, document):
+        return self.insert_multiple([document])[0]
+
+    def insert_multiple(self, documents):
+        documents = list(documents)
+        self._indexing = True
+        try:
+            docIds = super(IndexedTable, self).insert_multiple(documents)
+        finally:
+            self._indexing = False
+        if self._index is not None:
+            self._index.add(docIds, documents)
+        return docIds
+
+    def lookup(self, det_name=None, meas_tag=None, start=None, end=None):
+        """
+        Indexed query of the documents.
+
+        Example
+        ---------
+        All readouts of a detector in April 2019
+            >>> db.lookup(det_name='R19405', start='2019-04-01', end='2019-05-01')
+
+        Parameters
+        ---------
+        det_name
+            string, list of strings or None (default). Detector name(s) of the documents
+        meas_tag
+            string, list of strings or None (default). Measurement tag(s) of the documents
+        start
+            date string, datetime or None (default). Documents measured at or after this date ('meas_dateTime' or 'meas_date')
+        end
+            date string, datetime or None (default). Documents measured before this date
+
+        Returns
+        ---------
+        docs
+            list of matching documents, all documents if no condition is passed
+        """
+        docIds = self._getIndex().lookup(det_name, meas_tag, start, end)
+        docs = self._rawDocs()
+        if docIds is None:
+            return [Document(doc, int(docId)) for docId, doc in docs.items()]
+        results = []
+        for docId in docIds:
+            doc = docs.get(docId, docs.get(str(docId)))
+            if doc is not None:
+                results.append(Document(doc, docId))
+        return results
+
+    def indexRecord(self):
+        """
+        Returns the index of the table as a storable document
+        """
+        docs = self._rawDocs()
+        record = self._getIndex().toRecord()
+        record.update({'table': self.name, 'count': len(docs), 'last_id': max([int(docId) for docId in docs]) if docs else 0})
+        return record
+
+
+def _indexedData(db):
+    """
+    Internal helper returning the content of a data base with the indexes of its tables in the index table. The data
+    base itself is not changed.
+    """
+    records = [db.table(name).indexRecord() for name in db.tables() if name not in [indexTable, manifestTable] and isinstance(db.table(name), IndexedTable)]
+    data = dict(db.storage.read() or {})
+    data[indexTable] = {i+1: record for i, record in enumerate(records)}
+    return data
+
+
+def _isColumnar(path):
+    """
+    Internal helper to check whether a path refers to a columnar data base
+    """
+    return path.rstrip(os.sep).endswith(columnarExtension) or os.path.isfile(os.path.join(path, columnarMeta))
+
+def _isArrayCandidate(value):
+    """
+    Internal helper to check whether a document entry is a candidate for the array columns
+    """
+    if isinstance(value, np.ndarray):
+        return value.ndim == 1
+    return isinstance(value, list) and len(value) > 0 and isinstance(value[0], (int, float)) and not isinstance(value[0], bool)
+
+def _toBuiltin(value):
+    """
+    Internal helper to convert numpy types to python types for the scalar table
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value
+
+def _writeColumnar(data, path):
+    """
+    Internal function writing the content of a TinyDB storage to the columnar layout. The data is written
+    to a temporary directory first which replaces the old data base when complete.
+    """
+    path = path.rstrip(os.sep)
+    tmpPath = path + ".tmp"
+    if os.path.isdir(tmpPath):
+        shutil.rmtree(tmpPath)
+    os.makedirs(tmpPath)
+
+    meta = {'format': columnarFormat, 'version': columnarVersion, 'tables': {}}
+    for t, (table, docs) in enumerate((data or {}).items()):
+        docIds = list(docs.keys())
+
+        # first pass: split the scalar entries from the array candidates
+        scalars = []
+        columns = {}
+        for pos, docId in enumerate(docIds):
+            row = {}
+            for key, value in docs[docId].items():
+                if _isArrayCandidate(value):
+                    columns.setdefault(key, []).append(pos)
+                else:
+                    row[key] = _toBuiltin(value)
+            scalars.append(row)
+
+        # second pass: write one contiguous buffer and an index (position, start, stop) per column and data type,
+        # so integer and float arrays keep their types
+        arrays = {}
+        for c, (key, positions) in enumerate(columns.items()):
+            buffers = {}
+            index = {}
+            stop = {}
+            for pos in positions:
+                value = docs[docIds[pos]][key]
+                try:
+                    array = np.asarray(value)
+                except ValueError:
+                    array = None
+                if array is None or array.ndim != 1 or array.dtype.kind not in "biuf":
+                    # not a numeric array, keep it with the scalar entries
+                    scalars[pos][key] = _toBuiltin(value)
+                    continue
+                dtype = array.dtype.str
+                start = stop.get(dtype, 0)
+                buffers.setdefault(dtype, []).append(array)
+                index.setdefault(dtype, []).append((pos, start, start+len(array)))
+                stop[dtype] = start+len(array)
+            if not buffers:
+                continue
+
+            arrays[key] = []
+            for g, dtype in enumerate(buffers):
+                stem = "%s_%s_%s"%(t, c, g)
+                np.save(os.path.join(tmpPath, stem+".npy"), np.concatenate(buffers[dtype]))
+                np.save(os.path.join(tmpPath, stem+"_index.npy"), np.array(index[dtype], dtype=np.int64).reshape(-1, 3))
+                arrays[key].append(stem)
+            buffers = None
+
+        with open(os.path.join(tmpPath, "%s_scalars.pkl"%t), 'wb') as file2write:
+            pickle.dump(scalars, file2write, protocol=pickle.HIGHEST_PROTOCOL)
+        meta['tables'][table] = {'scalars': "%s_scalars.pkl"%t, 'doc_ids': docIds, 'arrays': arrays}
+
+    with open(os.path.join(tmpPath, columnarMeta), 'w') as file2write:
+        file2write.write(json.dumps(meta))
+
+    # replace the old data base
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmpPath, path)
+
+def _readColumnar(path, mmap=False):
+    """
+    Internal function reading a columnar data base into the TinyDB memory format. The arrays of the documents are
+    views into one buffer per column, if mmap is True into one memory-mapped buffer per column.
+    """
+    with open(os.path.join(path, columnarMeta)) as file2load:
+        meta = json.load(file2load)
+    if meta.get('format') != columnarFormat or meta.get('version', 0) > columnarVersion:
+        raise OSError("Unsupported columnar data base format in %s"%path)
+
+    data = {}
+    for table, tableMeta in meta['tables'].items():
+        with open(os.path.join(path, tableMeta['scalars']), 'rb') as file2load:
+            docs = pickle.load(file2load)
+
+        for key, stems in tableMeta['arrays'].items():
+            # version 1 stores one buffer per column
+            for stem in ([stems] if isinstance(stems, str) else stems):
+                values = np.load(os.path.join(path, stem+".npy"), mmap_mode="c" if mmap else None)
+                index = np.load(os.path.join(path, stem+"_index.npy"))
+                for pos, start, stop in index.tolist():
+                    docs[pos][key] = values[start:stop]
+
+        data[table] = dict(zip(tableMeta['doc_ids'], docs))
+    return data
+
 
 def newDB(store = None, mode="overwrite"):
     """
@@ -32,7 +430,7 @@ def newDB(store = None, mode="overwrite"):
     Parameters
     ---------
     store
-        Either string or None (default). If string, sets the file used for TinyDB file storage. If None, the data base is run in-memory.
+        Either string or None (default). If string, sets the file used for TinyDB file storage. If the string ends on '.gcdb', the columnar storage is used (see ColumnarStorage). If None, the data base is run in-memory.
     mode
         "append" or "overwrite"(default). If a file storage is set, this flag can be used to either append to the existing file store or to whipe it before adding new data (overwrite).
 
@@ -53,10 +451,13 @@ def newDB(store = None, mode="overwrite"):
         # check for write permissions in target dir
         if os.access(os.path.dirname(store), os.W_OK):
             # get a new TinyDB instance with the target file as file storage
-            db = TinyDB(store)
+            if _isColumnar(store):
+                db = TinyDB(store, storage=ColumnarStorage, table_class=IndexedTable)
+            else:
+                db = TinyDB(store, table_class=IndexedTable)
 
             # in overwrite mode, delete all data points in data base
-            if os.path.isfile(store) and mode is "overwrite":
+            if os.path.exists(store) and mode == "overwrite":
                 db.purge()
             return db
 
@@ -64,7 +465,7 @@ def newDB(store = None, mode="overwrite"):
             raise OSError("Cannot access specified storage location")
     else:
         # if no store is passed, use the in-memory version
-        return TinyDB(storage=MemoryStorage)
+        return TinyDB(storage=MemoryStorage, table_class=IndexedTable)
 
 
 def loadReaderDBs(path):
@@ -94,7 +495,7 @@ def loadReaderDBs(path):
 
 
 
-def prototypeIItoJson(files2import, delimiter="="):
+def prototypeIItoJson(files2import, delimiter="=", njobs=1, asArrays=False):
     """
     Convenience function to convert data from old Prototype II TXT format to json.
     
@@ -102,6 +503,10 @@ def prototypeIItoJson(files2import, delimiter="="):
     ---------
     files2import
         Directory, filename or list of files to import. Must end on 'TXT' or 'txt' to be imported
+    njobs
+        integer (default=1). Number of processes converting the files. If -1, all available processors are used
+    asArrays
+        Boolean (default: False). If True, the table columns are returned as typed numpy arrays instead of lists
 
     Returns
     ---------
@@ -110,21 +515,41 @@ def prototypeIItoJson(files2import, delimiter="="):
 
     """
 
-    docs = []
+    return list(iterPrototypeII(files2import, delimiter, njobs, asArrays))
+
+def iterPrototypeII(files2import, delimiter="=", njobs=1, asArrays=False):
+    """
+    Generator version of prototypeIItoJson. The files are converted one at a time (one chunk per process if njobs is not 1) when the documents are requested.
+    
+    Parameters
+    ---------
+    files2import
+        Directory, filename or list of files to import. Must end on 'TXT' or 'txt' to be imported
+    njobs
+        integer (default=1). Number of processes converting the files. If -1, all available processors are used
+    asArrays
+        Boolean (default: False). If True, the table columns are returned as typed numpy arrays instead of lists
+
+    Returns
+    ---------
+    docs
+        generator of json documents (python dictionaries) derived from the imported file(s)
+
+    """
+
     if isinstance(files2import, list):
-        for file in files2import:
-            if file.endswith(".TXT") or file.endswith(".txt"):
-                docs.append(_prototypeIItoJson(file, delimiter))
+        files2import = [file for file in files2import if file.endswith((".TXT", ".txt"))]
     elif os.path.isdir(files2import):
-        for dirs, subdirs, files in os.walk(files2import):
-            for file in files:
-                if file.endswith(".TXT") or file.endswith(".txt"):
-                    docs.append(_prototypeIItoJson(os.path.join(dirs, file), delimiter))
+        files2import = _findFiles(files2import, extension=(".TXT", ".txt"))
     elif os.path.isfile(files2import):
-        docs.append(_prototypeIItoJson(files2import, delimiter))
-    return docs
+        files2import = [files2import]
+    else:
+        files2import = []
 
-def _prototypeIItoJson(file, delimiter="="):
+    for doc in _mapFiles(functools.partial(_prototypeIItoJson, delimiter=delimiter, asArrays=asArrays), files2import, njobs):
+        yield doc
+
+def _prototypeIItoJson(file, delimiter="=", asArrays=False):
     """
     Internal helper function for prototypeIItoJson
     """
@@ -132,35 +557,29 @@ def _prototypeIItoJson(file, delimiter="="):
     unknown = 0
 
     with open(file, encoding='iso-8859-1') as fileStream:
-        while(True):
-            line = fileStream.readline()
-            if line == "":
-                break 
+        for line in fileStream:
 
             if "[" in line and "]" in line and "BEGIN" in line:
                 tableTitle = line[line.find('BEGIN')+len("BEGIN"):line.rfind(']')].strip()
 
-                tableContent = ""
-                while(True):
-                    line = fileStream.readline()
+                # collect the lines of the table, the same file iterator continues after the END line
+                tableLines = []
+                for line in fileStream:
                     if "[" in line and "]" in line and "END "+tableTitle in line:
                         break
-                    
-                    tableContent += line.replace(',', '.')
+                    tableLines.append(line)
                 
                 if "INFO" in tableTitle:
-                    for contentLine in tableContent.split('\n'):
+                    for contentLine in tableLines:
+                        if not contentLine.strip():
+                            continue
+                        contentLine = contentLine.replace(',', '.')
                         itemTitle = contentLine[0:contentLine.find(delimiter)].strip()
                         itemContent = contentLine[contentLine.find(delimiter)+1:].strip()
                         doc[itemTitle] = itemContent
                 else:
-                    tableContent = pd.read_csv(io.StringIO(tableContent), delimiter="\t")
-                    for key in tableContent:
-                        
-                        try:
-                            doc[key] = [x.item() for x in tableContent[key].values]
-                        except:
-                            doc[key] = [x for x in tableContent[key].values]
+                    for key, values in _parsePrototypeIITable(tableLines).items():
+                        doc[key] = values if asArrays else values.tolist()
                     
             elif delimiter in line:
                 itemTitle = line[0:line.find(delimiter)+1].strip()
@@ -173,8 +592,293 @@ def _prototypeIItoJson(file, delimiter="="):
 
     return doc
 
+def _parsePrototypeIITable(tableLines):
+    """
+    Internal helper parsing a tab separated Prototype II table with decimal commas into typed numpy arrays (one per column).
+    Numeric tables are tokenized in one pass, other tables are read with pandas.
+    """
+    tableLines = [line for line in tableLines if line.strip()]
+    if not tableLines:
+        return {}
+    header = tableLines[0].rstrip('\r\n').split('\t')
+    rows = tableLines[1:]
+
+    # numeric tables: decimal commas are replaced and the whole block is tokenized at once
+    text = "".join(rows).replace(',', '.')
+    tokens = text.split()
+    values = None
+    if len(tokens) == len(rows)*len(header) and all(len(row.rstrip('\r\n').split('\t')) == len(header) for row in rows):
+        try:
+            with warnings.catch_warnings():
+                # numpy warns about (and will raise on) incomplete parsing, which is detected by the number of values
+                warnings.filterwarnings("ignore", message="string or file could not be read to its end", category=DeprecationWarning)
+                values = np.fromstring(text, sep=" ")
+        except ValueError:
+            values = None
+    if values is None or values.size != len(tokens):
+        table = pd.read_csv(io.StringIO("".join(tableLines).replace(',', '.')), delimiter="\t")
+        return {key: table[key].values for key in table}
+
+    values = values.reshape(len(rows), len(header))
+    tokens = np.array(tokens).reshape(len(rows), len(header))
+    columns = {}
+    for i, key in enumerate(header):
+        # columns written without decimal separator or exponent in every row are integer columns, they are parsed
+        # from the text so large values keep their precision
+        if not any(c in token for token in tokens[:, i] for c in ".eEnNiI"):
+            try:
+                columns[key] = tokens[:, i].astype(np.int64)
+                continue
+            except (ValueError, OverflowError):
+                pass
+        columns[key] = values[:, i]
+    return columns
+
 
-def readFiles(files2load, db = None, store = None, mode="overwrite"):
+def _readFile(file2load):
+    """
+    Internal helper reading a single measurement file into a document
+    """
+    doc = {'filename': os.path.basename(file2load), 'filedir': os.path.dirname(file2load)}
+    with open(file2load, 'r') as ioWrapper2import:
+        doc.update(json.load(ioWrapper2import))
+    return doc
+
+def _readFileChanged(args):
+    """
+    Internal helper reading a measurement file if its content hash differs from the known one. Returns the document (None if unchanged) and the hash
+    """
+    file2load, knownHash = args
+    with open(file2load, 'rb') as ioWrapper2import:
+        content = ioWrapper2import.read()
+    digest = hashlib.sha1(content).hexdigest()
+    if digest == knownHash:
+        return None, digest
+
+    doc = {'filename': os.path.basename(file2load), 'filedir': os.path.dirname(file2load)}
+    doc.update(json.loads(content))
+    return doc, digest
+
+def _findFiles(dir2load, depth=None, extension='.json'):
+    """
+    Internal helper listing the files of a directory tree down to the given depth
+    """
+    files2import = []
+    for root, dirs, files in os.walk(dir2load):
+        files2import.extend([os.path.join(root, file) for file in files if file.endswith(extension)])
+        # the root directory is level 1
+        relPath = os.path.relpath(root, dir2load)
+        level = 1 if relPath == os.curdir else relPath.count(os.sep)+2
+        if depth is not None and level >= depth:
+            del dirs[:]
+    return files2import
+
+def _insertBatches(db, docs, batchSize):
+    """
+    Internal helper inserting documents from an iterable in batches
+    """
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= batchSize:
+            db.insert_multiple(batch)
+            batch = []
+    if batch:
+        db.insert_multiple(batch)
+
+def _mapFiles(func, files, njobs):
+    """
+    Internal helper mapping a reader function over files, in parallel if more than one job is requested. The order of the files is kept
+    """
+    if njobs == 1 or len(files) < 2:
+        for result in map(func, files):
+            yield result
+    else:
+        processes = njobs if njobs != -1 else max(multiprocessing.cpu_count()-1, 1)
+        chunksize = max(1, min(16, len(files)//(4*processes)))
+        with multiprocessing.Pool(processes=processes) as pool:
+            for result in pool.imap(func, files, chunksize):
+                yield result
+
+def _readFilesIncremental(files2load, db, njobs=1, batchSize=1000):
+    """
+    Internal function importing only new or changed files. The imported files are tracked in the manifest table of the data base
+    with their path, size, modification time, content hash and document id. Files with unchanged size and modification time are
+    skipped without being read, files with unchanged content are not parsed. Documents of changed files are replaced.
+
+    Returns
+    ---------
+    imported
+        number of imported documents
+    """
+    manifest = db.table(manifestTable)
+    entries = {entry['path']: entry for entry in manifest.all()}
+
+    # stat the files, only new or modified files are read
+    candidates = []
+    for file2load in files2load:
+        path = os.path.abspath(file2load)
+        fileStat = os.stat(file2load)
+        entry = entries.get(path)
+        if entry is None or entry['size'] != fileStat.st_size or entry['mtime'] != fileStat.st_mtime:
+            candidates.append((file2load, path, fileStat))
+    if not candidates:
+        return 0
+
+    imported = 0
+    newEntries = []
+    changedEntries = []
+    replacedIds = []
+    batch = []
+    batchEntries = []
+
+    def insertBatch():
+        docIds = db.insert_multiple(batch)
+        for docId, entry in zip(docIds, batchEntries):
+            entry['doc_id'] = docId
+        del batch[:]
+        del batchEntries[:]
+
+    results = _mapFiles(_readFileChanged, [(file2load, entries[path]['hash'] if path in entries else None) for file2load, path, fileStat in candidates], njobs)
+    for (file2load, path, fileStat), (doc, digest) in zip(candidates, results):
+        entry = entries.get(path)
+        if entry is None:
+            entry = {'path': path}
+            newEntries.append(entry)
+        else:
+            changedEntries.append(entry)
+        entry.update({'size': fileStat.st_size, 'mtime': fileStat.st_mtime, 'hash': digest})
+
+        # content did not change, only the file stats are updated
+        if doc is None:
+            continue
+
+        if entry.get('doc_id') is not None:
+            replacedIds.append(entry['doc_id'])
+        imported += 1
+        batch.append(doc)
+        batchEntries.append(entry)
+        if len(batch) >= batchSize:
+            insertBatch()
+    if batch:
+        insertBatch()
+
+    # remove outdated documents of changed files
+    replacedIds = [docId for docId in replacedIds if db.contains(doc_ids=[docId])]
+    if replacedIds:
+        db.remove(doc_ids=replacedIds)
+
+    if newEntries:
+        manifest.insert_multiple(newEntries)
+    if changedEntries:
+        manifest.write_back(changedEntries)
+
+    return imported
+
+def _toTimestamp(value):
+    """
+    Internal helper converting dates (strings, datetime objects) to pandas Timestamps
+    """
+    return None if value is None else pd.Timestamp(value)
+
+def _matchesFilter(doc, det_name=None, start=None, end=None):
+    """
+    Internal helper checking whether a document matches the detector name and the measurement date range [start, end)
+    """
+    if det_name is not None:
+        if isinstance(det_name, str):
+            det_name = [det_name]
+        if doc.get('det_name') not in det_name:
+            return False
+
+    if start is not None or end is not None:
+        date = doc.get('meas_dateTime', doc.get('meas_date'))
+        if date is None:
+            return False
+        date = pd.Timestamp(date)
+        if (start is not None and date < start) or (end is not None and date >= end):
+            return False
+    return True
+
+def iterFiles(files2load, njobs=1, det_name=None, start=None, end=None):
+    """
+    Generator over the documents of measurement files. Only one document (or one chunk per process if njobs is not 1) is held
+    in memory at a time, so analysis functions can be chained over large data sets without building a data base.
+
+    Example
+    ---------
+    Compute the glow curve parameters of all files of a detector
+        >>> for doc in gcdb.iterFiles(files, det_name='R19405'):
+        ...     gcana.calcGCparams('time_sec', 'PhCount')(doc)
+
+    Parameters
+    ---------
+    files2load
+        Either string or list. The measurement files to read.
+    njobs
+        integer (default=1). Number of processes parsing the files, see readFiles
+    det_name
+        string, list of strings or None (default). If passed, only documents of the given detector(s) are returned
+    start
+        date string, datetime or None (default). If passed, only documents measured at or after this date are returned ('meas_dateTime' or 'meas_date')
+    end
+        date string, datetime or None (default). If passed, only documents measured before this date are returned
+
+    Returns
+    ---------
+    docs
+        generator of documents
+    """
+    if not isinstance(files2load, list):
+        files2load = [files2load]
+    start, end = _toTimestamp(start), _toTimestamp(end)
+
+    for doc in _mapFiles(_readFile, files2load, njobs):
+        if _matchesFilter(doc, det_name, start, end):
+            yield doc
+
+def iterDir(dir2load, depth=None, njobs=1, det_name=None, start=None, end=None):
+    """
+    Generator over the documents of a directory of measurements, see iterFiles.
+
+    Example
+    ---------
+    Iterate over all readouts of April 2019
+        >>> for doc in gcdb.iterDir('./pathToDir', start='2019-04-01', end='2019-05-01'):
+        ...     gcana.calcGCparams('time_sec', 'PhCount')(doc)
+
+    Parameters
+    ---------
+    dir2load
+        String that contains the path to the directory to be read.
+    depth
+        Either integer or None (default). Limits the depth of subdirectories which are read, see readDir
+    njobs
+        integer (default=1). Number of processes parsing the files, see readFiles
+    det_name
+        string, list of strings or None (default). If passed, only documents of the given detector(s) are returned
+    start
+        date string, datetime or None (default). If passed, only documents measured at or after this date are returned
+    end
+        date string, datetime or None (default). If passed, only documents measured before this date are returned
+
+    Returns
+    ---------
+    docs
+        generator of documents
+    """
+    if not os.path.isdir(dir2load):
+        raise AttributeError("Directory is not accessible. Maybe incorrect name?")
+    return iterFiles(_findFiles(dir2load, depth), njobs, det_name, start, end)
+
+def _flush(db):
+    """
+    Internal helper writing a data base with columnar storage to disk, other storages write on every change
+    """
+    if isinstance(db.storage, ColumnarStorage):
+        db.storage.close()
+
+def readFiles(files2load, db = None, store = None, mode="overwrite", njobs=1, batchSize=1000, incremental=False):
     """
     Function to import single measurement files or a list of measurements.
     
@@ -188,6 +892,12 @@ def readFiles(files2load, db = None, store = None, mode="overwrite"):
         Either string or None (default). Only used if db is None. If string, sets the file used for TinyDB file storage. If None, the data base is run in-memory.
     mode
         "append" or "overwrite"(default). Only used if db is None. If a file storage is set, this flag can be used to either append to the existing file store or to whipe it before adding new data (overwrite).
+    njobs
+        integer (default=1). Number of processes parsing the files. If -1, all available processors are used. The documents are inserted in the order of the files as in the serial import
+    batchSize
+        integer (default=1000). The parsed documents are inserted into the data base in batches of this size
+    incremental
+        Boolean (default: False). If True, only files which are new or changed since their last import are read. The imported files are tracked in a manifest table stored with the data base, documents of changed files are replaced
 
     Returns
     ---------
@@ -200,17 +910,15 @@ def readFiles(files2load, db = None, store = None, mode="overwrite"):
     if not isinstance(files2load, list):
         files2load = [files2load]
 
-    data2import = []
-    for i, file2load in enumerate(files2load):
-        with open(file2load, 'r') as ioWrapper2import:
-            
-            data2import.append({'filename': os.path.basename(file2load), 'filedir': os.path.dirname(file2load)})
-            data2import[-1].update(json.load(ioWrapper2import))
-    
-    db.insert_multiple(data2import)
+    if incremental:
+        _readFilesIncremental(files2load, db, njobs, batchSize)
+    else:
+        # the parsed documents are streamed into the data base in the order of the files
+        _insertBatches(db, iterFiles(files2load, njobs), batchSize)
+    _flush(db)
     return db
 
-def readDir(dir2load, asDataFrame=False, depth = None, db = None, store = None, mode="overwrite"):
+def readDir(dir2load, asDataFrame=False, depth = None, db = None, store = None, mode="overwrite", njobs=1, incremental=False):
     """
     Function to import a directory of measurements.
 
@@ -222,6 +930,12 @@ def readDir(dir2load, asDataFrame=False, depth = None, db = None, store = None,
 
     Simple appending to an existing data base
         >>> gcdb.readDir('./pathToDir', db = existingDB)
+
+    Parallel import using four processes
+        >>> db = gcdb.readDir('./pathToDir', njobs = 4)
+
+    Nightly import of new files only into a stored data base
+        >>> db = gcdb.readDir('./pathToDir', store = 'archive.gcdb', mode = 'append', incremental = True)
     
     Parameters
     ---------
@@ -237,6 +951,10 @@ def readDir(dir2load, asDataFrame=False, depth = None, db = None, store = None,
         Either string or None (default). Only used if db is None. If string, sets the file used for TinyDB file storage. If None, the data base is run in-memory.
     mode
         "append" or "overwrite"(default). Only used if db is None. If a file storage is set, this flag can be used to either append to the existing file store or to whipe it before adding new data (overwrite).
+    njobs
+        integer (default=1). Number of processes parsing the files, see readFiles. If -1, all available processors are used
+    incremental
+        Boolean (default: False). If True, only files which are new or changed since their last import are read, see readFiles
 
     Returns
     ---------
@@ -248,33 +966,136 @@ def readDir(dir2load, asDataFrame=False, depth = None, db = None, store = None,
         raise AttributeError("Directory is not accessible. Maybe incorrect name?")
     if db is None:
         db = newDB(store, mode)
-    level = 0
 
-    files_found = 0
-    files2import = []
-    for root, dirs, files in os.walk(dir2load):
-        files2import.extend([os.path.join(root, file) for file in files if file.endswith('.json')])
-        files_found += len(files2import)
-        level += 1
-        if level == depth:
-            del dirs[:]
-    readFiles(files2import, db = db)
-
-    print(">> Imported %s glow curve files."%files_found)
+    files2import = _findFiles(dir2load, depth)
+    if incremental:
+        imported = _readFilesIncremental(files2import, db, njobs)
+        print(">> Imported %s new or changed of %s glow curve files."%(imported, len(files2import)))
+    else:
+        readFiles(files2import, db = db, njobs = njobs)
+        print(">> Imported %s glow curve files."%len(files2import))
+    _flush(db)
     if asDataFrame:
         return pd.DataFrame(db.all())
     else:
         return db
 
 
-def load(db2open):
+def _shuffleBytes(data, itemsize):
+    """
+    Internal helper grouping the bytes of array items by their significance, improves the compression of numeric arrays
+    """
+    data = np.frombuffer(data, dtype=np.uint8)
+    n = len(data)//itemsize
+    return data[:n*itemsize].reshape(n, itemsize).T.tobytes() + data[n*itemsize:].tobytes()
+
+def _unshuffleBytes(data, itemsize):
+    """
+    Internal helper inverting _shuffleBytes
+    """
+    data = np.frombuffer(data, dtype=np.uint8)
+    n = len(data)//itemsize
+    return data[:n*itemsize].reshape(itemsize, n).T.tobytes() + data[n*itemsize:].tobytes()
+
+# compression codecs of the stream format: compress(data, level), decompress(data), shuffle array buffers
+codecs = {
+    'none': (lambda data, level: data, lambda data: data, False),
+    'gzip': (lambda data, level: gzip.compress(data, 6 if level is None else level), gzip.decompress, False),
+    'bz2': (lambda data, level: bz2.compress(data, 9 if level is None else level), bz2.decompress, False),
+    'lzma': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress, False),
+    'shuffle': (lambda data, level: zlib.compress(data, 1 if level is None else level), zlib.decompress, True),
+}
+
+def _writeStream(data, path2save, codec="bz2", level=None, chunkSize=1000):
+    """
+    Internal function writing the content of a TinyDB storage in the chunked stream format:
+    a header (magic, format version, codec name) followed by frames of up to chunkSize documents. Each frame holds the
+    compressed pickle of the documents and the compressed out-of-band array buffers.
+    """
+    if codec not in codecs:
+        raise AttributeError("Invalid codec passed: valid are: "+str(list(codecs.keys())))
+    compress, _, shuffle = codecs[codec]
+
+    with open(path2save, 'wb') as file2write:
+        file2write.write(streamMagic + struct.pack('<BB', streamVersion, len(codec)) + codec.encode())
+
+        for table, docs in (data or {}).items():
+            docIds = list(docs.keys())
+            for i in range(0, max(len(docIds), 1), chunkSize):
+                chunk = {}
+                for docId in docIds[i:i+chunkSize]:
+                    doc = docs[docId]
+                    if shuffle:
+                        # numeric lists are converted to arrays so their buffers can be shuffled
+                        doc = {key: np.asarray(value) if isinstance(value, list) and _isArrayCandidate(value) else value for key, value in doc.items()}
+                    chunk[docId] = dict(doc)
+
+                buffers = []
+                frame = pickle.dumps((table, chunk), protocol=5, buffer_callback=buffers.append)
+                frame = compress(frame, level)
+                file2write.write(struct.pack('<QI', len(frame), len(buffers)))
+                file2write.write(frame)
+
+                for buffer in buffers:
+                    view = memoryview(buffer)
+                    itemsize = view.itemsize if shuffle else 1
+                    raw = buffer.raw()
+                    raw = compress(_shuffleBytes(raw, itemsize) if itemsize > 1 else raw, level)
+                    file2write.write(struct.pack('<BQ', itemsize, len(raw)))
+                    file2write.write(raw)
+                chunk = frame = buffers = None
+
+        # closing frame
+        file2write.write(struct.pack('<QI', 0, 0))
+
+def _readStream(db2open):
+    """
+    Internal function reading a data base stored in the chunked stream format (see _writeStream)
+    """
+    data = {}
+    with open(db2open, 'rb') as file2load:
+        file2load.read(len(streamMagic))
+        version, codecLength = struct.unpack('<BB', file2load.read(2))
+        if version > streamVersion:
+            raise OSError("Data base %s was stored with a newer version of the format"%db2open)
+        codec = file2load.read(codecLength).decode()
+        if codec not in codecs:
+            raise OSError("Unknown codec %s in data base %s"%(codec, db2open))
+        decompress = codecs[codec][1]
+
+        while True:
+            frameLength, nBuffers = struct.unpack('<QI', file2load.read(12))
+            if frameLength == 0:
+                break
+            frame = decompress(file2load.read(frameLength))
+
+            buffers = []
+            for i in range(nBuffers):
+                itemsize, length = struct.unpack('<BQ', file2load.read(9))
+                raw = decompress(file2load.read(length))
+                # bytearrays keep the restored arrays writeable
+                buffers.append(bytearray(_unshuffleBytes(raw, itemsize) if itemsize > 1 else raw))
+
+            table, chunk = pickle.loads(frame, buffers=buffers)
+            data.setdefault(table, {}).update(chunk)
+    return data
+
+def load(db2open, mmap=False):
     """
     Load a stored glow curve data base
+
+    Example
+    ---------
+    Open a large columnar data base without reading the glow curves
+        >>> db = gcdb.load('archive.gcdb', mmap=True)
+        >>> docs = db.search(Query().det_name == 'R19405')
     
     Parameters
     ---------
     db2open
-        Path to the data base file
+        Path to the data base file or directory of a columnar data base (see ColumnarStorage)
+    mmap
+        Boolean (default: False). Only used for columnar data bases. If True, the arrays are memory-mapped and only read from disk when accessed, so queries on the scalar entries do not load the glow curves
     
     Returns
     ---------
@@ -282,16 +1103,29 @@ def load(db2open):
         TinyDB instance
 
     """
-    if db2open.endswith(".json"):
+    if _isColumnar(db2open):
+        if not os.path.isdir(db2open):
+            raise OSError("Cannot access specified storage location")
+        return TinyDB(db2open, storage=ColumnarStorage, mmap=mmap, table_class=IndexedTable)
+    elif db2open.endswith(".json"):
         return newDB(db2open, mode="append")
     else:
-        with bz2.BZ2File(db2open) as file2load:
-            db_data = pickle.load(file2load)
-            db = newDB()
-            db.storage.memory = db_data
+        with open(db2open, 'rb') as file2load:
+            isStream = file2load.read(len(streamMagic)) == streamMagic
+        if isStream:
+            db_data = _readStream(db2open)
+        else:
+            # data bases stored before version 1 of the stream format are a single bz2 compressed pickle
+            with bz2.BZ2File(db2open) as file2load:
+                db_data = pickle.load(file2load)
+        db = newDB()
+        db.storage.memory = db_data
+        # the tables were set up on the empty storage, recreate them to continue the document ids
+        db._table_cache.clear()
+        db._table = db.table(TinyDB.DEFAULT_TABLE)
         return db
 
-def store(db, path2save, compress=True):
+def store(db, path2save, compress=True, columnar=False, codec="bz2", level=None, chunkSize=1000):
     """
     Store a TinyDB instance. Can be compressed to save disk memory.
     
@@ -300,9 +1134,17 @@ def store(db, path2save, compress=True):
     db
         TinyDB instance to be stored
     path2save
-        Path (string) where to save the content of the data base. Use .json extension for plain text saving and any extension for compressed saving
+        Path (string) where to save the content of the data base. Use .json extension for plain text saving, .gcdb extension for columnar saving and any extension for compressed saving
     compress
         Boolean (default: True). If True, the data is saved in a compressed form. Reduces the disk usage significantly
+    columnar
+        Boolean (default: False). If True, the data is saved in the columnar layout (see ColumnarStorage), a directory with the scalar entries in one table and the arrays as numpy buffers. Fast to load for large data bases
+    codec
+        Compression codec, one of "bz2" (default, smallest files), "gzip", "lzma", "shuffle" (fast, byte-shuffled array compression, numeric lists are restored as numpy arrays) or "none". The codec is recorded in the file, load() detects it
+    level
+        integer or None (default). Compression level of the codec, if None the default level of the codec is used
+    chunkSize
+        integer (default=1000). The documents are serialized, compressed and written in chunks of this size, so the data base does not need to fit into memory twice
     
     Returns
     ---------
@@ -310,20 +1152,21 @@ def store(db, path2save, compress=True):
         TinyDB instance
 
     """
-    if compress:
-        # get the dict from the memory
-        data2dump = db._storage.memory
-        # open a bzip2 file with highest (default) compression rate
-        with bz2.BZ2File(path2save, 'wb') as file2write:
-            # use pickle to serialize and save a little more space
-            pickle.dump(data2dump, file2write, protocol=pickle.HIGHEST_PROTOCOL)
+    # the indexes are stored with the data
+    data = _indexedData(db)
+
+    if columnar or path2save.rstrip(os.sep).endswith(columnarExtension):
+        _writeColumnar(data, path2save)
+
+    elif compress:
+        _writeStream(data, path2save, codec, level, chunkSize)
 
     else:
         if not path2save.endswith(".json"):
             path2save+=".json"
-        # simply store the string from memory
+        # simply store the string from memory, arrays of columnar or shuffled data bases are stored as lists
         with open(path2save, "w") as file2write:
-            file2write.write(json.dumps(db.storage.memory))
+            file2write.write(json.dumps(data, default=_toBuiltin))
     
 
 if __name__ == "__main__":
@@ -81,6 +81,27 @@ step_default = {
     'temperature': 2.5
 }
 
+# units of the simulation settings, converted to mSv, days (dt_pre) and hours (dt_post)
+unitPresets = {
+    'dose': {
+        'muSv': 1e-3,
+        'mSv': 1,
+        'Sv': 1e3
+    },
+    'dt_pre': {
+        's': 1/60/60/24,
+        'min': 1/60/24,
+        'h': 1/24,
+        'd': 1
+    },
+    'dt_post': {
+        's': 1/60/60,
+        'min': 1/60,
+        'h': 1,
+        'd': 24
+    }
+}
+
 sim_parameters = {
     'dose': 1,
     'dt_post': 1,
@@ -96,43 +117,103 @@ def getParams(which=None):
         return empirical_parameters[which]
  
 
-def computeKinetics(sim_settings=sim_parameters, sim_parameters=empirical_parameters):
+class KineticsModel(object):
     """
-    Internal function for glow curve simulation. Computes the kinetic parameters for given dose and fading time from the parameter pickle.
+    Empirical kinetics model of the simulation. The coefficients are loaded once into arrays, grouped by the fit
+    function of the parameters, so the dose, pre-fading and post-fading functions are evaluated for many simulation
+    settings with one numpy call per function. The model holds no state besides the read-only coefficients and can be
+    shared between threads.
+
+    Example
+    ---------
+    Kinetic parameters of a fading study
+        >>> model = gcsim.KineticsModel()
+        >>> kinetics = model(dose=1, dt_pre=0, dt_post=np.linspace(0, 24*30, 1000))
+        >>> kinetics['Im3'].shape
+        (1000,)
+
+    Parameters
+    ---------
+    parameters
+        dict (default=empirical_parameters). Empirical coefficients per setting ('dose', 'dt_post', 'dt_pre') and kinetic parameter
     """
-    
-    if sim_settings['dt_post'] == 0:
-        sim_settings['dt_post'] = 1/60
 
-    kinetic_parameters = {}
-    for key in functions_D.keys():
-        
-        doseFunction = functions_D[key]
-        doseParams = list(val for val in sim_parameters['dose'][key].values() if val is not None)[::2]
+    def __init__(self, parameters=empirical_parameters):
+        self.keys = list(functions_D.keys())
+        self._dose = self._compile(parameters['dose'], functions_D, self.keys)
+        self._fading = self._compile(parameters['dt_post'], functions_t, self.keys)
+        self._preIrrad = self._compile(parameters['dt_pre'], functions_tpre, self.keys)
+
+    @staticmethod
+    def _compile(coefficients, functions, keys):
+        """
+        Internal helper returning (function, rows, coefficients) per fit function: the rows of its parameters in keys and
+        the coefficients as read-only array of shape (number of coefficients, number of rows, 1)
+        """
+        groups = []
+        for function in dict.fromkeys(functions.values()):
+            groupKeys = [key for key in keys if functions.get(key) is function]
+            values = np.array([list(val for val in coefficients[key].values() if val is not None)[::2] for key in groupKeys], dtype=float)
+            values = values.T[:, :, np.newaxis]
+            values.flags.writeable = False
+            groups.append((function, [keys.index(key) for key in groupKeys], values))
+        return groups
+
+    def _evaluate(self, groups, x, default=np.nan):
+        """
+        Internal helper evaluating the functions for the settings x, returns an array with one row per key
+        """
+        values = np.full((len(self.keys), len(x)), default)
+        for function, rows, coefficients in groups:
+            values[rows] = function(x[np.newaxis, :], *coefficients)
+        return values
 
-        fadingFunction = functions_t[key]
-        fadingParams = list(val for val in sim_parameters['dt_post'][key].values() if val is not None)[::2]
+    def __call__(self, dose, dt_pre=0, dt_post=1):
+        """
+        Computes the kinetic parameters.
 
-        doseMean = doseFunction(sim_settings['dose'], *doseParams)
-        if fadingFunction(sim_settings['dt_pre']*24, *fadingParams) > 1e-5:
-            fadingMean = fadingFunction(sim_settings['dt_post']+sim_settings['dt_pre']*24, *fadingParams)/fadingFunction(sim_settings['dt_pre']*24, *fadingParams)
-        else:
-            fadingMean = 1
-        value = doseMean*fadingMean    
-        kinetic_parameters[key] = value
+        Parameters
+        ---------
+        dose
+            float or array-like. Dose in mSv
+        dt_pre
+            float or array-like (default=0). Time between the previous readout and the irradiation in days
+        dt_post
+            float or array-like (default=1). Time between the irradiation and the readout in hours, 0 is replaced by 1 min
 
-    for key in functions_tpre.keys():
-        preIrrad_Function = functions_tpre[key]
-        preIrrad_Params = list(val for val in sim_parameters['dt_pre'][key].values() if val is not None) [::2]
-        
-        preIrrad_Mean = preIrrad_Function(sim_settings['dt_pre'], *preIrrad_Params)
-        kinetic_parameters[key] *= preIrrad_Mean
-    
-    return kinetic_parameters
+        Returns
+        ---------
+        dict
+            arrays of the kinetic parameters, one value per setting
+        """
+        dose, dt_pre, dt_post = np.broadcast_arrays(*[np.atleast_1d(np.asarray(value, dtype=float)).ravel() for value in (dose, dt_pre, dt_post)])
+        dt_post = np.where(dt_post == 0, 1/60, dt_post)
+
+        fadingStart = self._evaluate(self._fading, dt_pre*24)
+        fadingEnd = self._evaluate(self._fading, dt_post+dt_pre*24)
+        valid = fadingStart > 1e-5
+        fadingMean = np.ones(fadingStart.shape)
+        np.divide(fadingEnd, fadingStart, out=fadingMean, where=valid)
+
+        kinetics = self._evaluate(self._dose, dose)*fadingMean*self._evaluate(self._preIrrad, dt_pre, default=1.)
+        return dict(zip(self.keys, kinetics))
+
+# model of the empirical parameters shipped with gcpy
+kineticsModel = KineticsModel()
+
+
+def computeKinetics(sim_settings=sim_parameters, sim_parameters=empirical_parameters):
+    """
+    Internal function for glow curve simulation. Computes the kinetic parameters for given dose and fading time from the
+    empirical parameters, see KineticsModel. The settings are not modified.
+    """
+    model = kineticsModel if sim_parameters is empirical_parameters else KineticsModel(sim_parameters)
+    kinetic_parameters = model(sim_settings['dose'], sim_settings['dt_pre'], sim_settings['dt_post'])
+    return {key: float(value[0]) for key, value in kinetic_parameters.items()}
 
 
 
-def genCurve(kinetic_parameters, time_col, photon_col):
+def genCurve(kinetic_parameters, time_col, photon_col, signal_noise=None):
         """
         Internal method for glow curve simulation. Generates the curve DataFrame.
         """
@@ -172,59 +253,192 @@ def genCurve(kinetic_parameters, time_col, photon_col):
 
 
         ### handle signal noise setting
-        if sim_parameters['signal_noise']:
+        if signal_noise is None:
+            signal_noise = sim_parameters['signal_noise']
+        if signal_noise:
             y = np.array(list(map(lambda x: np.random.poisson(lam=x), y)))
 
         result['PhCount'] = y
         return result
 
 
+def _parseUnit(key, value):
+    """
+    Internal helper converting a value with unit string like '2h' to the internal unit of the simulation setting key
+    """
+    if not isinstance(value, str):
+        raise AttributeError("Provide a value with a unit in form of a string please.")
+    units = [ unit in value for unit in unitPresets[key].keys() ]
+    if not any(units):
+        raise AttributeError("Invalid unit passed: valid are: "+str(unitPresets[key].keys()))
+    unit = list(compress(unitPresets[key].keys(), units))[0]
+    return float(value.replace(unit, ''))*unitPresets[key][unit]
+
+
 def generate(sim_params=None, kinetic_params=None, time_col='time_sec', photon_col='PhCount'):
-        presets = {
-            'dose': {
-                'muSv': 1e-3,
-                'mSv': 1,
-                'Sv': 1e3
-            },
-            'dt_pre': {
-                's': 1/60/60/24,
-                'min': 1/60/24,
-                'h': 1/24,
-                'd': 1
-            },
-            'dt_post': {
-                's': 1/60/60,
-                'min': 1/60,
-                'h': 1,
-                'd': 24
-            }
-
-        }
-        for key in ['dose', 'dt_pre', 'dt_post']:
-            if key not in sim_params.keys():
-                continue
-            if not isinstance(sim_params[key], str):
-                raise AttributeError("Provide a value with a unit in form of a string please.")
-            else:
-                units = [ unit in sim_params[key] for unit in presets[key].keys() ]
-                if not any(units):
-                    raise AttributeError("Invalid unit passed: valid are: "+str(presets[key].keys()))
-                else:
-                    unit = list(compress(presets[key].keys(), units))[0]
-                    value = float(sim_params[key].replace(unit, ''))*presets[key][unit]
-                    sim_params[key] = value
-
-        if sim_params:
-            sim_parameters.update(sim_params)
-
-        kinetic_parameters = computeKinetics()   
+        # the settings start from the module defaults, neither of them is modified
+        settings = dict(sim_parameters)
+        for key, value in (sim_params or {}).items():
+            settings[key] = _parseUnit(key, value) if key in unitPresets else value
+        if settings['dt_post'] == 0:
+            settings['dt_post'] = 1/60
+
+        kinetic_parameters = computeKinetics(settings)
         if kinetic_params:
             kinetic_parameters.update(kinetic_params)    
             
-        curve = genCurve(kinetic_parameters, time_col, photon_col)
-        for key in sim_parameters:
-            curve["sim_"+key] = sim_parameters[key]
+        curve = genCurve(kinetic_parameters, time_col, photon_col, settings['signal_noise'])
+        for key in settings:
+            curve["sim_"+key] = settings[key]
         for key in kinetic_parameters:
             curve["sim_"+key] = kinetic_parameters[key]
 
         return curve
+
+
+def computeKineticsBatch(dose, dt_pre=0, dt_post=1, sim_parameters=empirical_parameters):
+    """
+    Computes the kinetic parameters of computeKinetics for many simulation settings at once.
+
+    Parameters
+    ---------
+    dose
+        float or array-like. Dose in mSv
+    dt_pre
+        float or array-like (default=0). Time between the previous readout and the irradiation in days
+    dt_post
+        float or array-like (default=1). Time between the irradiation and the readout in hours, 0 is replaced by 1 min
+    sim_parameters
+        dict (default=empirical_parameters). Empirical coefficients of the kinetics
+
+    Returns
+    ---------
+    dict
+        arrays of the kinetic parameters, one value per setting
+    """
+    model = kineticsModel if sim_parameters is empirical_parameters else KineticsModel(sim_parameters)
+    return model(dose, dt_pre, dt_post)
+
+
+def _batchValues(key, values):
+    """
+    Internal helper converting a setting of generateBatch, numbers or strings with units, to a float array
+    """
+    values = np.atleast_1d(np.asarray(values, dtype=object))
+    return np.array([_parseUnit(key, value) if isinstance(value, str) else float(value) for value in values.ravel()]).reshape(values.shape)
+
+
+def _genCurves(kinetic_parameters, t, rng, signal_noise, peaks, templates=None):
+    """
+    Internal helper generating the glow curves of generateBatch for arrays of kinetic parameters
+    """
+    n = len(kinetic_parameters['T0'])
+    T = utils.exponentialHeating(t[np.newaxis, :], kinetic_parameters['T0'][:, np.newaxis], kinetic_parameters['alpha'][:, np.newaxis])
+
+    # peaks are evaluated at the bin centers, shifted like in genCurve, and scaled with the bin widths
+    lower = T[:, :-1]
+    upper = T[:, 1:]
+    centers = np.concatenate([(upper+lower)/2, upper[:, -1:]], axis=1) - 2.5
+    widths = np.concatenate([upper-lower, np.zeros((n, 1))], axis=1)
+    Tm = np.column_stack([kinetic_parameters['Tm%s'%peak] for peak in [2,3,4,5]])
+    Im = np.column_stack([kinetic_parameters['Im%s'%peak] for peak in [2,3,4,5]])
+    E = np.column_stack([kinetic_parameters['E%s'%peak] for peak in [2,3,4,5]])
+
+    I = np.empty((n, 4, len(t)))
+    for curve in range(n):
+        if templates is not None:
+            I[curve] = templates(centers[curve], Tm[curve], Im[curve], E[curve])
+        elif utils._cfunc is not None:
+            utils.ckitis2006(centers[curve], Tm[curve], Im[curve], E[curve], out=I[curve])
+        else:
+            I[curve] = utils.kitis2006(centers[curve], Tm[curve], Im[curve], E[curve])
+    np.maximum(I, 0, out=I)
+    I *= widths[:, np.newaxis, :]*step_default['temperature']
+
+    result = {'sim_T': T, 'sim_PhCount': I.sum(axis=1)}
+    if peaks:
+        for peak in [2,3,4,5]:
+            result['sim_Phcount_peak%s'%peak] = I[:, peak-2]
+    result['PhCount'] = rng.poisson(result['sim_PhCount']) if signal_noise else result['sim_PhCount'].copy()
+    return result
+
+
+def generateBatch(dose, dt_pre=0, dt_post=1, kinetic_params=None, signal_noise=True, seed=None, chunkSize=None, peaks=False, time_col='time_sec', templates=None):
+    """
+    Simulates many glow curves at once. The kinetics are computed for all settings together, the peaks of each curve
+    are evaluated in one call and the noise of all curves is drawn in a single call.
+
+    Example
+    ---------
+    A dose scan with 1000 curves per dose value, reproducible by the seed
+        >>> dose = np.repeat(np.linspace(0.1, 10, 100), 1000)
+        >>> curves = gcsim.generateBatch(dose, dt_post='2h', seed=42)
+        >>> curves['PhCount'].shape
+        (100000, 2000)
+    Iterating over chunks of curves to limit the memory
+        >>> for chunk in gcsim.generateBatch(dose, dt_post='2h', seed=42, chunkSize=10000):
+        >>>     ...
+
+    Parameters
+    ---------
+    dose
+        float, string or array-like. Dose in mSv or with a unit like '100muSv'
+    dt_pre
+        float, string or array-like (default=0). Time between the previous readout and the irradiation in days or with a unit like '2h'
+    dt_post
+        float, string or array-like (default=1). Time between the irradiation and the readout in hours or with a unit like '3d'
+    kinetic_params
+        None (default) or dict. Kinetic parameters replacing the computed ones, floats or arrays with one value per curve
+    signal_noise
+        boolean (default=True). If True, Poisson noise is applied to the photon counts
+    seed
+        None (default), integer or numpy.random.Generator. Seed of the noise
+    chunkSize
+        None (default) or integer. If passed, an iterator over chunks of at most chunkSize curves is returned
+    peaks
+        boolean (default=False). If True, the counts of the single peaks are returned as 'sim_Phcount_peak<n>'
+    time_col
+        string (default='time_sec'). Key of the time axis
+    templates
+        None (default) or utils.TemplateBank. If passed, the peaks are interpolated from the bank instead of evaluating kitis2006
+
+    Returns
+    ---------
+    dict
+        the time axis shared by all curves, arrays with one row per curve ('sim_T', 'sim_PhCount', 'PhCount') and arrays
+        with one value per curve for the settings and kinetic parameters ('sim_<key>'). An iterator of such dicts if
+        chunkSize is passed
+    """
+    settings = dict(zip(['dose', 'dt_pre', 'dt_post'], np.broadcast_arrays(_batchValues('dose', dose), _batchValues('dt_pre', dt_pre), _batchValues('dt_post', dt_post))))
+    settings = {key: value.ravel() for key, value in settings.items()}
+    settings['dt_post'] = np.where(settings['dt_post'] == 0, 1/60, settings['dt_post'])
+    rng = np.random.default_rng(seed)
+    if chunkSize is None:
+        return next(_generateChunks(settings, kinetic_params, signal_noise, rng, max(len(settings['dose']), 1), peaks, time_col, templates))
+    if chunkSize < 1:
+        raise AttributeError("Invalid chunk size: ", chunkSize)
+    return _generateChunks(settings, kinetic_params, signal_noise, rng, chunkSize, peaks, time_col, templates)
+
+
+def _generateChunks(settings, kinetic_params, signal_noise, rng, chunkSize, peaks, time_col, templates):
+    """
+    Internal generator of the chunks of generateBatch
+    """
+    t = np.linspace(start_time, end_time, int((end_time-start_time)/step_default['time']))
+    n = len(settings['dose'])
+    for start in range(0, max(n, 1), chunkSize):
+        chunk = {key: value[start:start+chunkSize] for key, value in settings.items()}
+        kinetic_parameters = computeKineticsBatch(chunk['dose'], chunk['dt_pre'], chunk['dt_post'])
+        if kinetic_params:
+            for key, value in kinetic_params.items():
+                value = np.asarray(value, dtype=float)
+                kinetic_parameters[key] = np.broadcast_to(value if value.ndim == 0 else value[start:start+chunkSize], chunk['dose'].shape).copy()
+
+        curves = {time_col: t}
+        curves.update(_genCurves(kinetic_parameters, t, rng, signal_noise, peaks, templates))
+        for key in chunk:
+            curves["sim_"+key] = chunk[key]
+        curves["sim_signal_noise"] = signal_noise
+        for key in kinetic_parameters:
+            curves["sim_"+key] = kinetic_parameters[key]
+        yield curves
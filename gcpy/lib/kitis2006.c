@@ -2,103 +2,95 @@
 #include <stdlib.h>
 #include <stdio.h>
 
-double * kitis2006(int lenx, double *T, double *par){
-   
-    // read values from parameter array
-    double Tm = par[0];
-    double Im = par[1];
-    double E = par[2];
-    double Tg = par[3];  
-
-    // allocate and initialize I pointer
-    double *I;
-    I = malloc(lenx*sizeof(double));
-
-     // define constants
-    double k = 8.61733e-05;
-
-    // define criteria vars
-    int z,l,n;
-    double nFak;
-    double B,D,Z,Z2,ZM,Z2M;
-  	
-    // Zm term
+// Boltzmann constant k_B[eV/K]
+#define K_B 8.61733e-05
+
+// truncated asymptotic series with correction term, the factor (r^(n+1)-1) is only used if r != 0
+// the terms (-1)^n n! d^n and r^(n+1) are computed by recurrence
+static double asymptoticSeries(int z, double d, double r){
+
+    int n;
+    double term = 1;
+    double rPow = r;
+    double S = 0;
+    for(n=0; n<=z; n++){
+        if(n > 0){
+            term *= -n*d;
+            rPow *= r;
+        }
+        S += term*(r != 0 ? rPow-1 : 1);
+    }
+    // correction term
+    S += 0.5*term*(-(z+1)*d)*(r != 0 ? rPow*r-1 : 1);
+    return S;
+}
+
+// exponential integral series, the terms B^n/n! are computed by recurrence
+static double exponentialSeries(double B){
+
+    int n;
+    double term = 1;
+    double S = 0.5772156649+log(fabs(B));
+    for(n=1; n<=50; n++){
+        term *= B/n;
+        S += term/n;
+    }
+    return S;
+}
+
+// evaluate a single peak, writing into the lenx values of I
+static void kitis2006Peak(int lenx, const double *T, double Tm, double Im, double E, double Tg, double *I){
+
+    double k = K_B;
+    int z, i;
+    double B, D, Z, Z2;
+
+    // Zm terms, independent of the temperature
     int zM = abs(roundf(E*(Tm-Tg)/(k*Tm*Tg)));
+    double ZM_asa = asymptoticSeries(zM, k*Tm/E, Tg/(Tg-Tm));
+    double ZM_csa = exponentialSeries(E/(k*Tm)*(Tm-Tg)/Tg);
+    double Z2M_csa = asymptoticSeries(zM, k*Tm/E, 0);
 
     // loop over temperature values
-	int i;
-	for(i=0; i<lenx; i++){
-
-		z = abs(roundf(E/k*(T[i]-Tg)/(T[i]*Tg)));
-		if(z > 10){
-
-			Z = 0;
-			for(n=0; n<=z; n++){
-				nFak = 1;
-				for(l=1;l<=n;l++){
-					nFak *= l;
-				}
-				Z += pow(-1,n)*nFak*pow(k*T[i]/E,n)*(pow(Tg/(Tg-T[i]),n+1)-1);	
-			}
-			// correction term
-			Z += 0.5*pow(-1,z+1)*nFak*(z+1)*pow(k*T[i]/E,z+1)*(pow(Tg/(Tg-T[i]),z+2)-1);
-
-			ZM = 0;
-			for(n=0; n<=zM; n++){
-				nFak = 1;
-				for(l=1;l<=n;l++){
-					nFak *= l;
-				}
-				ZM += pow(-1,n)*nFak*pow(k*Tm/E,n)*(pow(Tg/(Tg-Tm),n+1)-1);
-			}
-			// correction term
-			ZM += 0.5*pow(-1,zM+1)*nFak*(zM+1)*pow(k*Tm/E,zM+1)*(pow(Tg/(Tg-Tm),zM+2)-1);
-
-			I[i] = Im*exp(-1*E*(Tm-T[i])/(k*T[i]*Tm)+(Tg-Tm)/Tm*(ZM-T[i]/Tm*exp(-1*E*(Tm-T[i])/(k*T[i]*Tm))*Z));
-		
-		}else{
-
-			B = E/(k*T[i])*(T[i]-Tg)/Tg;
-			D = k*T[i]/E;
-
-			Z = 0.5772156649+log(fabs(B));
-			ZM = 0.5772156649+log(fabs(E/(k*Tm)*(Tm-Tg)/Tg));
-
-			for(n=1; n<=50; n++){
-				nFak = 1;
-				for(l=1;l<=n;l++){
-					nFak *= l;
-				}
-				Z += pow(B,n)/(n*nFak);
-				ZM += pow(E/(k*Tm)*(Tm-Tg)/Tg,n)/(n*nFak);
-			}
-			
-			Z2 = 0;
-			for(n=0; n<=z; n++){
-				nFak = 1;
-				for(l=1;l<=n;l++){
-					nFak *= l;
-				}
-				Z2 += pow(-1,n)*nFak*pow(D,n);
-			}
-			// correction term
-			Z2 += 0.5*pow(-1,z+1)*nFak*(z+1)*pow(D,z+1);
-
-			Z2M = 0;
-			for(n=0; n<=zM; n++){
-				nFak = 1;
-				for(l=1;l<=n;l++){
-					nFak *= l;
-				}
-				Z2M += pow(-1,n)*nFak*pow(k*Tm/E,n);
-			}
-			// correction term
-			Z2M += 0.5*pow(-1,zM+1)*nFak*(zM+1)*pow(k*Tm/E,zM+1);
-
-			// integral computation
-			I[i] = Im*exp(-1*E*(Tm-T[i])/(k*T[i]*Tm)-E*(Tg-Tm)/(k*Tm*Tm)*exp(E*(Tg-Tm)/(k*Tm*Tg))*(ZM-Z)-(Tg-Tm)/Tm*(Z2M-Z2*T[i]/Tm*exp(-E*(Tm-T[i])/(k*T[i]*Tm))));
-		}
-	}
-
-	return I;
+    for(i=0; i<lenx; i++){
+
+        z = abs(roundf(E/k*(T[i]-Tg)/(T[i]*Tg)));
+        if(z > 10){
+
+            Z = asymptoticSeries(z, k*T[i]/E, Tg/(Tg-T[i]));
+            I[i] = Im*exp(-1*E*(Tm-T[i])/(k*T[i]*Tm)+(Tg-Tm)/Tm*(ZM_asa-T[i]/Tm*exp(-1*E*(Tm-T[i])/(k*T[i]*Tm))*Z));
+
+        }else{
+
+            B = E/(k*T[i])*(T[i]-Tg)/Tg;
+            D = k*T[i]/E;
+
+            Z = exponentialSeries(B);
+            Z2 = asymptoticSeries(z, D, 0);
+
+            // integral computation
+            I[i] = Im*exp(-1*E*(Tm-T[i])/(k*T[i]*Tm)-E*(Tg-Tm)/(k*Tm*Tm)*exp(E*(Tg-Tm)/(k*Tm*Tg))*(ZM_csa-Z)-(Tg-Tm)/Tm*(Z2M_csa-Z2*T[i]/Tm*exp(-E*(Tm-T[i])/(k*T[i]*Tm))));
+        }
+    }
+}
+
+// evaluate npeaks peaks with parameters par = {Tm_0, Im_0, E_0, Tm_1, ...} into the caller provided buffer I of npeaks*lenx values
+void kitis2006Peaks(int lenx, const double *T, int npeaks, const double *par, double Tg, double *I){
+
+    int p;
+    for(p=0; p<npeaks; p++){
+        kitis2006Peak(lenx, T, par[3*p], par[3*p+1], par[3*p+2], Tg, I+p*lenx);
+    }
+}
+
+// legacy interface, the returned buffer has to be released with kitis2006Free
+double * kitis2006(int lenx, double *T, double *par){
+
+    double *I = malloc(lenx*sizeof(double));
+    kitis2006Peak(lenx, T, par[0], par[1], par[2], par[3], I);
+    return I;
+}
+
+void kitis2006Free(double *I){
+    free(I);
 }
@@ -17,7 +17,6 @@ setup(
         "tinydb >= 3.13.0",
         "numba >= 0.43",
         "peakutils",
-        "uncertainties",
         "xlwt",
         "xlrd"
     ], #external packages as dependencies
@@ -1,7 +1,7 @@
 import unittest, os
 import numpy as np
 import pandas as pd
-from gcpy import gcana, gcdb
+from gcpy import gcana, gccache, gcdb, gcsim, utils
 
 path2testData = os.path.join(os.path.dirname(__file__), 'test_data/single_files')
 RoI_keys = ['RoI_low', 'RoI_high']
@@ -32,6 +32,25 @@ class GCanaTest(unittest.TestCase):
         self.assertTrue(all([key in db.get(doc_id=1).keys() for key in RoI_keys]))
         print("--> OK")
 
+    def test_calcRoIBatch(self):
+        print("Testing batch RoI detection against the results of the original single curve implementation")
+        table = gcana.getTable(gcdb.readDir(path2testData))
+        length = min([len(y) for y in table['PhCount']])
+        x = np.array(table['time_sec'].iloc[0][:length])
+        curves = np.stack([np.array(y[:length]) for y in table['PhCount']])
+        curves = np.concatenate([curves, 0.5*curves, curves[:, ::-1]])
+        # RoI indices of the while loop implementation before calcRoIBatch was introduced
+        reference = {
+            0: ([705, 648, 705, 648, 1091, 1232], [1837, 1696, 1837, 1696, 2223, 2280]),
+            2: ([467, 368, 467, 368, 392, 617], [2536, 2311, 2536, 2311, 2461, 2560]),
+        }
+        for iterations, (low, high) in reference.items():
+            roi = gcana.calcRoIBatch(x, curves, iterations=iterations)
+            self.assertEqual(roi['RoI_low'].tolist(), low)
+            self.assertEqual(roi['RoI_high'].tolist(), high)
+        self.assertEqual(gcana.calcRoI(x, curves[1]), {'RoI_low': 368, 'RoI_high': 2311})
+        print("--> OK")
+
     def test_calcGCparams(self):
         print("Testing insertion of GC param keys to data base")
         db = gcdb.readDir(path2testData)
@@ -50,6 +69,112 @@ class GCanaTest(unittest.TestCase):
         )
         print('--> OK')
 
+    def test_calcGCparamsBatch(self):
+        print("Testing batch GC params against the single curve version")
+        table = gcana.getTable(gcdb.readDir(path2testData))
+        length = min([len(y) for y in table['PhCount']])
+        x = np.array(table['time_sec'].iloc[0][:length])
+        curves = np.stack([np.array(y[:length]) for y in table['PhCount']])
+        results = gcana.calcGCparamsBatch(x, curves)
+        self.assertEqual(len(results), len(curves))
+        for i, y in enumerate(curves):
+            for key, value in gcana.calcGCparams(x, y).items():
+                self.assertAlmostEqual(value, results[key].iloc[i])
+        # background subtracted curves with negative counts
+        subtracted = curves - curves.mean(axis=1, keepdims=True)
+        results = gcana.calcGCparamsBatch(x, subtracted)
+        for i, y in enumerate(subtracted):
+            for key in ['gc_t_nphotonFirstQuarter', 'gc_t_nphotonSecondQuarter', 'gc_t_nphotonThirdQuarter']:
+                self.assertAlmostEqual(gcana.calcGCparams(x, y)[key], results[key].iloc[i])
+        table = table.assign(time_sec=[x]*len(table), PhCount=list(curves))
+        table = gcana.calcGCparamsBatch('time_sec', 'PhCount')(table)
+        self.assertTrue(all([key in table.columns for key in GCparam_keys]))
+        print("--> OK")
+
+    def test_kitis2006(self):
+        print("Testing vectorised kitis2006 peaks")
+        T = np.linspace(300, 572, 500)
+        Tm, Im, E = np.array([441.36, 483.11, 512.1, 537.02]), np.array([1e4, 5e3, 3e3, 2e3]), np.array([1.2, 1.5, 1.8, 2.2])
+        peaks = utils.kitis2006(T, Tm, Im, E)
+        self.assertEqual(peaks.shape, (4, len(T)))
+        for i in range(4):
+            single = utils.kitis2006(T, Tm[i], Im[i], E[i])
+            self.assertEqual(single.shape, T.shape)
+            self.assertTrue(np.allclose(peaks[i], single, rtol=0, atol=1e-8*Im[i]))
+            self.assertAlmostEqual(T[single.argmax()], Tm[i], delta=T[1]-T[0])
+            if utils._cfunc is not None:
+                self.assertTrue(np.allclose(single, utils.ckitis2006(T, Tm[i], Im[i], E[i]), rtol=0, atol=1e-8*Im[i]))
+        # without the C library ckitis2006 falls back to the numpy implementation
+        cfunc, utils._cfunc = utils._cfunc, None
+        try:
+            self.assertTrue(np.allclose(utils.ckitis2006(T, Tm, Im, E), peaks))
+            self.assertTrue(np.allclose(utils.ckitis2006(T, Tm[0], Im[0], E[0]), peaks[0]))
+        finally:
+            utils._cfunc = cfunc
+        print("--> OK")
+
+    def test_rebinHistRescale(self):
+        print("Testing rebinning of glow curves")
+        x = np.sort(np.random.uniform(300, 570, 1000))
+        y = np.random.poisson(50, 1000)
+        xNew = np.linspace(x.min(), x.max(), 100)
+        indices = np.digitize(x, xNew)
+        reference = np.append([0], [y[indices == i].sum()/(xNew[i]-xNew[i-1]) for i in range(1, len(xNew))])
+        self.assertTrue(np.allclose(utils.rebinHistRescale(x, y, xNew), reference))
+        self.assertTrue(np.allclose(utils.rebinHistRescale(x, np.stack([y, 2*y]), xNew), [reference, 2*reference]))
+        self.assertTrue(np.allclose(utils.rebinHistRescale(np.stack([x, x]), np.stack([y, 2*y]), xNew), [reference, 2*reference]))
+        self.assertEqual(len(utils.rebinHistRescale(x, y, [])), 0)
+        # the flux conserving variant keeps the counts within the new grid
+        rebinned = utils.rebinHistConserving(x, np.stack([y, y]), xNew)
+        self.assertTrue(np.allclose(np.sum(rebinned[:, 1:]*np.diff(xNew), axis=1), y[:-1].sum()))
+        self.assertTrue(np.allclose(utils.rebinHistConserving(np.arange(10.), np.ones(10), [0, 2.5, 5, 10]), [0, 1, 1, 1]))
+        self.assertTrue(np.allclose(utils.rebinHistConserving(np.arange(10.), np.ones(10), rebinFactor=2), [0, 1, 1, 1, 1]))
+        print("--> OK")
+
+    def test_templateBank(self):
+        print("Testing the interpolated peak shape templates")
+        bank = utils.TemplateBank.build(Tm=np.arange(480., 490.01, 0.5), E=np.arange(1.4, 1.701, 0.05))
+        T = np.linspace(350, 570, 300)
+        reference = utils.kitis2006(T, [483.11, 486.3], [300, 50], [1.55, 1.62])
+        self.assertTrue(np.allclose(bank(T, [483.11, 486.3], [300, 50], [1.55, 1.62]), reference, rtol=0, atol=2e-3*300))
+        self.assertTrue(np.allclose(bank.shape(483., 1.5), bank.shapes[6, 2]))
+        bank.save("test_templates.npy")
+        stored = utils.TemplateBank.load("test_templates.npy")
+        self.assertIsInstance(stored.shapes, np.memmap)
+        self.assertTrue(np.array_equal(stored(T, 483.11, 300, 1.55), bank(T, 483.11, 300, 1.55)))
+        with self.assertRaises(AttributeError):
+            bank(T, 441.36, 300, 1.25)
+        del stored
+        os.remove("test_templates.npy")
+        os.remove("test_templates.npy.json")
+        print("--> OK")
+
+    def test_jacobians(self):
+        print("Testing analytic Jacobians against finite differences")
+        def numeric(function, x, params):
+            steps = 1e-6*np.maximum(1, np.abs(params))
+            return np.column_stack([(function(x, *(params + step*np.eye(len(params))[i])) - function(x, *(params - step*np.eye(len(params))[i])))/(2*step) for i, step in enumerate(steps)])
+        t = np.linspace(0, 3, 200)
+        params = np.array([0.4, 0.3, 2.0, 0.2, 0.03, 0.05, 100, 200, 300, 5])
+        self.assertTrue(np.allclose(utils.gaussianMultiPeak3Jacobian(t, *params), numeric(utils.gaussianMultiPeak3, t, params), rtol=1e-5, atol=1e-5))
+        params = np.array([0.3, 0.4, 0.3, 2.0, 0.15, 0.03, 0.02, 0.05, 50, 100, 200, 300, 5])
+        self.assertTrue(np.allclose(utils.gaussianMultiPeak4Jacobian(t, *params), numeric(utils.gaussianMultiPeak4, t, params), rtol=1e-5, atol=1e-5))
+        T = np.linspace(350, 570, 200)
+        params = np.array([441.36, 483.11, 512.1, 537.02, 100, 200, 300, 100, 1.25, 1.55, 1.46, 2.4, 100, 600, 1e-3, 1e-2])
+        self.assertTrue(np.allclose(gcana.jacobian_kitis98(T, *params), numeric(gcana.fitmethod_kitis98, T, params), rtol=1e-4, atol=1e-4))
+        dTm, dIm, dE = utils.kitis2006Jacobian(T, 483.11, 300, 1.55)
+        self.assertTrue(np.allclose(dIm*300, utils.kitis2006(T, 483.11, 300, 1.55)))
+        self.assertTrue(np.allclose(dTm, numeric(lambda T, Tm: utils.kitis2006(T, Tm, 300, 1.55), T, np.array([483.11]))[:, 0], rtol=1e-3, atol=1e-3*np.abs(dTm).max()))
+        self.assertTrue(np.allclose(dE, numeric(lambda T, E: utils.kitis2006(T, 483.11, 300, E), T, np.array([1.55]))[:, 0], rtol=1e-3, atol=1e-3*np.abs(dE).max()))
+        # both series branches, batched over peaks. The steps are larger as the convergent series cancels strongly
+        Tm, Im, E = np.array([441.36, 512.1, 537.02]), np.array([100., 300., 100.]), np.array([1.25, 1.46, 2.4])
+        dTm, dIm, dE = utils.kitis2006Jacobian(T, Tm, Im, E, function=utils.ckitis2006)
+        numericTm = (utils.kitis2006(T, Tm+1e-2, Im, E)-utils.kitis2006(T, Tm-1e-2, Im, E))/2e-2
+        numericE = (utils.kitis2006(T, Tm, Im, E+1e-4)-utils.kitis2006(T, Tm, Im, E-1e-4))/2e-4
+        self.assertTrue(np.allclose(dTm, numericTm, rtol=1e-3, atol=1e-3*np.abs(dTm).max()))
+        self.assertTrue(np.allclose(dE, numericE, rtol=1e-3, atol=1e-3*np.abs(dE).max()))
+        print("--> OK")
+
     def test_Treco(self):
         print("Testing insertion of Treco keys to data base")
         db = gcdb.readDir(path2testData)
@@ -65,12 +190,176 @@ class GCanaTest(unittest.TestCase):
         self.assertTrue(all([(key in db.get(doc_id=1).keys()) and (db.get(doc_id=1)[key] is not None) for key in gcFit_keys]))
         print("--> OK")
 
+    def test_gcFitReference(self):
+        print("Testing gcFit against the results of the original curve_fit implementation")
+        # Tm, Im and E of the peaks 3 to 5 and the sum of squared residuals of the finite difference curve_fit
+        # implementation before the analytic Jacobians were introduced, on the Treco curves (peaks=3)
+        reference = {
+            'R19402': ([478.718, 512.219, 539.549], [120.15, 582.24, 1158.23], [1.5560, 1.4218, 2.1726], 10897.85),
+            'R19405': ([479.180, 512.413, 539.151], [130.96, 542.73, 1093.37], [1.3345, 1.5862, 2.1893], 9869.75),
+            'R19409': ([483.103, 512.779, 538.879], [252.09, 632.64, 1212.52], [1.6348, 1.6736, 2.2172], 8596.48),
+            'R19417': ([480.629, 511.693, 538.779], [202.00, 582.95, 1133.14], [1.3699, 1.6161, 2.1408], 15043.67),
+            'R19425': ([481.750, 512.473, 538.669], [195.56, 554.22, 1067.06], [1.4275, 1.6313, 2.1498], 9919.18),
+        }
+        db = gcdb.readDir(os.path.join(os.path.dirname(__file__), 'test_data/test_nested_dir'))
+        for doc in db.all():
+            if doc['det_name'] not in reference:
+                continue
+            Tm, Im, E, sse = reference[doc['det_name']]
+            treco = gcana.calcTreco(doc['time_sec'], doc['PhCount'], peaks=3)
+            results = gcana.gcFit(treco['Treco_T'], treco['Treco_PhCount'])
+            # the peaks agree within a small fraction of their fit uncertainties
+            for peak in range(3):
+                for name, value in [('Tm', Tm[peak]), ('Im', Im[peak]), ('E', E[peak])]:
+                    key = "gcfit_%s%s"%(name, peak+3)
+                    self.assertLess(abs(results[key]-value), 0.05*results[key+"_std_dev"], msg="%s %s"%(doc['det_name'], key))
+                # the uncertainties of the activation energies are a fraction of an eV
+                self.assertLess(results["gcfit_E%s_std_dev"%(peak+3)], 0.5)
+            self.assertLess(((results['gcfit_gcd']-results['gcfit_nPhotons'])**2).sum(), sse*(1+1e-4))
+        print("--> OK")
+
+    def test_fitExponentialHeating(self):
+        print("Testing the closed form heating fit")
+        from scipy.optimize import curve_fit
+        peakTemperatures = utils.peakTemps[1:]
+        t = utils.invertExponentialHeating(peakTemperatures, 300., 0.25) + np.array([0.05, -0.04, 0.03])
+        reference, referenceCov = curve_fit(lambda t, T0, alpha: utils.exponentialHeating(t, T0, alpha), t, peakTemperatures)
+        params, cov = utils.fitExponentialHeating(t, peakTemperatures)
+        self.assertLess(abs(params[0]-reference[0]), 1e-3*np.sqrt(referenceCov[0, 0]))
+        self.assertLess(abs(params[1]-reference[1]), 1e-3*np.sqrt(referenceCov[1, 1]))
+        self.assertTrue(np.allclose(cov, referenceCov, rtol=1e-3))
+        # batches of exact heating curves are recovered
+        times = np.stack([utils.invertExponentialHeating(peakTemperatures, T0, alpha) for T0, alpha in [(300., 0.25), (280., 0.3)]])
+        params, cov = utils.fitExponentialHeating(times, peakTemperatures, newton=False)
+        self.assertTrue(np.allclose(params, [[300., 0.25], [280., 0.3]]))
+        self.assertEqual(cov.shape, (2, 2, 2))
+        # direct temperature grid
+        t = np.linspace(0.005, 15, 2929)
+        y = np.random.default_rng(1).poisson(50, len(t)).astype(float)
+        T, grid, y_rebin = utils.exponentialHeatingGrid(t, y, 300., 0.25)
+        self.assertTrue(np.array_equal(grid, np.linspace(T.min(), T.max(), int((T.max()-T.min())/2.5))))
+        self.assertTrue(np.allclose(y_rebin, utils.rebinHistRescale(T, y, grid)))
+        print("--> OK")
+
+    def test_calcTrecoBatch(self):
+        print("Testing the batched temperature reconstruction")
+        db = gcdb.readDir(path2testData)
+        table = gcana.getTable(db)
+        for peaks in [3, 4]:
+            results = gcana.calcTrecoBatch(table['time_sec'].iloc[0], np.stack(table['PhCount']), peaks=peaks)
+            self.assertEqual(len(results), len(table))
+            for doc, result in zip(db.all(), results):
+                reference = gcana.calcTreco(doc['time_sec'], doc['PhCount'], peaks=peaks)
+                self.assertEqual(set(result), set(reference))
+                self.assertAlmostEqual(result['Treco_redChi2'], reference['Treco_redChi2'], places=4)
+                self.assertLess(abs(result['Treco_T0']-reference['Treco_T0']), 0.01*reference['Treco_T0_std_dev'])
+                self.assertAlmostEqual(result['Treco_alpha'], reference['Treco_alpha'], places=3)
+        # simulated four peak curves across doses and fading times
+        dose, dt_post = np.meshgrid(np.geomspace(0.1, 10, 7), [1, 24, 48, 56])
+        sim = gcsim.generateBatch(dose.ravel(), dt_post=dt_post.ravel(), seed=7)
+        results = gcana.calcTrecoBatch(sim['time_sec'], sim['PhCount'], peaks=4)
+        for curve, result in zip(sim['PhCount'], results):
+            reference = gcana.calcTreco(sim['time_sec'], curve, peaks=4)
+            self.assertFalse('Treco_error' in result or 'Treco_error' in reference)
+            self.assertLess(abs(result['Treco_T0']-reference['Treco_T0']), reference['Treco_T0_std_dev'])
+            self.assertLess(result['Treco_redChi2'], 1.01*reference['Treco_redChi2'])
+        df = gcana.calcTrecoBatch('time_sec', 'PhCount')(table)
+        self.assertTrue(all(key in df.columns for key in ['Treco_T0', 'Treco_alpha', 'Treco_T']))
+        with self.assertRaises(AttributeError):
+            gcana.calcTrecoBatch(table['time_sec'].iloc[0], np.stack(table['PhCount']), peaks=None)
+        print("--> OK")
+
+    def test_gcFitStages(self):
+        print("Testing the staged glow curve fit")
+        doc = gcdb.readDir(path2testData).get(doc_id=1)
+        treco = gcana.calcTreco(doc['time_sec'], doc['PhCount'], peaks=3)
+        results = gcana.gcFit(treco['Treco_T'], treco['Treco_PhCount'])
+        self.assertEqual(results['gcfit_stages'], 'kitis98,kitis06')
+        self.assertTrue(results['gcfit_converged'])
+        self.assertTrue(results['gcfit_converged_kitis06'])
+        # a prefit with a high skip threshold is not run
+        stages = [{'name': 'kitis98', 'skip': np.inf}, {'name': 'kitis06', 'maxNfev': 5}]
+        results = gcana.gcFit(treco['Treco_T'], treco['Treco_PhCount'], stages=stages)
+        self.assertEqual(results['gcfit_stages'], 'kitis06')
+        self.assertEqual(results['gcfit_nfev_kitis98'], 0)
+        self.assertLessEqual(results['gcfit_nfev_kitis06'], 5)
+        self.assertFalse(results['gcfit_converged'])
+        self.assertFalse('gcfit_converged_kitis98' in results)
+        self.assertTrue('gcfit_Ntot' in results)
+        # warm started fits use the limit of warm starts
+        cache = gccache.FitCache()
+        gcana.gcFit(treco['Treco_T'], treco['Treco_PhCount'], cache=cache, cacheKey='curve')
+        stages = [{'name': 'kitis06', 'maxNfev': None, 'warmNfev': 1}]
+        results = gcana.gcFit(treco['Treco_T'], treco['Treco_PhCount'], cache=cache, cacheKey='curve', stages=stages)
+        self.assertTrue(results['gcfit_warmStart'])
+        self.assertEqual(results['gcfit_nfev_kitis06'], 1)
+        # the last stage has to be kitis06
+        for stages in [[], [{'name': 'kitis98'}], [{'name': 'kitis06'}, {'name': 'kitis98'}], [{'name': 'unknown'}, {'name': 'kitis06'}]]:
+            with self.assertRaises(AttributeError):
+                gcana.gcFit(treco['Treco_T'], treco['Treco_PhCount'], stages=stages)
+        print("--> OK")
+
+    def test_gcFitFast(self):
+        print("Testing the fast glow curve fit")
+        db = gcdb.readDir(path2testData)
+        docs = [gcana.calcTreco(doc['time_sec'], doc['PhCount'], peaks=3) for doc in db.all()[:2]]
+        full = gcana.gcFit(docs[0]['Treco_T'], docs[0]['Treco_PhCount'])
+        self.assertEqual(full['gcfit_mode'], 'full')
+        reference = [full['gcfit_%s'%key] for key in ['Tm2', 'Tm3', 'Tm4', 'Tm5', 'Im2', 'Im3', 'Im4', 'Im5', 'E2', 'E3', 'E4', 'E5', 'a', 'b', 'c', 'd']]
+        # refitting the same curve only adjusts the amplitudes, the fit does not get worse
+        fast = gcana.gcFit(docs[0]['Treco_T'], docs[0]['Treco_PhCount'], mode='fast', reference=reference)
+        self.assertEqual(fast['gcfit_mode'], 'fast')
+        self.assertTrue(all(key in fast for key in full if key.startswith('gcfit_') and 'nfev' not in key and not key.startswith('gcfit_converged_') and key not in ['gcfit_stages', 'gcfit_startRedChi2']))
+        self.assertLessEqual(fast['gcfit_redChi2'], full['gcfit_redChi2']*(1+1e-6))
+        self.assertLess(abs(fast['gcfit_Ntot']/full['gcfit_Ntot']-1), 0.05)
+        self.assertEqual(fast['gcfit_Tm2_std_dev'], 0)
+        full = gcana.gcFit(docs[1]['Treco_T'], docs[1]['Treco_PhCount'])
+        fast = gcana.gcFit(docs[1]['Treco_T'], docs[1]['Treco_PhCount'], mode='fast', reference=reference)
+        self.assertLess(abs(fast['gcfit_Ntot']/full['gcfit_Ntot']-1), 0.05)
+        # without the C library the numpy implementation of the peaks is used
+        cfunc, utils._cfunc = utils._cfunc, None
+        try:
+            numpyFast = gcana.gcFit(docs[1]['Treco_T'], docs[1]['Treco_PhCount'], mode='fast', reference=reference)
+        finally:
+            utils._cfunc = cfunc
+        self.assertAlmostEqual(numpyFast['gcfit_Ntot'], fast['gcfit_Ntot'], delta=1e-6*fast['gcfit_Ntot'])
+        # without reference parameters the full fit is performed
+        self.assertEqual(gcana.gcFit(docs[1]['Treco_T'], docs[1]['Treco_PhCount'], mode='fast')['gcfit_mode'], 'full')
+        with self.assertRaises(AttributeError):
+            gcana.gcFit(docs[1]['Treco_T'], docs[1]['Treco_PhCount'], mode='unknown')
+        print("--> OK")
+
+    def test_pipeline(self):
+        print("Testing the analysis pipeline")
+        db = gcdb.readDir(path2testData)
+        doc = db.get(doc_id=1)
+        pipeline = gcana.Pipeline(outputs=['gc_*', 'Treco_T0', 'gcfit_Ntot'])
+        results = pipeline.run(doc)
+        reference = gcana.calcGCparams(doc['time_sec'], doc['PhCount'])
+        reference.update(gcana.calcTreco(doc['time_sec'], doc['PhCount'], peaks=3))
+        self.assertEqual(results['gcfit_Ntot'], gcana.gcFit(reference['Treco_T'], reference['Treco_PhCount'])['gcfit_Ntot'])
+        self.assertEqual(results['Treco_T0'], reference['Treco_T0'])
+        self.assertFalse('Treco_T' in results)
+        self.assertTrue(all(results[key] == reference[key] for key in reference if key.startswith('gc_')))
+        pipeline.apply(db)
+        self.assertTrue(all('gcfit_Ntot' in doc and 'gc_Ntot' in doc for doc in db.all()))
+        df = gcana.Pipeline(['calcGCparams']).apply(pd.DataFrame(db.all()))
+        self.assertTrue(all(key in df.columns for key in GCparam_keys))
+        with self.assertRaises(AttributeError):
+            gcana.Pipeline(['gcFit', 'unknown'])
+        with self.assertRaises(AttributeError):
+            gcana.Pipeline(fitStages=[{'name': 'kitis98'}])
+        print("--> OK")
+
     def test_getTable(self):
         print("Test flattening to DataFrame")
         db = gcdb.readDir(path2testData)
         db.update(gcana.calcGCparams('time_sec', 'PhCount'))
         results = gcana.getTable(db)
         self.assertTrue(all([key in results.columns for key in GCparam_keys]))
+        results = gcana.getTable(db, arrays=False)
+        self.assertTrue(all([key in results.columns for key in GCparam_keys]))
+        self.assertFalse('PhCount' in results.columns)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
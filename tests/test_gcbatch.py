@@ -0,0 +1,58 @@
+import unittest, os, sys, subprocess
+import numpy as np
+from gcpy import gcana, gcdb, gcbatch
+
+testdirPath = os.path.join(os.path.dirname(__file__), 'test_data/test_nested_dir')
+
+def scaleInPlace(doc):
+    doc['PhCount'] *= 2
+
+class GCbatchTest(unittest.TestCase):
+
+    def test_batchUpdate(self):
+        print("Test parallel update of a data base with the batch engine")
+        db = gcdb.readDir(testdirPath)
+        reference = gcdb.readDir(testdirPath)
+        reference.update(gcana.calcGCparams('time_sec', 'PhCount'))
+        with gcbatch.BatchEngine(njobs=2, chunkSize=2) as engine:
+            engine.update(db, gcana.calcGCparams('time_sec', 'PhCount'), arrays=['time_sec', 'PhCount'])
+            # the workers are kept for the next job
+            docs = engine.update([dict(doc) for doc in reference.all()[:2]], gcana.calcTreco('time_sec', 'PhCount', peaks=3), arrays=['time_sec', 'PhCount'])
+            # the workers do not keep the shared memory of the last job mapped
+            if os.path.exists('/proc'):
+                for worker in engine._pool._pool:
+                    with open('/proc/%s/maps'%worker.pid) as maps:
+                        self.assertFalse('/dev/shm/psm_' in maps.read())
+        self.assertEqual(len(db), len(reference))
+        for doc, referenceDoc in zip(db.all(), reference.all()):
+            self.assertEqual(sorted(doc.keys()), sorted(referenceDoc.keys()))
+            self.assertTrue(np.array_equal(doc['PhCount'], referenceDoc['PhCount']))
+            self.assertTrue(np.allclose(doc['gc_NtRoI'], referenceDoc['gc_NtRoI'], equal_nan=True))
+        self.assertTrue(all('Treco_T0' in doc and 'CurrCount' in doc for doc in docs))
+        print("--> OK")
+
+    def test_sharedArrays(self):
+        print("Test the shared arrays of the workers")
+        docs = gcdb.readDir(testdirPath).all()[:2]
+        with gcbatch.BatchEngine(njobs=1) as engine:
+            # in-place changes of the shared arrays would be lost
+            with self.assertRaises(ValueError):
+                engine.map(docs, scaleInPlace, arrays=['PhCount'])
+        # the workers do not report the memory of the engine as leaked
+        script = "from gcpy import gcana, gcdb, gcbatch\n" \
+            "with gcbatch.BatchEngine(njobs=2) as engine:\n" \
+            "    engine.map(gcdb.readDir(%r).all(), gcana.calcGCparams('time_sec', 'PhCount'))\n"%testdirPath
+        run = subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), capture_output=True, text=True)
+        self.assertEqual(run.returncode, 0)
+        self.assertFalse('resource_tracker' in run.stderr)
+        print("--> OK")
+
+    def test_update(self):
+        print("Test update of documents with a temporary engine")
+        docs = gcdb.readDir(testdirPath).all()
+        doc = gcana.update(dict(docs[0]), gcana.calcGCparams('time_sec', 'PhCount'), njobs=1)
+        self.assertEqual(doc['gc_Ntot'], gcana.calcGCparams(docs[0]['time_sec'], docs[0]['PhCount'])['gc_Ntot'])
+        print("--> OK")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest, os, shutil
+import numpy as np
+from gcpy import gcana, gcdb, gccache
+
+path2testData = os.path.join(os.path.dirname(__file__), 'test_data/single_files')
+testCacheString = gccache.fitCachePath("test_db.json")
+testResultCacheString = gccache.resultCachePath("test_db.json")
+
+class GCcacheTest(unittest.TestCase):
+
+    def test_fitCache(self):
+        print("Test LRU eviction and storage of the fit cache")
+        cache = gccache.FitCache(testCacheString, maxsize=2)
+        cache.put('a', 'gcFit', [1, 2, 3], 10)
+        cache.put('b', 'gcFit', [4, 5, 6], 10)
+        self.assertTrue(np.array_equal(cache.get('a', 'gcFit')[0], [1, 2, 3]))
+        cache.put('c', 'gcFit', [7, 8, 9], 10)
+        self.assertEqual(len(cache), 2)
+        self.assertFalse('b' in cache)
+        self.assertIsNone(cache.get('a', 'calcTreco_10'))
+        cache.save()
+        newCache = gccache.FitCache(testCacheString)
+        self.assertTrue(np.array_equal(newCache.get('c', 'gcFit')[0], [7, 8, 9]))
+        self.assertEqual(newCache.get('c', 'gcFit')[1], 10)
+        os.remove(testCacheString)
+        print("--> OK")
+
+    def test_warmStart(self):
+        print("Test warm started fits")
+        cache = gccache.FitCache()
+        doc = gcdb.readDir(path2testData).get(doc_id=1)
+        key = gccache.fitKey(doc)
+        self.assertIn(doc['det_name'], key)
+        cold = gcana.calcTreco(doc['time_sec'], doc['PhCount'], cache=cache, cacheKey=key)
+        self.assertIsNotNone(cache.get(key, 'calcTreco_10'))
+        warm = gcana.calcTreco(doc['time_sec'], doc['PhCount'], cache=cache, cacheKey=key)
+        self.assertAlmostEqual(cold['Treco_T0'], warm['Treco_T0'], places=2)
+        gcana.gcFit(warm['Treco_T'], warm['Treco_PhCount'], cache=cache, cacheKey=key)
+        results = gcana.gcFit(warm['Treco_T'], warm['Treco_PhCount'], cache=cache, cacheKey=key)
+        self.assertTrue(results['gcfit_warmStart'])
+        self.assertTrue('gcfit_Ntot' in results)
+        # start values are clipped to the bounds and rescaled with the curve
+        p0 = gccache.warmStart(cache, key, 'gcFit', np.zeros(16), [np.full(16, -np.inf), np.full(16, np.inf)], 2*cache.get(key, 'gcFit')[1], amplitudes=[4])
+        self.assertAlmostEqual(p0[4], 2*cache.get(key, 'gcFit')[0][4])
+        p0 = gccache.warmStart(cache, key, 'gcFit', np.zeros(16), [np.full(16, -np.inf), np.full(16, np.inf)], 2*cache.get(key, 'gcFit')[1])
+        self.assertAlmostEqual(p0[4], cache.get(key, 'gcFit')[0][4])
+        # fits stopped at their evaluation limit are not cached
+        truncatedCache = gccache.FitCache()
+        results = gcana.gcFit(warm['Treco_T'], warm['Treco_PhCount'], cache=truncatedCache, cacheKey=key, stages=[{'name': 'kitis06', 'maxNfev': 1}])
+        self.assertFalse(results['gcfit_converged'])
+        self.assertIsNone(truncatedCache.get(key, 'gcFit'))
+        print("--> OK")
+
+    def test_resultCache(self):
+        print("Test the content-addressed result cache of the pipeline")
+        x, y = np.arange(10.), np.arange(10)
+        self.assertEqual(gccache.resultKey('calcTreco', [x, y], {'peaks': 3}), gccache.resultKey('calcTreco', [x.copy(), y.copy()], {'peaks': 3}))
+        self.assertNotEqual(gccache.resultKey('calcTreco', [x, y], {'peaks': 3}), gccache.resultKey('calcTreco', [x, y], {'peaks': 4}))
+        self.assertNotEqual(gccache.resultKey('calcTreco', [x, y]), gccache.resultKey('calcTreco', [x, y.astype(float)]))
+        self.assertNotEqual(gccache.resultKey('calcTreco', [x, y], version=1), gccache.resultKey('calcTreco', [x, y], version=2))
+        # least recently used entries are evicted
+        cache = gccache.ResultCache(maxBytes=1000)
+        for i in range(10):
+            cache.put(str(i), {'values': np.zeros(10)})
+        self.assertIsNone(cache.get('0'))
+        self.assertTrue(np.array_equal(cache.get('9')['values'], np.zeros(10)))
+
+        doc = gcdb.readDir(path2testData).get(doc_id=1)
+        cache = gccache.ResultCache(testResultCacheString)
+        results = gcana.Pipeline(resultCache=cache).run(doc)
+        self.assertEqual(len(cache), 3)
+        cached = gcana.Pipeline(resultCache=gccache.ResultCache(testResultCacheString)).run(doc)
+        self.assertEqual(cached['gcfit_cpuTime'], results['gcfit_cpuTime'])
+        # changed fit settings only rerun gcFit
+        gcana.Pipeline(resultCache=cache, fitStages=[{'name': 'kitis06', 'maxNfev': 5}]).run(doc)
+        self.assertEqual(len(cache), 4)
+        # warm started fits are cached separately
+        gcana.Pipeline(resultCache=cache, stages=['calcTreco'], cache=gccache.FitCache()).run(doc)
+        self.assertEqual(len(cache), 5)
+        cache.clear('gcFit')
+        self.assertEqual(len(cache), 3)
+        # overwritten entries are only counted once
+        size = cache._size
+        cache.put('overwritten', {'values': np.zeros(10)})
+        cache.put('overwritten', {'values': np.zeros(10)})
+        self.assertEqual(cache._size, size + os.path.getsize(cache._file('overwritten')))
+        shutil.rmtree(testResultCacheString)
+        print("--> OK")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,6 @@
-import unittest, os, json
+import unittest, os, json, shutil
+import numpy as np
+from tinydb import Query
 from gcpy import gcdb
 
 singleFilePath_1 = os.path.join(os.path.dirname(__file__),'test_data/single_files/20190430_145144_R19405.json')
@@ -6,6 +8,7 @@ singleFilePath_2 = os.path.join(os.path.dirname(__file__), 'test_data/single_fil
 testdirPath = os.path.join(os.path.dirname(__file__), 'test_data/test_nested_dir')
 testdbString = 'test_db.json'
 testStorageString = "test_storage"
+testColumnarString = "test_storage.gcdb"
 
 class GCDBTest(unittest.TestCase):  
 
@@ -18,6 +21,80 @@ class GCDBTest(unittest.TestCase):
         os.remove(testStorageString)
         print("--> OK")    
 
+    def test_store_open_codecs(self):
+        print("Test storage and opening of data base with the different codecs")
+        db = gcdb.readDir(testdirPath, depth=3)
+        for codec in ['gzip', 'lzma', 'none']:
+            gcdb.store(db, testStorageString, codec=codec, chunkSize=2)
+            self.assertEqual(db.all(), gcdb.load(testStorageString).all())
+        gcdb.store(db, testStorageString, codec='shuffle', level=3)
+        newDB = gcdb.load(testStorageString)
+        for doc, newDoc in zip(db.all(), newDB.all()):
+            self.assertEqual(sorted(doc.keys()), sorted(newDoc.keys()))
+            self.assertTrue(np.array_equal(doc['PhCount'], newDoc['PhCount']))
+            self.assertEqual(doc['det_name'], newDoc['det_name'])
+        os.remove(testStorageString)
+        print("--> OK")
+
+    def test_store_open_columnar(self):
+        print("Test columnar storage and opening of data base")
+        db = gcdb.readDir(testdirPath, depth=3)
+        gcdb.store(db, testColumnarString)
+        newDB = gcdb.load(testColumnarString)
+        self.assertEqual(len(db), len(newDB))
+        for doc, newDoc in zip(db.all(), newDB.all()):
+            self.assertEqual(sorted(doc.keys()), sorted(newDoc.keys()))
+            self.assertIsInstance(newDoc['PhCount'], np.ndarray)
+            for key in doc:
+                if isinstance(doc[key], list):
+                    self.assertTrue(np.array_equal(doc[key], newDoc[key]))
+                    self.assertEqual(np.asarray(doc[key]).dtype, newDoc[key].dtype)
+                else:
+                    self.assertEqual(doc[key], newDoc[key])
+        shutil.rmtree(testColumnarString)
+        # integer and float arrays of one column keep their types
+        db = gcdb.newDB()
+        db.insert_multiple([{'PhCount': [1, 2, 3]}, {'PhCount': [1.5, 2.5]}, {'PhCount': np.array([4, 5], dtype=np.int32)}])
+        gcdb.store(db, testColumnarString)
+        docs = gcdb.load(testColumnarString).all()
+        self.assertEqual([doc['PhCount'].dtype for doc in docs], [np.dtype(np.int64), np.dtype(np.float64), np.dtype(np.int32)])
+        self.assertEqual([doc['PhCount'].tolist() for doc in docs], [[1, 2, 3], [1.5, 2.5], [4, 5]])
+        shutil.rmtree(testColumnarString)
+        print("--> OK")
+
+    def test_open_columnar_mmap(self):
+        print("Test opening a columnar data base with memory-mapped arrays")
+        db = gcdb.readDir(testdirPath, depth=3)
+        gcdb.store(db, testColumnarString)
+        newDB = gcdb.load(testColumnarString, mmap=True)
+        docs = newDB.search(Query().det_name == 'R19405')
+        self.assertEqual(len(docs), 1)
+        self.assertIsInstance(docs[0]['PhCount'], np.memmap)
+        self.assertTrue(np.array_equal(docs[0]['PhCount'], db.search(Query().det_name == 'R19405')[0]['PhCount']))
+        # the arrays are converted back to the plain json format
+        gcdb.store(newDB, testdbString, compress=False)
+        self.assertEqual(db.all(), gcdb.load(testdbString).all())
+        os.remove(testdbString)
+        newDB.close()
+        shutil.rmtree(testColumnarString)
+        print("--> OK")
+
+    def test_columnarStorage(self):
+        print("Test import into a columnar storage data base")
+        db = gcdb.readFiles([singleFilePath_1, singleFilePath_2], store = testColumnarString)
+        # the import is written without closing the data base
+        self.assertEqual(len(gcdb.load(testColumnarString)), 2)
+        db.close()
+        db = gcdb.readFiles(singleFilePath_1, store = testColumnarString, mode = "append")
+        db.close()
+        db = gcdb.load(testColumnarString)
+        self.assertEqual(len(db), 3)
+        self.assertTrue(np.array_equal(db.get(doc_id=3)['PhCount'], db.get(doc_id=1)['PhCount']))
+        self.assertEqual(db.get(doc_id=2)['filename'], os.path.basename(singleFilePath_2))
+        db.close()
+        shutil.rmtree(testColumnarString)
+        print("--> OK")
+
     def test_dirImport(self):
         print("Test import of a nested directory with varying depth")
         db = gcdb.readDir(testdirPath, depth=1)
@@ -28,6 +105,115 @@ class GCDBTest(unittest.TestCase):
         self.assertEqual(len(db), 6)
         print("--> OK")
 
+    def test_parallelDirImport(self):
+        print("Test parallel import of a nested directory")
+        db = gcdb.readDir(testdirPath, depth=2)
+        parallelDB = gcdb.readDir(testdirPath, depth=2, njobs=2)
+        self.assertEqual(db.all(), parallelDB.all())
+        print("--> OK")
+
+    def test_incrementalDirImport(self):
+        print("Test incremental import of a directory")
+        tmpDir = "test_incremental_dir"
+        shutil.copytree(testdirPath, tmpDir)
+        db = gcdb.readDir(tmpDir, incremental=True)
+        self.assertEqual(len(db), 7)
+        # nothing changed, nothing is imported
+        db = gcdb.readDir(tmpDir, db=db, incremental=True)
+        self.assertEqual(len(db), 7)
+        # touched file with the same content is not imported again
+        os.utime(os.path.join(tmpDir, '20190430_150029_PMT_darkcurrent.json'), (0, 0))
+        db = gcdb.readDir(tmpDir, db=db, incremental=True)
+        self.assertEqual(len(db), 7)
+        # the manifest is stored with the data base, a changed file replaces its document
+        gcdb.store(db, testStorageString)
+        db = gcdb.load(testStorageString)
+        with open(os.path.join(tmpDir, '20190430_150029_PMT_darkcurrent.json')) as testFile:
+            data = json.load(testFile)
+        data['det_name'] = 'changed'
+        with open(os.path.join(tmpDir, '20190430_150029_PMT_darkcurrent.json'), 'w') as testFile:
+            json.dump(data, testFile)
+        db = gcdb.readDir(tmpDir, db=db, incremental=True)
+        self.assertEqual(len(db), 7)
+        self.assertEqual(len(db.search(Query().det_name == 'changed')), 1)
+        shutil.rmtree(tmpDir)
+        os.remove(testStorageString)
+        print("--> OK")
+
+    def test_iterDir(self):
+        print("Test iterating over the documents of a directory with filters")
+        self.assertEqual(len(list(gcdb.iterDir(testdirPath))), 7)
+        docs = list(gcdb.iterDir(testdirPath, det_name=['R19405', 'R19425']))
+        self.assertEqual(sorted([doc['det_name'] for doc in docs]), ['R19405', 'R19425'])
+        docs = list(gcdb.iterDir(testdirPath, start='2019-04-30T14:52', end='2019-04-30T14:59'))
+        self.assertEqual(sorted([doc['det_name'] for doc in docs]), ['R19402', 'R19409', 'R19417'])
+        print("--> OK")
+
+    def test_indexedLookup(self):
+        print("Test indexed queries of a data base")
+        db = gcdb.readDir(testdirPath)
+        docs = db.lookup(det_name='R19405')
+        self.assertEqual([doc.doc_id for doc in docs], [doc.doc_id for doc in db.search(Query().det_name == 'R19405')])
+        docs = db.lookup(start='2019-04-30T14:52', end='2019-04-30T14:59')
+        self.assertEqual(sorted([doc['det_name'] for doc in docs]), ['R19402', 'R19409', 'R19417'])
+        self.assertEqual(len(db.lookup(det_name=['R19402', 'R19405'], end='2019-04-30T14:59')), 2)
+        # the index follows inserts and updates
+        db.insert({'det_name': 'new', 'meas_date': '2019-05-01T10:00'})
+        self.assertEqual(len(db.lookup(det_name='new', start='2019-05-01')), 1)
+        db.update({'det_name': 'renamed'}, Query().det_name == 'new')
+        self.assertEqual(len(db.lookup(det_name='new')), 0)
+        self.assertEqual(len(db.lookup(det_name='renamed')), 1)
+        # the index is stored with the data, the stored data base is not changed
+        gcdb.store(db, testStorageString)
+        self.assertNotIn(gcdb.indexTable, db.tables())
+        newDB = gcdb.load(testStorageString)
+        self.assertEqual(len(newDB.table(gcdb.indexTable)), 1)
+        self.assertEqual(len(newDB.lookup(det_name='renamed')), 1)
+        self.assertEqual(len(newDB.lookup()), 8)
+        os.remove(testStorageString)
+        # json data bases reuse the stored index and their file is not rewritten by store
+        gcdb.store(db, testdbString, compress=False)
+        jsonDB = gcdb.load(testdbString)
+        with open(testdbString) as dbFile:
+            content = dbFile.read()
+        gcdb.store(jsonDB, testStorageString)
+        with open(testdbString) as dbFile:
+            self.assertEqual(dbFile.read(), content)
+        self.assertEqual(len(jsonDB.lookup(det_name='renamed')), 1)
+        self.assertIsNotNone(jsonDB.table(gcdb.TinyDB.DEFAULT_TABLE)._record)
+        # the stored index is dropped when the documents change
+        jsonDB.update({'det_name': 'again'}, Query().det_name == 'renamed')
+        self.assertEqual(len(jsonDB.lookup(det_name='again')), 1)
+        self.assertEqual(len(gcdb.load(testdbString).table(gcdb.indexTable)), 0)
+        jsonDB.close()
+        os.remove(testdbString)
+        os.remove(testStorageString)
+        print("--> OK")
+
+    def test_prototypeIIImport(self):
+        print("Test conversion of Prototype II TXT files")
+        testTxtString = "test_prototypeII.TXT"
+        with open(testTxtString, 'w', encoding='iso-8859-1') as testFile:
+            testFile.write("Detektor=R19405\nKommentar\n[BEGIN INFO]\nHeizrate=2,5\n[END INFO]\n")
+            testFile.write("[BEGIN DATA]\nZeit\tPhCount\n0,005\t12\n0,010\t15\n0,015\t9\n[END DATA]\n")
+        doc = gcdb.prototypeIItoJson(testTxtString)[0]
+        self.assertEqual(doc['Detektor='], 'R19405')
+        self.assertEqual(doc['UNKNOWN_0'], 'Kommentar')
+        self.assertEqual(doc['Heizrate'], '2.5')
+        self.assertEqual(doc['Zeit'], [0.005, 0.01, 0.015])
+        self.assertEqual(doc['PhCount'], [12, 15, 9])
+        self.assertIsInstance(doc['PhCount'][0], int)
+        doc = gcdb.prototypeIItoJson([testTxtString], asArrays=True)[0]
+        self.assertEqual(doc['PhCount'].dtype, np.int64)
+        # integer columns are detected from all rows and keep values above 2^53, text tables use pandas
+        columns = gcdb._parsePrototypeIITable(["A\tB\n", "1\t9007199254740993\n", "2,5\t2\n"])
+        self.assertEqual(columns['A'].dtype, np.float64)
+        self.assertEqual(columns['B'].tolist(), [9007199254740993, 2])
+        columns = gcdb._parsePrototypeIITable(["A\tB\n", "1\tx\n", "2\ty\n"])
+        self.assertEqual(columns['B'].tolist(), ['x', 'y'])
+        os.remove(testTxtString)
+        print("--> OK")
+
     def test_singleFileImport2Memory(self):
         print("Loading a single data point into memory data base")
         # load the specified file using the function
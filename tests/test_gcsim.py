@@ -0,0 +1,64 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from gcpy import gcsim
+
+class GCsimTest(unittest.TestCase):
+
+    def test_generateBatch(self):
+        print("Test batched glow curve simulation")
+        curves = gcsim.generateBatch(['1mSv', '300muSv'], dt_pre=['1d', 0], dt_post=['2h', '10min'], signal_noise=False, peaks=True)
+        self.assertEqual(curves['PhCount'].shape, (2, len(curves['time_sec'])))
+        self.assertTrue(np.allclose(curves['sim_dose'], [1, 0.3]))
+        self.assertTrue(np.allclose(curves['sim_PhCount'], sum(curves['sim_Phcount_peak%s'%peak] for peak in [2, 3, 4, 5])))
+        kinetics = gcsim.computeKineticsBatch([1, 0.3], [1, 0], [2, 1/6])
+        for i in range(2):
+            for key in ['T0', 'alpha', 'Tm3', 'Im4', 'E5']:
+                self.assertAlmostEqual(curves['sim_'+key][i], kinetics[key][i])
+        # noise is reproducible by the seed, chunks continue the random stream
+        dose = np.linspace(0.5, 5, 10)
+        curves = gcsim.generateBatch(dose, seed=42)
+        self.assertTrue(np.array_equal(curves['PhCount'], gcsim.generateBatch(dose, seed=42)['PhCount']))
+        chunks = list(gcsim.generateBatch(dose, seed=42, chunkSize=4))
+        self.assertEqual([len(chunk['PhCount']) for chunk in chunks], [4, 4, 2])
+        self.assertTrue(np.allclose(np.concatenate([chunk['sim_PhCount'] for chunk in chunks]), curves['sim_PhCount']))
+        # no settings give empty arrays
+        empty = gcsim.generateBatch([], peaks=True)
+        self.assertEqual(empty['PhCount'].shape, (0, len(curves['time_sec'])))
+        self.assertEqual(len(empty['sim_T0']), 0)
+        with self.assertRaises(AttributeError):
+            gcsim.generateBatch('1Gy')
+        print("--> OK")
+
+    def test_kineticsModel(self):
+        print("Test the vectorised kinetics model")
+        defaults = dict(gcsim.sim_parameters)
+        dose, dt_pre, dt_post = np.array([0.3, 1, 5]), np.array([0, 1, 0.5]), np.array([0, 2, 72])
+        kinetics = gcsim.KineticsModel()(dose, dt_pre, dt_post)
+        # reference values of the former single curve implementation of computeKinetics
+        reference = {
+            'Tm2': [444.7893767, 444.4587251, 442.9035752], 'Tm3': [485.9496865, 485.9839291, 485.1431256],
+            'Tm4': [510.933092, 511.2076885, 511.4755892], 'Tm5': [538.1265833, 538.0349981, 537.9023338],
+            'E2': [1.250423944, 1.255966321, 1.252158598], 'E3': [1.567992057, 1.577713529, 1.594933495],
+            'E4': [1.470210213, 1.502854562, 1.522415385], 'E5': [2.412415354, 2.409032311, 2.369844893],
+            'Im2': [44.0701684, 104.880961, 216.4307894], 'Im3': [39.64929763, 124.8389992, 614.0079881],
+            'Im4': [50.93382128, 172.6669137, 925.3108029], 'Im5': [90.90173921, 313.0048961, 1554.536447],
+            'T0': [205.7673044, 206.7084055, 208.4231763], 'alpha': [0.3454378109, 0.3441058391, 0.3392037536],
+        }
+        for key in gcsim.functions_D:
+            self.assertTrue(np.allclose(kinetics[key], reference[key], rtol=1e-8, atol=0))
+        for i in range(3):
+            single = gcsim.computeKinetics({'dose': dose[i], 'dt_pre': dt_pre[i], 'dt_post': dt_post[i]})
+            for key in gcsim.functions_D:
+                self.assertAlmostEqual(single[key], reference[key][i], delta=1e-8*abs(reference[key][i]))
+        # the module defaults are not modified by the simulation
+        curve = gcsim.generate({'dose': '5mSv', 'dt_post': '0h'})
+        self.assertEqual(curve['sim_dose'], 5)
+        self.assertEqual(gcsim.sim_parameters, defaults)
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(lambda value: gcsim.kineticsModel(value, 0, 1)['Im3'][0], np.linspace(0.1, 10, 20)))
+        self.assertTrue(np.allclose(results, gcsim.kineticsModel(np.linspace(0.1, 10, 20), 0, 1)['Im3']))
+        print("--> OK")
+
+if __name__ == '__main__':
+    unittest.main()